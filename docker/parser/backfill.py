@@ -0,0 +1,293 @@
+"""Backfill of channels history (run from cli).
+
+Messages of several channels are fetched concurrently by iter_messages (from
+old to new), written by batches (IngestBuffer + NewsWriter, i.e. duplicates
+are skipped) and the last written message id of each channel is saved to
+parser_checkpoints table, so backfill resumes from checkpoint after restart.
+Requests to telegram are limited by shared token bucket, on FloodWaitError
+all channels wait required time and the channel is resumed from its last
+message.
+
+Run from cli:
+    python ./app/parser/backfill.py --days 30
+    python ./app/parser/backfill.py --chats -1001101170442 --limit 5000
+    python ./app/parser/backfill.py --fake 2000  # fake client, for testing
+"""
+import time
+import asyncio
+import argparse
+from datetime import datetime, timedelta, timezone
+from telethon.errors import FloodWaitError
+from ingest_buffer import IngestBuffer
+from news_writer import NewsWriter
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        """
+        Args:
+            rate (float): tokens (requests) per second
+            capacity (int): max burst of requests (default - rate)
+        """
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """No tokens for all consumers during seconds (e.g. flood wait)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def load_checkpoints(engine):
+    """Return dict {chat_id: last_message_id}"""
+    pg_con = engine.raw_connection()
+    try:
+        pg_cur = pg_con.cursor()
+        pg_cur.execute("SELECT chat_id, last_message_id FROM parser_checkpoints;")
+        checkpoints = dict(pg_cur.fetchall())
+        pg_cur.close()
+    finally:
+        pg_con.close()
+    return checkpoints
+
+
+def save_checkpoint(engine, chat_id, news_source, last_message_id):
+    pg_con = engine.raw_connection()
+    try:
+        pg_cur = pg_con.cursor()
+        pg_cur.execute(
+            "INSERT INTO parser_checkpoints "
+            "(chat_id, news_source, last_message_id, date_updated) "
+            "VALUES (%s, %s, %s, now()) "
+            "ON CONFLICT (chat_id) DO UPDATE "
+            "SET last_message_id = EXCLUDED.last_message_id, "
+            "news_source = EXCLUDED.news_source, date_updated = now();",
+            (chat_id, news_source, last_message_id),
+        )
+        pg_con.commit()
+        pg_cur.close()
+    finally:
+        pg_con.close()
+
+
+async def flush_and_checkpoint(buffer, engine, chat_id, news_source, last_message_id):
+    """Save checkpoint only after all messages before it are written (the
+    checkpoint is kept below the first message of chat moved to dead-letter
+    file, so it is fetched again on resume)"""
+    while not await buffer.flush():
+        await asyncio.sleep(buffer.retry_delay())
+    lost = [message_id for key, message_id in buffer.dead_keys if key == chat_id]
+    if lost and min(lost) <= last_message_id:
+        last_message_id = min(lost) - 1
+        print(
+            "Error backfill {}: {} messages are not written, checkpoint {}".format(
+                news_source, len(lost), last_message_id
+            )
+        )
+    await asyncio.get_running_loop().run_in_executor(
+        None, save_checkpoint, engine, chat_id, news_source, last_message_id
+    )
+
+
+async def backfill_chat(
+    client,
+    chat_id,
+    last_message_id,
+    buffer,
+    engine,
+    bucket,
+    min_date,
+    limit,
+    page_size=100,
+    checkpoint_every=1000,
+):
+    """Fetch history of chat after last_message_id (or after min_date if
+    there is no checkpoint) and put messages to buffer"""
+
+    await bucket.acquire()
+    chat = await client.get_entity(chat_id)
+    count = 0
+    start = time.perf_counter()
+
+    while limit is None or count < limit:
+        # first page of request (after flood wait the retry waits for the end
+        # of pause here, before telegram is requested again)
+        await bucket.acquire()
+        try:
+            messages = client.iter_messages(
+                chat_id,
+                limit=None if limit is None else limit - count,
+                offset_date=min_date if last_message_id == 0 else None,
+                min_id=last_message_id,
+                reverse=True,
+                wait_time=0,
+            )  # requests are limited by bucket
+            fetched = 0
+            async for message in messages:
+                await buffer.put(
+                    (
+                        message.text,
+                        chat.username,
+                        datetime.now().isoformat(sep=" ", timespec="seconds"),
+                        message.date.isoformat(sep=" ", timespec="seconds"),
+                    ),
+                    key=(chat_id, message.id),
+                )
+                last_message_id = message.id
+                count += 1
+                fetched += 1
+                if fetched % page_size == 0:
+                    # ~ one request to telegram per page of messages, the next
+                    # page is requested on the next iteration
+                    await bucket.acquire()
+                if count % checkpoint_every == 0:
+                    await flush_and_checkpoint(
+                        buffer, engine, chat_id, chat.username, last_message_id
+                    )
+            break
+
+        except FloodWaitError as error:
+            print(
+                "Info: backfill {}: flood wait {} s".format(
+                    chat.username, error.seconds
+                )
+            )
+            bucket.pause(error.seconds)
+
+    await flush_and_checkpoint(buffer, engine, chat_id, chat.username, last_message_id)
+    print(
+        "Info: backfill {}: {} messages ({:.1f} s), last message id {}".format(
+            chat.username, count, time.perf_counter() - start, last_message_id
+        )
+    )
+    return count
+
+
+async def backfill(
+    client, engine, chats, days=30, limit=None, concurrency=4, rate=1.0, batch_size=1000
+):
+    """Backfill history of chats concurrently"""
+
+    writer = NewsWriter(engine)
+    buffer = IngestBuffer(
+        writer, max_size=batch_size, flush_interval=2, spill_path="backfill_spill.jsonl"
+    )
+    buffer_task = asyncio.create_task(buffer.run())
+    bucket = TokenBucket(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    checkpoints = await asyncio.get_running_loop().run_in_executor(
+        None, load_checkpoints, engine
+    )
+    min_date = datetime.now(timezone.utc) - timedelta(days=days)
+
+    async def run_chat(chat_id):
+        async with semaphore:
+            return await backfill_chat(
+                client,
+                chat_id,
+                checkpoints.get(chat_id, 0),
+                buffer,
+                engine,
+                bucket,
+                min_date,
+                limit,
+            )
+
+    try:
+        await client.start()
+        counts = await asyncio.gather(*[run_chat(chat_id) for chat_id in chats])
+    finally:
+        await buffer.close()
+        await buffer_task
+        await client.disconnect()
+
+    print(
+        "Info: backfill finished: {} messages, stats: {}".format(
+            sum(counts), {**buffer.stats(), **writer.stats()}
+        )
+    )
+
+
+def main():
+
+    from parser import CHATS, make_connection, make_client
+
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument(
+        "--chats",
+        default=",".join(map(str, CHATS)),
+        help="ids of channels separated by comma",
+    )
+    arg_parser.add_argument(
+        "--days",
+        type=int,
+        default=30,
+        help="history depth for channels without checkpoint",
+    )
+    arg_parser.add_argument(
+        "--limit", type=int, default=None, help="max amount of messages per channel"
+    )
+    arg_parser.add_argument("--concurrency", type=int, default=4)
+    arg_parser.add_argument(
+        "--rate", type=float, default=1.0, help="max requests to telegram per second"
+    )
+    arg_parser.add_argument("--batch-size", type=int, default=1000)
+    arg_parser.add_argument(
+        "--fake",
+        type=int,
+        default=0,
+        help="use fake client with N messages per channel",
+    )
+    args = arg_parser.parse_args()
+
+    chats = [int(chat) for chat in args.chats.split(",")]
+
+    async def run():
+        # client is created inside event loop (telethon binds to current loop)
+        if args.fake > 0:
+            from fake_client import FakeTelegramClient
+
+            client = FakeTelegramClient(chats, args.fake)
+        else:
+            client = make_client()
+        await backfill(
+            client,
+            make_connection(),
+            chats,
+            args.days,
+            args.limit,
+            args.concurrency,
+            args.rate,
+            args.batch_size,
+        )
+        if args.fake > 0:
+            print(
+                "Info: fake client: {} requests, {} during flood wait".format(
+                    len(client.request_times), client.flood_violations
+                )
+            )
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
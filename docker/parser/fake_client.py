@@ -0,0 +1,119 @@
+"""Fake telethon client for testing of backfill without telegram: channels
+with synthetic messages, optional FloodWaitError every flood_every requests.
+As telegram, the client keeps flood wait: requests before its end raise
+FloodWaitError too (counted in flood_violations), so retries without wait
+are caught.
+"""
+import math
+import time
+import random
+from datetime import datetime, timedelta, timezone
+from telethon.errors import FloodWaitError
+
+
+class FakeMessage:
+    def __init__(self, id, text, date):
+        self.id = id
+        self.text = text
+        self.date = date
+
+
+class FakeChat:
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+
+class FakeTelegramClient:
+    def __init__(
+        self,
+        chats,
+        messages_per_chat=1000,
+        page_size=100,
+        flood_every=0,
+        flood_seconds=1,
+        duplicates_share=0.1,
+        seed=0,
+    ):
+        """
+        Args:
+            chats: list of chat ids
+            messages_per_chat (int): amount of messages in history of each chat
+            page_size (int): messages per request (as telegram api)
+            flood_every (int): raise FloodWaitError every flood_every requests
+                               (0 - never)
+            flood_seconds (int): seconds of FloodWaitError (requests during
+                                 them raise FloodWaitError)
+            duplicates_share (float): share of messages with the same text as
+                                      in other chat (reposts)
+        """
+        self.page_size = page_size
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.requests = 0
+        self.request_times = []  # time.monotonic() of all requests
+        self.flood_violations = 0  # requests during flood wait
+        self._flood_until = 0.0
+
+        rnd = random.Random(seed)
+        start = datetime.now(timezone.utc) - timedelta(days=30)
+        self._chats = {}
+        self._history = {}
+        for chat in chats:
+            self._chats[chat] = FakeChat(chat, "fake_{}".format(abs(chat)))
+            self._history[chat] = [
+                FakeMessage(
+                    i,
+                    "Новость {} канала {}".format(
+                        i, "общего" if rnd.random() < duplicates_share else chat
+                    ),
+                    start + timedelta(seconds=i * 30 * 24 * 3600 // messages_per_chat),
+                )
+                for i in range(1, messages_per_chat + 1)
+            ]
+
+    async def start(self):
+        return self
+
+    async def disconnect(self):
+        pass
+
+    async def get_entity(self, chat):
+        return self._chats[chat]
+
+    def _request(self):
+        now = time.monotonic()
+        self.request_times.append(now)
+        if now < self._flood_until:
+            self.flood_violations += 1
+            raise FloodWaitError(
+                request=None, capture=math.ceil(self._flood_until - now)
+            )
+        self.requests += 1
+        if self.flood_every > 0 and self.requests % self.flood_every == 0:
+            self._flood_until = now + self.flood_seconds
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+
+    async def iter_messages(
+        self,
+        chat,
+        limit=None,
+        offset_date=None,
+        min_id=0,
+        reverse=False,
+        wait_time=None,
+    ):
+        """Messages of chat with id > min_id (and date >= offset_date for
+        reverse=True), from old to new if reverse=True"""
+        messages = [m for m in self._history[chat] if m.id > min_id]
+        if offset_date is not None and reverse:
+            messages = [m for m in messages if m.date >= offset_date]
+        if not reverse:
+            messages = messages[::-1]
+        if limit is not None:
+            messages = messages[:limit]
+
+        for i, message in enumerate(messages):
+            if i % self.page_size == 0:
+                self._request()
+            yield message
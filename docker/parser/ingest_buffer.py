@@ -0,0 +1,268 @@
+"""Async buffer for ingestion of messages to database.
+
+Messages are collected in memory and written by batches (bulk insert) when
+buffer reaches max_size or every flush_interval seconds. Writing is done in
+thread executor, so event loop (telethon handlers) is not blocked.
+
+Errors of writing:
+    - errors of data of rows (row_errors, e.g. encoding error, constraint
+      violation): batch is written by halves (bisection), so rows, which
+      can't be written even alone, are isolated and appended to dead-letter
+      file (jsonl) instead of blocking ingestion
+    - other errors (e.g. database is down): rows are returned to buffer and
+      retried with exponential backoff (up to max_backoff seconds) without
+      limit of attempts
+
+Rows can be put with key (e.g. id of message), keys of rows moved to
+dead-letter file are collected in dead_keys, so caller can tell which rows
+are lost. put() waits while buffer has max_buffer rows (backpressure). close()
+flushes all remaining messages (call it on shutdown), rows which are not
+written (database is down) are saved to spill file and put back to buffer
+at the next start.
+"""
+import os
+import asyncio
+import json
+import time
+import psycopg2
+
+# errors of data of rows (the same rows fail on retry)
+ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, UnicodeError, ValueError)
+
+
+class IngestBuffer:
+    def __init__(
+        self,
+        write_batch,
+        max_size=100,
+        flush_interval=2.0,
+        max_backoff=60.0,
+        max_buffer=100000,
+        dead_letter_path="ingest_dead_letter.jsonl",
+        spill_path="ingest_spill.jsonl",
+        row_errors=ROW_ERRORS,
+    ):
+        """
+        Args:
+            write_batch: function(rows) for bulk insert of list of rows
+                         (blocking, is called in thread executor)
+            max_size (int): flush when amount of rows in buffer >= max_size
+            flush_interval (float): max time (in seconds) between flushes
+            max_backoff (float): max wait (in seconds) before retry of failed
+                                 flush
+            max_buffer (int): max amount of rows in buffer (put() waits)
+            dead_letter_path (str): jsonl file for rows, which can't be written
+            spill_path (str): jsonl file for rows, which are not written at
+                              close (restored at start)
+            row_errors: exceptions of data of rows (other exceptions are
+                        retried)
+        """
+        self.write_batch = write_batch
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.max_buffer = max_buffer
+        self.dead_letter_path = dead_letter_path
+        self.spill_path = spill_path
+        self.row_errors = row_errors
+
+        self._rows = []  # (row, key)
+        self._flush_lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._space = asyncio.Event()
+        self._closed = False
+        self._attempts = 0  # failed flushes in a row
+
+        self.rows_written = 0
+        self.batches_written = 0
+        self.write_errors = 0
+        self.rows_dead_letter = 0
+        self.dead_keys = []  # keys of rows moved to dead-letter file
+        self.in_flight = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+        self._restore_spill()
+
+    async def put(self, row, key=None):
+        if self._closed:
+            raise RuntimeError("IngestBuffer is closed")
+        while len(self._rows) >= self.max_buffer:
+            self._full.set()
+            self._space.clear()
+            await self._space.wait()
+        self._rows.append((row, key))
+        if len(self._rows) >= self.max_size:
+            self._full.set()
+
+    def retry_delay(self):
+        """Wait (in seconds) before retry of failed flush (exponential backoff)"""
+        return min(
+            self.flush_interval * 2 ** max(self._attempts - 1, 0), self.max_backoff
+        )
+
+    async def flush(self):
+        """Write all rows of buffer (one batch). Return True if all rows put
+        before the call are written (or moved to dead-letter file)"""
+        async with self._flush_lock:
+            rows, self._rows = self._rows, []
+            self._full.clear()
+            self._space.set()
+            if len(rows) == 0:
+                return True
+
+            start = time.perf_counter()
+            self.in_flight = len(rows)
+            try:
+                (
+                    n_written,
+                    dead_rows,
+                    pending,
+                    error,
+                ) = await asyncio.get_running_loop().run_in_executor(
+                    None, self._write_rows, rows
+                )
+            finally:
+                self.in_flight = 0
+            self.write_dead_letter([row for row, _ in dead_rows])
+            self.dead_keys.extend(key for _, key in dead_rows if key is not None)
+            self.rows_written += n_written
+
+            if error is not None:
+                # return rows to buffer (before new rows), retry after backoff
+                print("Error ingest buffer write:\n", error)
+                self.write_errors += 1
+                self._attempts += 1
+                self._rows = pending + self._rows
+                return False
+
+            self._attempts = 0
+            self.last_flush_latency = time.perf_counter() - start
+            self.max_flush_latency = max(
+                self.max_flush_latency, self.last_flush_latency
+            )
+            self.batches_written += 1
+            return True
+
+    def _write_rows(self, rows):
+        """Write rows (list of (row, key)), on errors of data write them by
+        halves until rows, which fail alone, are isolated (blocking).
+
+        Returns:
+            tuple(amount of written rows, failed rows, rows not written because
+            of other error, the error or None)
+        """
+        n_written, dead_rows = 0, []
+        parts = [rows]  # stack of parts to write, the next part is the last
+        while parts:
+            part = parts.pop()
+            try:
+                self.write_batch([row for row, _ in part])
+                n_written += len(part)
+            except self.row_errors as error:
+                if len(part) == 1:
+                    print("Error ingest buffer row:\n", error)
+                    dead_rows.extend(part)
+                else:
+                    middle = len(part) // 2
+                    parts.extend([part[middle:], part[:middle]])
+            except Exception as error:
+                pending = part + [row for rest in parts[::-1] for row in rest]
+                return n_written, dead_rows, pending, error
+        return n_written, dead_rows, [], None
+
+    @staticmethod
+    def _append_jsonl(path, rows):
+        with open(path, "a", encoding="utf-8", errors="backslashreplace") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+
+    def write_dead_letter(self, rows):
+        """Append rows to dead-letter file (one json list per line)"""
+        if len(rows) == 0:
+            return
+        self._append_jsonl(self.dead_letter_path, rows)
+        self.rows_dead_letter += len(rows)
+        print(
+            "Error ingest buffer: {} rows are moved to {}".format(
+                len(rows), self.dead_letter_path
+            )
+        )
+
+    def _restore_spill(self):
+        """Put rows of spill file (not written at previous close) to buffer"""
+        if self.spill_path is None or not os.path.exists(self.spill_path):
+            return
+        with open(self.spill_path, encoding="utf-8") as f:
+            rows = [tuple(json.loads(line)) for line in f if line.strip()]
+        os.remove(self.spill_path)
+        self._rows = [(row, None) for row in rows] + self._rows
+        print(
+            "Info: ingest buffer: {} rows are restored from {}".format(
+                len(rows), self.spill_path
+            )
+        )
+
+    async def run(self):
+        """Flush buffer by size or by interval (until close)"""
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            if not await self.flush():
+                await asyncio.sleep(self.retry_delay())
+
+    async def close(self, retries=3):
+        """Stop accepting rows and write all remaining rows (rows, which are
+        not written after retries, are saved to spill file)"""
+        self._closed = True
+        for _ in range(retries):
+            if await self.flush():
+                break
+            await asyncio.sleep(self.flush_interval)
+        if len(self._rows) > 0:
+            rows, self._rows = self._rows, []
+            self._append_jsonl(self.spill_path, [row for row, _ in rows])
+            print(
+                "Error ingest buffer: {} rows are not written, saved to {}".format(
+                    len(rows), self.spill_path
+                )
+            )
+
+    def stats(self):
+        return {
+            "queue_depth": len(self._rows),
+            "in_flight": self.in_flight,
+            "rows_written": self.rows_written,
+            "batches_written": self.batches_written,
+            "write_errors": self.write_errors,
+            "rows_dead_letter": self.rows_dead_letter,
+            "last_flush_latency": round(self.last_flush_latency, 4),
+            "max_flush_latency": round(self.max_flush_latency, 4),
+        }
+
+
+async def start_stats_server(get_stats, port=8080):
+    """Minimal http server, returns json of get_stats() on any GET request"""
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = json.dumps(get_stats()).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, "0.0.0.0", port)
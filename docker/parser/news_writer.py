@@ -0,0 +1,214 @@
+"""Bulk writing of news to database with deduplication.
+
+For each message we compute hash of normalized text (lowercase, only letters
+and digits). Hashes are stored in news_text_hashes table (unique), so
+duplicates of news (forwards, reposts, repeated messages) are not written
+to news table (and are not processed by ml pipelines), they are recorded in
+news_duplicates table with id of the original news. Recently seen hashes
+are cached in memory to skip database checks.
+"""
+import re
+import hashlib
+import unicodedata
+from collections import OrderedDict
+from psycopg2.extras import execute_values
+
+RE_NOT_WORDS = re.compile(r"[\W_]+")
+# postgres NOTIFY channel with ids of new news (NEWS_INSERTED_CHANNEL in
+# src/common_funcs.py), listened by stream ml pipeline
+NEWS_INSERTED_CHANNEL = "news_inserted"
+
+
+def normalize_text(text):
+    """Lowercase letters and digits of text separated by single spaces"""
+    text = unicodedata.normalize("NFKC", text or "").lower().replace("ё", "е")
+    return RE_NOT_WORDS.sub(" ", text).strip()
+
+
+def text_hash(text):
+    """Hash of normalized text (None for text without letters and digits)"""
+    text = normalize_text(text)
+    if text == "":
+        return None
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class NewsWriter:
+    def __init__(self, engine, table_name="news", cache_size=100000):
+        """
+        Args:
+            engine: sqlalchemy engine
+            table_name (str): table of news
+            cache_size (int): amount of recent hashes in memory
+        """
+        self.engine = engine
+        self.table_name = table_name
+        self.cache_size = cache_size
+        self._recent = OrderedDict()  # {text_hash: id_news}
+
+        self.news_written = 0
+        self.duplicates_cache = 0
+        self.duplicates_db = 0
+
+    def _remember(self, hashes_ids):
+        for hash_, id_news in hashes_ids:
+            self._recent[hash_] = id_news
+            self._recent.move_to_end(hash_)
+        while len(self._recent) > self.cache_size:
+            self._recent.popitem(last=False)
+
+    def __call__(self, rows):
+        """Write rows (tuples(news_text, news_source, date_collected,
+        news_date)) in single transaction (blocking)"""
+
+        rows_hashes = [(row, text_hash(row[0])) for row in rows]
+
+        # duplicates of recent news (by cache) and inside the batch
+        duplicates = []  # tuples(text_hash, row)
+        candidates = []  # tuples(row, text_hash)
+        batch_hashes = set()
+        for row, hash_ in rows_hashes:
+            if hash_ is not None and (hash_ in self._recent or hash_ in batch_hashes):
+                duplicates.append((hash_, row))
+            else:
+                candidates.append((row, hash_))
+                batch_hashes.add(hash_)
+        n_duplicates_cache = len(duplicates)
+
+        pg_con = self.engine.raw_connection()
+        try:
+            pg_cur = pg_con.cursor()
+
+            # duplicates of older news (by db)
+            pg_cur.execute(
+                "SELECT text_hash, id_news FROM news_text_hashes "
+                "WHERE text_hash = ANY(%s);",
+                ([hash_ for _, hash_ in candidates if hash_ is not None],),
+            )
+            db_hashes = dict(pg_cur.fetchall())
+            duplicates.extend(
+                (hash_, row) for row, hash_ in candidates if hash_ in db_hashes
+            )
+            candidates = [
+                (row, hash_) for row, hash_ in candidates if hash_ not in db_hashes
+            ]
+
+            ids, new_hashes, n_lost, lost_hashes = [], [], 0, set()
+            if len(candidates) > 0:
+                # ids are returned in order of values
+                ids = execute_values(
+                    pg_cur,
+                    "INSERT INTO {} "
+                    "(news_text, news_source, date_collected, news_date) "
+                    "VALUES %s RETURNING id_news;".format(self.table_name),
+                    [row for row, _ in candidates],
+                    page_size=len(candidates),
+                    fetch=True,
+                )
+                new_hashes = [
+                    (hash_, id_news)
+                    for (_, hash_), (id_news,) in zip(candidates, ids)
+                    if hash_ is not None
+                ]
+
+            if len(new_hashes) > 0:
+                inserted = execute_values(
+                    pg_cur,
+                    "INSERT INTO news_text_hashes (text_hash, id_news) VALUES %s "
+                    "ON CONFLICT (text_hash) DO NOTHING RETURNING text_hash;",
+                    new_hashes,
+                    page_size=len(new_hashes),
+                    fetch=True,
+                )
+                inserted = set(hash_ for (hash_,) in inserted)
+                # the same news was written meanwhile by other process
+                # (e.g. backfill), drop our copy
+                lost = [
+                    (hash_, id_news)
+                    for hash_, id_news in new_hashes
+                    if hash_ not in inserted
+                ]
+                n_lost = len(lost)
+                if n_lost > 0:
+                    pg_cur.execute(
+                        "DELETE FROM {} WHERE id_news = ANY(%s);".format(
+                            self.table_name
+                        ),
+                        ([id_news for _, id_news in lost],),
+                    )
+                    pg_cur.execute(
+                        "SELECT text_hash, id_news FROM news_text_hashes "
+                        "WHERE text_hash = ANY(%s);",
+                        ([hash_ for hash_, _ in lost],),
+                    )
+                    db_hashes.update(pg_cur.fetchall())
+                    lost_hashes = set(hash_ for hash_, _ in lost)
+                    duplicates.extend(
+                        (hash_, row)
+                        for row, hash_ in candidates
+                        if hash_ in lost_hashes
+                    )
+                    new_hashes = [
+                        (hash_, id_news)
+                        for hash_, id_news in new_hashes
+                        if hash_ in inserted
+                    ]
+                db_hashes.update(new_hashes)
+
+            # notify about new news (delivered on commit), payload of NOTIFY
+            # is limited by 8000 bytes
+            new_ids = sorted(
+                id_news
+                for (_, hash_), (id_news,) in zip(candidates, ids)
+                if hash_ not in lost_hashes
+            )
+            for i in range(0, len(new_ids), 500):
+                pg_cur.execute(
+                    "SELECT pg_notify(%s, %s);",
+                    (NEWS_INSERTED_CHANNEL, ",".join(map(str, new_ids[i:][:500]))),
+                )
+
+            if len(duplicates) > 0:
+                # original news can be deleted since it was cached, skip such
+                # duplicates (insert only if original exists)
+                execute_values(
+                    pg_cur,
+                    "INSERT INTO news_duplicates "
+                    "(id_news, news_source, date_collected, news_date) "
+                    "SELECT v.id_news, v.news_source, v.date_collected::timestamp, "
+                    "v.news_date::timestamp "
+                    "FROM (VALUES %s) "
+                    "v(id_news, news_source, date_collected, news_date) "
+                    "WHERE EXISTS (SELECT 1 FROM news WHERE id_news = v.id_news);",
+                    [
+                        (
+                            db_hashes.get(hash_) or self._recent[hash_],
+                            row[1],
+                            row[2],
+                            row[3],
+                        )
+                        for hash_, row in duplicates
+                    ],
+                    page_size=1000,
+                )
+
+            pg_con.commit()
+            pg_cur.close()
+        except Exception:
+            pg_con.rollback()
+            raise
+        finally:
+            pg_con.close()
+
+        self._remember(db_hashes.items())
+        self.news_written += len(candidates) - n_lost
+        self.duplicates_cache += n_duplicates_cache
+        self.duplicates_db += len(duplicates) - n_duplicates_cache
+
+    def stats(self):
+        return {
+            "news_written": self.news_written,
+            "duplicates_cache": self.duplicates_cache,
+            "duplicates_db": self.duplicates_db,
+            "recent_hashes": len(self._recent),
+        }
@@ -2,9 +2,15 @@ from telethon.sync import TelegramClient, events
 from telethon.sessions import StringSession
 import os
 import json
+import signal
+import asyncio
 from sqlalchemy import create_engine
 from datetime import datetime
-import pandas as pd
+from ingest_buffer import IngestBuffer, start_stats_server
+from news_writer import NewsWriter
+
+#РИА новости, ТАСС
+CHATS = [-1001101170442, -1001050820672]
 
 def make_connection():
 
@@ -34,39 +40,57 @@ def make_client():
 
     return TelegramClient(StringSession(SESSION), API_ID, API_HASH)
 
-async def upload_data(conn, event, chat, table_name):
-
-    news_dic = dict()
-    news_dic['news_text'] = [event.text]
-    news_dic['news_source'] = [chat.username]
-    news_dic['date_collected'] = [datetime.now().isoformat(sep=' ', timespec='seconds')]
-    news_dic['news_date'] = [event.date.isoformat(sep=' ', timespec='seconds')]
-    
-    df = pd.DataFrame().from_dict(news_dic)
+async def upload_data(buffer, event, chat):
 
-    df.to_sql(table_name, conn, index=False, if_exists='append', method='multi')
+    await buffer.put((
+        event.text,
+        chat.username,
+        datetime.now().isoformat(sep=' ', timespec='seconds'),
+        event.date.isoformat(sep=' ', timespec='seconds')))
 
-def main():
+async def main():
 
     conn = make_connection()
     table_name = 'news'
-    #РИА новости, ТАСС
-    chats = [-1001101170442, -1001050820672]
+
+    # messages are written by batches (by size or by interval) in background,
+    # duplicates of news are skipped (see news_writer)
+    writer = NewsWriter(conn, table_name)
+    buffer = IngestBuffer(
+        writer,
+        max_size=int(os.environ.get('INGEST_BATCH_SIZE', 100)),
+        flush_interval=float(os.environ.get('INGEST_FLUSH_INTERVAL', 2)),
+        dead_letter_path=os.environ.get(
+            'INGEST_DEAD_LETTER_FILE', 'ingest_dead_letter.jsonl'),
+        spill_path=os.environ.get('INGEST_SPILL_FILE', 'ingest_spill.jsonl'))
+    buffer_task = asyncio.create_task(buffer.run())
+    # stats of buffer (queue depth, flush latency) and duplicates
+    # on http://<host>:8080/
+    stats_server = await start_stats_server(
+        lambda: {**buffer.stats(), **writer.stats()}, 8080)
 
     client = make_client()
-    client.start()
-    
+    await client.start()
+
+    # disconnect on docker stop, remaining messages are flushed below
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: asyncio.ensure_future(client.disconnect()))
 
-    @client.on(events.NewMessage(chats = chats))
+    @client.on(events.NewMessage(chats = CHATS))
     async def handler(event):
         
         chat  = await event.get_chat()
-        await upload_data(conn, event, chat, table_name)
-
-    client.run_until_disconnected()
+        await upload_data(buffer, event, chat)
+
+    try:
+        await client.run_until_disconnected()
+    finally:
+        await buffer.close()
+        await buffer_task
+        stats_server.close()
+        print('Info: parser stopped, stats: {}'.format({**buffer.stats(), **writer.stats()}))
    
 
 if __name__ == '__main__':
-    main()
-
-
+    asyncio.run(main())
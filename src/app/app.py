@@ -1,15 +1,28 @@
 import uuid
 import re
 import os
-from itertools import combinations
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, redirect
 from werkzeug.middleware.proxy_fix import ProxyFix
 from waitress import serve
 from datetime import datetime, timedelta
 import pandas as pd
-import networkx as nx
-import psycopg2
 from psycopg2 import Error
+from src.app.graph_cache import GraphCache
+from src.app.graph_engine import links_to_triplets
+from src.app.ner_lookup import NerLookup
+from src.app.graph_store import RollingGraphStore
+from src.app.snapshots import SnapshotBuilder
+from src.app.db import PgPool
+from src.common_profiling import profile_stage, profiling_enabled
+from src.app.wire_format import (
+    GRAPH_FORMATS,
+    CONTENT_TYPE_JSON,
+    graph_to_format,
+    negotiate_content_type,
+    negotiate_encoding,
+    serialize,
+    compress,
+)
 
 
 # Hyperparameters
@@ -27,245 +40,261 @@ PG_CONN_CFG = {
 with open(os.environ.get("POSTGRES_PASSWORD_FILE"), "r") as f:
     PG_CONN_CFG["password"] = f.readlines()[0].rstrip("\n")
 
+# limits of graph size (larger graphs are pruned by weights of nodes and
+# edges, 0 - no limit)
+GRAPH_MAX_NODES = int(os.environ.get("GRAPH_MAX_NODES", 1000))
+GRAPH_MAX_EDGES = int(os.environ.get("GRAPH_MAX_EDGES", 5000))
 
-def get_db_data_for_triplets(pg_conn_cfg, input_ner: str, date_min: str, date_max: str):
+# clean input ner (prevent from sql injection)
+RE_CLEAN_INPUT_NER = re.compile(r"[^a-zA-Zа-яА-ЯёЁ№0-9 ]+")
+
+
+# pool of db connections (one per waitress thread)
+WAITRESS_THREADS = int(os.environ.get("WAITRESS_THREADS", 4))
+PG_POOL = PgPool(
+    PG_CONN_CFG,
+    maxconn=WAITRESS_THREADS,
+    statement_timeout=int(os.environ.get("PG_STATEMENT_TIMEOUT", 30000)),
+)
+
+
+def get_data_version(pg_pool):
+    """Get current data version (bumped by ner-pipeline after commit).
+
+    Returns:
+        int or None: data version or None if db is unavailable
+    """
+    try:
+        with pg_pool.cursor() as pg_cur:
+            pg_pool.execute(pg_cur, "data_version")
+            data_version = pg_cur.fetchone()[0]
+
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+        data_version = None
+
+    return data_version
+
+
+GRAPH_CACHE = GraphCache(
+    maxsize=int(os.environ.get("GRAPH_CACHE_MAXSIZE", 128)),
+    ttl=float(os.environ.get("GRAPH_CACHE_TTL", 3600)),
+    version_getter=lambda: get_data_version(PG_POOL),
+    version_check_interval=float(os.environ.get("GRAPH_CACHE_VERSION_CHECK", 30)),
+)
+
+NER_LOOKUP = NerLookup(
+    PG_CONN_CFG,
+    refresh_interval=float(os.environ.get("NER_LOOKUP_REFRESH", 300)),
+    full_refresh_interval=float(os.environ.get("NER_LOOKUP_FULL_REFRESH", 3600)),
+)
+
+GRAPH_STORE = RollingGraphStore(
+    PG_CONN_CFG, window_days=int(os.environ.get("GRAPH_STORE_DAYS", 90))
+)
+
+
+def get_db_data_for_triplets(pg_pool, input_ner: str, date_min: str, date_max: str):
 
     # clean input ner (prevent from sql injection)
-    input_ner = re.sub(r"[^a-zA-Zа-яА-ЯёЁ№0-9 ]+", "", input_ner)
+    input_ner = RE_CLEAN_INPUT_NER.sub("", input_ner)
 
     # check query dates to sql injection
     date_pattern = r"\d\d\d\d-\d\d-\d\d"
     if re.fullmatch(date_pattern, date_min) and re.fullmatch(date_pattern, date_max):
         try:
-            pg_con = psycopg2.connect(
-                dbname=pg_conn_cfg["dbname"],
-                user=pg_conn_cfg["user"],
-                password=pg_conn_cfg["password"],
-                host=pg_conn_cfg["host"],
-                port=pg_conn_cfg["port"],
-            )
-
-            # fuzzy search by input ner
+            # fuzzy search by input ner (trigram index over ner_synonyms)
             if len(input_ner) > 0:
-                query = """
-                SELECT CASE WHEN %(input_ner)s IN (SELECT ner_synonym
-                                                   FROM ner_synonyms)
-                    THEN
-                    (SELECT ner_name
-                        FROM ner
-                        WHERE id_ner = (SELECT id_ner
-                                        FROM ner_synonyms
-                                        WHERE %(input_ner)s = ner_synonym
-                                        LIMIT 1))
-                        ELSE
-                        (SELECT ner_name
-                        FROM ner
-                        WHERE id_ner =
-                            (SELECT id_ner
-                             FROM ner_synonyms
-                             ORDER BY SIMILARITY(ner_synonym, %(input_ner)s) DESC,
-                                   ABS(LENGTH(ner_synonym) - LENGTH(%(input_ner)s)) ASC
-                             LIMIT 1))
-                        END;
-                """
-                pg_cur = pg_con.cursor()
-                pg_cur.execute(query, {"input_ner": input_ner})
-                res = pg_cur.fetchall()
-                pg_cur.close()
-                if len(res) > 0:
-                    founded_ner = res[0][0]
-                else:
-                    founded_ner = None
+                founded_ner = NER_LOOKUP.resolve(input_ner)
             else:
                 founded_ner = ""
 
-            if founded_ner is not None:
+            if founded_ner is not None and GRAPH_STORE.covers(date_min, date_max):
+                # date range is inside window of in-memory store
+                df_news, df_nlinks, df_ners = GRAPH_STORE.get_data(date_min, date_max)
+
+            elif founded_ner is not None:
                 # query to db for get news sample in date range
-                query = f"""
-                    SELECT id_news, summary_text, news_date
-                    FROM (SELECT * FROM news
-                        WHERE news_date
-                                BETWEEN '{date_min}' AND
-                                        '{date_max}') news
-                        INNER JOIN news_summary USING(id_news)
-                """
-                df_news = pd.read_sql(query, pg_con, index_col=["id_news"])
-
-                query = f"""
-                    SELECT id_news, ner_name, ner_type
-                    FROM (SELECT * FROM news_links
-                          WHERE id_news IN (SELECT id_news FROM news
-                                            WHERE news_date
-                                            BETWEEN '{date_min}' AND
-                                            '{date_max}')) news_links
-                         INNER JOIN ner USING(id_ner)
-                         LEFT JOIN ner_types USING(id_ner_type)
-                """
-                df_nlinks = pd.read_sql(query, pg_con)
+                with pg_pool.cursor() as pg_cur:
+                    df_news = pg_pool.read_df(
+                        pg_cur, "news_in_range", (date_min, date_max), "id_news"
+                    )
+                    df_nlinks = pg_pool.read_df(
+                        pg_cur, "nlinks_in_range", (date_min, date_max)
+                    )
+                    df_ners = pg_pool.read_df(
+                        pg_cur, "ners_in_range", (date_min, date_max), "id_ner"
+                    )
 
+            if founded_ner is not None:
                 # check if the ner is not mentioned in the news for the given date range
-                if founded_ner != "" and founded_ner not in df_nlinks.ner_name.values:
+                if founded_ner != "" and founded_ner not in df_ners.ner_name.values:
                     founded_ner = None
 
             else:
                 # ner not found
                 df_news = None
                 df_nlinks = None
+                df_ners = None
 
         except (Exception, Error) as error:
             print("Error connection to PostgreSQL:\n", error)
             founded_ner = None
             df_news = None
             df_nlinks = None
-
-        finally:
-            if "pg_con" in locals() and pg_con:
-                pg_con.close()
+            df_ners = None
     else:
         founded_ner = None
         df_news = None
         df_nlinks = None
+        df_ners = None
         print(f"Dates is incorrect {date_min} - {date_max}")
 
     return (
         founded_ner,
         df_news,
         df_nlinks,
+        df_ners,
     )
 
 
 def compute_triplets(
-    PG_CONN_CFG,
+    pg_pool,
     input_ner,
     date_min: str,
     date_max: str,
     graph_depth=None,
     min_news_count=1,
+    max_nodes=GRAPH_MAX_NODES,
+    max_edges=GRAPH_MAX_EDGES,
 ):
     # query to db and fuzzy search by synonyms table
-    founded_ner, df_news, df_nlinks = get_db_data_for_triplets(
-        PG_CONN_CFG, input_ner, date_min, date_max
+    founded_ner, df_news, df_nlinks, df_ners = get_db_data_for_triplets(
+        pg_pool, input_ner, date_min, date_max
     )
 
     if founded_ner is None or df_news is None or df_nlinks is None:
-        return pd.DataFrame(
+        df_bad_query = pd.DataFrame(
             {
                 "source": ["bad-PER#PER", "bad-LOC#LOC", "bad-ORG#ORG"],
                 "target": ["bad-ORG#ORG", "bad-MISC#MISC", "bad-LOC#LOC"],
                 "amount": [0, 0, 0],
-                "news": [
-                    ["nonews00", "nonews01", "nonews02"],
-                    ["nonews2"],
-                    ["nonews3"],
-                ],
+                "news_ids": [[0, 1, 2], [3], [4]],
             }
         )
+        df_bad_query.attrs["bad_query"] = True
+        news_texts = pd.Series(
+            ["nonews00", "nonews01", "nonews02", "nonews2", "nonews3"]
+        )
+        return df_bad_query, news_texts
 
-    df_nlinks_counts = df_nlinks.groupby(by="id_news").ner_name.count()
-
-    # удаляем новости с > 5 нер, пока не решится вопрос с комплексными
-    # сводками новостей (часто с ключевым словом "главное:"), где могут
-    # в виде списка приводится не связанные между собой новости,
-    # в настоящий момент все ner, упоминаемые в любой части тако сводки,
-    # окажутся связанными между собой, что не является верным; имеет смысл
-    # дробить такие новости на несколько, либо использовать схожий подход,
-    # когда ner будут связаны между обой только в пределах перечислений
-    id_news_to_drop = df_nlinks_counts[
-        ((df_nlinks_counts < 2) | (df_nlinks_counts > 5))
-    ].index
-    df_nlinks = df_nlinks[~df_nlinks.id_news.isin(id_news_to_drop)]
-
-    if input_ner != "":
-
-        lvl_ners = [
-            [founded_ner],
-        ]  # functionality for future
-        lvl_idx = []  # functionality for future
-        prev_lvls_idx = []
-
-        for _ in range(graph_depth):
-
-            lvl_idx.append(
-                list(
-                    set(
-                        df_nlinks[
-                            (
-                                df_nlinks.ner_name.isin(lvl_ners[-1])
-                                & (~df_nlinks.id_news.isin(prev_lvls_idx))
-                            )
-                        ].id_news
-                    )
-                )
-            )
+    df_triples, news_texts = links_to_triplets(
+        df_news,
+        df_nlinks,
+        df_ners,
+        founded_ner,
+        graph_depth,
+        min_news_count,
+        max_nodes,
+        max_edges,
+    )
 
-            lvl_ners.append(
-                list(
-                    set(df_nlinks[df_nlinks.id_news.isin(lvl_idx[-1])].ner_name)
-                    - set(lvl_ners[-1])
-                )
-            )
+    return df_triples, news_texts
 
-            prev_lvls_idx.extend(lvl_idx[-1])
 
-        # print(list(map(len, lvl_idx)))
-        # print(list(map(len, lvl_ners)))
+def normalize_graph_query(graph_query):
+    """Get cache key for graph query (queries with the same key give
+    the same graph)."""
+    input_ner = RE_CLEAN_INPUT_NER.sub("", graph_query["input_ner"] or "")
+    return (
+        input_ner,
+        graph_query["date_min"],
+        graph_query["date_max"],
+        graph_query["graph_depth"] if input_ner != "" else 0,
+        max(graph_query["min_news_count"], 1),
+    )
 
-        df_nlinks = df_nlinks[df_nlinks.id_news.isin(prev_lvls_idx)]
 
-    re_clean_name = re.compile(r"[^a-zA-Zа-яА-Я0-9 \-+№%]+")
-    df_nlinks["ner_name"] = (
-        df_nlinks.ner_name.map(lambda x: re_clean_name.sub("", x))
-        + "#"
-        + df_nlinks.ner_type
+def build_network(
+    graph_query,
+    graph_format="node_link",
+    content_type=CONTENT_TYPE_JSON,
+    encoding="identity",
+):
+    """Build graph for query (or get it from GRAPH_CACHE).
+
+    Args:
+        graph_query (dict): query params (args of compute_triplets)
+        graph_format (str): one of GRAPH_FORMATS (see wire_format module)
+        content_type (str): CONTENT_TYPE_JSON or CONTENT_TYPE_MSGPACK
+        encoding (str): content encoding of payload (br, gzip or identity)
+
+    Returns:
+        bytes: serialized (and compressed) graph
+    """
+    cache_key = (
+        normalize_graph_query(graph_query),
+        graph_format,
+        content_type,
+        encoding,
     )
-    df_nlinks.drop(columns="ner_type", inplace=True)
+    payload = GRAPH_CACHE.get(cache_key)
+    if payload is not None:
+        return payload
 
-    df_nlinks = df_nlinks.groupby("id_news").agg({"ner_name": sorted})
+    df_triples, news_texts = compute_triplets(PG_POOL, **graph_query)
 
-    df_nlinks = df_nlinks.merge(df_news, how="left", left_index=True, right_index=True)
-    del df_news
+    data = graph_to_format(df_triples, news_texts, graph_format)
+    payload = compress(serialize(data, content_type), encoding)
 
-    df_nlinks["ner_name"] = df_nlinks.ner_name.map(lambda x: list(combinations(x, 2)))
+    # don't cache stub graph for bad query or db error
+    if not df_triples.attrs.get("bad_query", False):
+        GRAPH_CACHE.set(cache_key, payload)
 
-    df_nlinks["news"] = (
-        df_nlinks.news_date.dt.strftime("%Y-%m-%d %H:%M: ") + df_nlinks.summary_text
-    )
-    df_nlinks = df_nlinks[["ner_name", "news"]]
-
-    df_triples = df_nlinks.explode("ner_name")
-    del df_nlinks
+    return payload
 
-    df_triples = df_triples.groupby("ner_name", as_index=False).agg(
-        news=("news", sorted), amount=("news", len)
-    )
 
-    # drop edges with news amount < min_news_count
-    if min_news_count > 1:
-        df_triples = df_triples[df_triples.amount >= min_news_count]
+def render_snapshot(graph_query):
+    """Render graph of standard query to node-link json for SNAPSHOTS
+    (without GRAPH_CACHE, as data has just been updated).
 
-    df_triples[["source", "target"]] = pd.DataFrame(
-        df_triples["ner_name"].tolist(), index=df_triples.index
-    )
+    Returns:
+        bytes: serialized graph or None for bad query or db error
+    """
+    df_triples, news_texts = compute_triplets(PG_POOL, **graph_query)
+    if df_triples.attrs.get("bad_query", False):
+        return None
+    data = graph_to_format(df_triples, news_texts, "node_link")
+    return serialize(data, CONTENT_TYPE_JSON)
 
-    df_triples = df_triples[["source", "target", "amount", "news"]]
 
-    return df_triples
+# snapshots of standard queries, served by nginx (SNAPSHOT_DIR is shared
+# with nginx, not set - snapshots are disabled)
+SNAPSHOTS = SnapshotBuilder(
+    PG_CONN_CFG,
+    os.environ.get("SNAPSHOT_DIR"),
+    render_snapshot,
+    normalize_graph_query,
+    url_prefix=os.environ.get("SNAPSHOT_URL", "/snapshots/"),
+)
 
 
-def build_network(graph_query):
+def get_news_texts(pg_pool, id_news):
+    """Get texts "date: summary" of news by ids (for lazy loading of news).
 
-    df_triples = compute_triplets(PG_CONN_CFG, **graph_query)
+    Returns:
+        dict: {id_news: text}
+    """
+    try:
+        with pg_pool.cursor() as pg_cur:
+            pg_pool.execute(pg_cur, "news_texts", (list(id_news),))
+            news_texts = dict(pg_cur.fetchall())
 
-    G = nx.from_pandas_edgelist(
-        df_triples,
-        source="source",
-        target="target",
-        edge_attr=["amount", "news"],
-        create_using=nx.Graph(),
-    )
-    data = nx.node_link_data(G)
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+        news_texts = {}
 
-    return data
+    return news_texts
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -291,14 +320,164 @@ def index_func():
 
     print(f"Info: Graph query: {graph_query}")
 
-    return render_template("index.html")
+    # graph of standard query is loaded by the page directly from nginx
+    data_url = SNAPSHOTS.get_url(graph_query) or "/data"
+
+    return render_template("index.html", data_url=data_url)
 
 
 @app.route("/data")
 def static_proxy():
-    network = build_network(session.get("graph_query"))
+    graph_format = request.args.get("format", "node_link")
+    if graph_format not in GRAPH_FORMATS:
+        return jsonify({"error": f"format must be one of {GRAPH_FORMATS}"}), 400
+    content_type = negotiate_content_type(request.headers.get("Accept"))
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+
+    snapshot_url = SNAPSHOTS.get_url(session.get("graph_query"))
+    if (
+        snapshot_url is not None
+        and graph_format == "node_link"
+        and content_type == CONTENT_TYPE_JSON
+        and not profiling_enabled()
+    ):
+        return redirect(snapshot_url)
+
+    if profiling_enabled():
+        # profile of each request is saved separately (PROFILE_DIR env)
+        profile_id = "{}_{}".format(
+            datetime.now().strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8]
+        )
+        with profile_stage("app", "data", run_id=profile_id) as profiled:
+            payload = build_network(
+                session.get("graph_query"), graph_format, content_type, encoding
+            )
+        if not profiled:
+            # another request is being profiled, artifacts are not written
+            profile_id = None
+    else:
+        profile_id = None
+        payload = build_network(
+            session.get("graph_query"), graph_format, content_type, encoding
+        )
+
+    response = app.response_class(payload, mimetype=content_type)
+    if profile_id is not None:
+        response.headers["X-Profile-Id"] = profile_id
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept, Accept-Encoding"
+    return response
+
+
+@app.route("/news")
+def news_func():
+    # ids of news separated by comma, e.g. /news?ids=1,2,3
+    id_news = [int(i) for i in request.args.get("ids", "").split(",") if i.isdigit()]
+    if len(id_news) == 0 or len(id_news) > 1000:
+        return jsonify({"error": "from 1 to 1000 ids are required"}), 400
+
+    news_texts = get_news_texts(PG_POOL, id_news)
+    return jsonify({str(i): text for i, text in news_texts.items()})
+
+
+@app.route("/ner_autocomplete")
+def ner_autocomplete_func():
+    text = RE_CLEAN_INPUT_NER.sub("", request.args.get("q", ""))
+    k = min(request.args.get("k", 10, type=int), 50)
+    if len(text) == 0:
+        return jsonify([])
+
+    return jsonify(NER_LOOKUP.search(text, k))
+
+
+@app.route("/top_ners")
+def top_ners_func():
+    # e.g. /top_ners?window=7&k=20&by=pagerank (metrics are precomputed by
+    # graph_metrics_pipeline for windows of 1, 7 and 30 days)
+    window_days = request.args.get("window", 7, type=int)
+    k = min(request.args.get("k", 20, type=int), 100)
+    metric = request.args.get("by", "pagerank")
+    if metric not in ("pagerank", "weighted_degree"):
+        return jsonify({"error": "by must be pagerank or weighted_degree"}), 400
+
+    try:
+        with PG_POOL.cursor() as pg_cur:
+            df_top = PG_POOL.read_df(pg_cur, f"top_ners_{metric}", (window_days, k))
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+        return jsonify({"error": "db is unavailable"}), 503
+
+    return jsonify(df_top.to_dict(orient="records"))
+
+
+@app.route("/ner_timeseries")
+def ner_timeseries_func():
+    # daily mentions of ners (from rollup table ner_daily_mentions), e.g.
+    # /ner_timeseries?ners=Россия,Путин&date_min=2022-10-01&date_max=2022-10-31
+    # by_source=1 - separate series for each news source
+    date_pattern = r"\d\d\d\d-\d\d-\d\d"
+    date_max = request.args.get("date_max", datetime.now().strftime("%Y-%m-%d"))
+    date_min = request.args.get(
+        "date_min", (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+    )
+    if not (
+        re.fullmatch(date_pattern, date_min) and re.fullmatch(date_pattern, date_max)
+    ):
+        return jsonify({"error": "dates must be in format YYYY-MM-DD"}), 400
+    by_source = request.args.get("by_source", 0, type=int) == 1
+
+    # ners by fuzzy search (as input ner of graph)
+    ners = {}
+    for text in request.args.get("ners", "").split(",")[:20]:
+        result = NER_LOOKUP.search(RE_CLEAN_INPUT_NER.sub("", text), k=1)
+        if len(result) > 0:
+            ners[result[0]["id_ner"]] = result[0]
+    if len(ners) == 0:
+        return jsonify({"error": "ners are not found"}), 404
+
+    try:
+        with PG_POOL.cursor() as pg_cur:
+            df_mentions = PG_POOL.read_df(
+                pg_cur, "ner_daily_mentions", (list(ners), date_min, date_max)
+            )
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+        return jsonify({"error": "db is unavailable"}), 503
+
+    # dense series over all days of range
+    days = pd.date_range(date_min, date_max, freq="D").date
+    keys = ["id_ner", "news_source"] if by_source else ["id_ner"]
+    df_mentions = (
+        df_mentions.groupby(keys + ["day"])
+        .mentions.sum()
+        .unstack("day")
+        .reindex(columns=days, fill_value=0)
+        .fillna(0)
+        .astype(int)
+    )
+    if not by_source:
+        # zero series for ners without mentions
+        df_mentions = df_mentions.reindex(list(ners), fill_value=0)
+    series = []
+    for key, mentions in df_mentions.iterrows():
+        key = key if isinstance(key, tuple) else (key,)
+        item = {
+            "id_ner": int(key[0]),
+            "ner_name": ners[key[0]]["ner_name"],
+            "ner_type": ners[key[0]]["ner_type"],
+            "mentions": mentions.tolist(),
+        }
+        if by_source:
+            item["news_source"] = key[1]
+        series.append(item)
+
+    return jsonify({"days": [str(day) for day in days], "series": series})
 
-    return jsonify(network)
+
+@app.route("/cache_stats")
+def cache_stats_func():
+    return jsonify(GRAPH_CACHE.stats())
 
 
 @app.route("/about", methods=["GET", "POST"])
@@ -313,11 +492,20 @@ def faq_func():
 
 
 def main(production=True):
+    # load in-memory store of last news (in background, until it is loaded
+    # all queries go to db), GRAPH_STORE_DAYS=0 - don't use store
+    if GRAPH_STORE.window_days > 0:
+        GRAPH_STORE.start()
+
+    # build snapshots of standard queries (rebuilt after updates of data)
+    if SNAPSHOTS.snapshot_dir is not None:
+        SNAPSHOTS.start()
+
     if production:
         # for production
         # https://flask.palletsprojects.com/en/2.2.x/deploying/
         app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
-        serve(app, host="0.0.0.0", port=5000)
+        serve(app, host="0.0.0.0", port=5000, threads=WAITRESS_THREADS)
     else:
         # for debugging, not production
         app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,212 @@
+"""Module for data access of the app: pool of postgres connections (sized
+to the amount of waitress threads) with prepared statements and
+statement_timeout for each request.
+
+Queries of the app are registered in QUERIES and prepared (PREPARE) once per
+connection of the pool, so postgres can reuse plans of these queries.
+"""
+import threading
+from contextlib import contextmanager
+import pandas as pd
+from psycopg2 import pool, errors
+from psycopg2.extensions import connection
+
+# prepared queries of the app {name: (sql with $n params, amount of params)},
+# date range is applied to news_date of each table (news_links and
+# news_summary have news_date of the news), so only partitions of the range
+# are scanned (see partition_news.py)
+QUERIES = {
+    "news_in_range": (
+        """
+        SELECT id_news, summary_text, news_date
+        FROM (SELECT * FROM news WHERE news_date BETWEEN $1 AND $2) news
+            INNER JOIN (SELECT * FROM news_summary
+                        WHERE news_date BETWEEN $1 AND $2) news_summary
+            USING(id_news, news_date)
+        """,
+        2,
+    ),
+    "nlinks_in_range": (
+        """
+        SELECT id_news, id_ner
+        FROM news_links
+        WHERE id_ner IS NOT Null AND news_date BETWEEN $1 AND $2
+        """,
+        2,
+    ),
+    "ners_in_range": (
+        """
+        SELECT id_ner, ner_name, ner_type
+        FROM (SELECT * FROM ner
+              WHERE id_ner IN (SELECT DISTINCT id_ner
+                               FROM news_links
+                               WHERE news_date BETWEEN $1 AND $2)) ner
+             LEFT JOIN ner_types USING(id_ner_type)
+        """,
+        2,
+    ),
+    "news_texts": (
+        """
+        SELECT id_news,
+               TO_CHAR(news_date, 'YYYY-MM-DD HH24:MI: ') || summary_text
+        FROM news INNER JOIN news_summary USING(id_news, news_date)
+        WHERE id_news = ANY($1::integer[])
+        """,
+        1,
+    ),
+    "data_version": ("SELECT MAX(version) FROM data_version", 0),
+    "ner_daily_mentions": (
+        """
+        SELECT id_ner, day, news_source, mentions
+        FROM ner_daily_mentions
+        WHERE id_ner = ANY($1::integer[]) AND day BETWEEN $2 AND $3
+        """,
+        3,
+    ),
+}
+# top ners by metrics of graph_metrics_pipeline
+for metric in ("pagerank", "weighted_degree"):
+    QUERIES[f"top_ners_{metric}"] = (
+        f"""
+        SELECT id_ner, ner_name, ner_type, news_count, weighted_degree,
+               pagerank, community
+        FROM (SELECT * FROM ner_metrics
+              WHERE window_days = $1
+              ORDER BY {metric} DESC
+              LIMIT $2) ner_metrics
+            INNER JOIN ner USING(id_ner)
+            LEFT JOIN ner_types USING(id_ner_type)
+        ORDER BY {metric} DESC
+        """,
+        2,
+    )
+
+
+class PreparedConnection(connection):
+    """Connection with names of prepared queries (state of the session lives
+    and dies with the connection)."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.statement_timeout = None  # of the current transaction
+
+
+class PgPool:
+    """Thread-safe pool of connections to postgres for the app."""
+
+    def __init__(self, pg_conn_cfg, maxconn=4, statement_timeout=30000) -> None:
+        """
+        Args:
+            pg_conn_cfg: dict with cfg connect to database
+            maxconn (int): max amount of connections (amount of threads, that
+                           can query db at the same time, others wait)
+            statement_timeout (int): max time of query (in milliseconds)
+        """
+        self.pg_conn_cfg = pg_conn_cfg
+        self.maxconn = maxconn
+        self.statement_timeout = statement_timeout
+
+        self._pool = None  # created on first use (db can be not ready at start)
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool raises error if there is no free connection,
+        # so threads wait for free connection on semaphore
+        self._semaphore = threading.BoundedSemaphore(maxconn)
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # minconn = maxconn: putconn doesn't close connections above
+                # minconn, so prepared queries are kept
+                self._pool = pool.ThreadedConnectionPool(
+                    self.maxconn,
+                    self.maxconn,
+                    connection_factory=PreparedConnection,
+                    dbname=self.pg_conn_cfg["dbname"],
+                    user=self.pg_conn_cfg["user"],
+                    password=self.pg_conn_cfg["password"],
+                    host=self.pg_conn_cfg["host"],
+                    port=self.pg_conn_cfg["port"],
+                )
+            return self._pool
+
+    @contextmanager
+    def cursor(self, statement_timeout=None):
+        """Get cursor of pooled connection (in read-only transaction, which is
+        rolled back at exit).
+
+        Args:
+            statement_timeout (int): max time of each query (in milliseconds),
+                                     None - self.statement_timeout
+        """
+        if statement_timeout is None:
+            statement_timeout = self.statement_timeout
+
+        with self._semaphore:
+            pg_pool = self._get_pool()
+            pg_con = pg_pool.getconn()
+            try:
+                pg_con.statement_timeout = int(statement_timeout)
+                pg_cur = pg_con.cursor()
+                self._begin(pg_cur)
+                yield pg_cur
+                pg_cur.close()
+            finally:
+                if not pg_con.closed:
+                    pg_con.rollback()
+                # broken connection (e.g. db restart) is closed
+                pg_pool.putconn(pg_con, close=bool(pg_con.closed))
+
+    @staticmethod
+    def _begin(pg_cur):
+        pg_cur.execute("SET TRANSACTION READ ONLY;")
+        pg_cur.execute(
+            "SET LOCAL statement_timeout = %s;", (pg_cur.connection.statement_timeout,)
+        )
+
+    def execute(self, pg_cur, name, params=()):
+        """Execute prepared query from QUERIES (prepare it on the connection
+        of the cursor at first call).
+
+        Args:
+            pg_cur: cursor from self.cursor()
+            name (str): name of query in QUERIES
+            params (tuple): params of query
+        """
+        query, n_params = QUERIES[name]
+        prepared = pg_cur.connection.prepared
+        if name not in prepared:
+            pg_cur.execute(f"PREPARE {name} AS {query};")
+            prepared.add(name)
+
+        if n_params > 0:
+            execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * n_params)});"
+        else:
+            execute_sql = f"EXECUTE {name};"
+        try:
+            pg_cur.execute(execute_sql, tuple(params))
+        except errors.InvalidSqlStatementName:
+            # prepared queries are lost by the session (e.g. DISCARD ALL of
+            # connection pooler), prepare again in new transaction and retry
+            pg_cur.connection.rollback()
+            prepared.clear()
+            self._begin(pg_cur)
+            pg_cur.execute(f"PREPARE {name} AS {query};")
+            prepared.add(name)
+            pg_cur.execute(execute_sql, tuple(params))
+
+    def read_df(self, pg_cur, name, params=(), index_col=None):
+        """Execute prepared query and get result as pd.DataFrame."""
+        self.execute(pg_cur, name, params)
+        df = pd.DataFrame.from_records(
+            pg_cur.fetchall(), columns=[col.name for col in pg_cur.description]
+        )
+        if index_col is not None:
+            df = df.set_index(index_col)
+        return df
+
+    def closeall(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
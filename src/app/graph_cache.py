@@ -0,0 +1,113 @@
+"""Module for caching of computed graphs in the app process.
+
+Cache is keyed by the normalized graph query and holds the serialized
+node-link json. Entries are evicted by size (LRU) and by TTL. In addition,
+the whole cache is invalidated when the data version (table data_version,
+bumped by the ner-pipeline after commit) has changed.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class GraphCache:
+    """Thread-safe LRU cache with TTL and data version invalidation."""
+
+    def __init__(
+        self, maxsize=128, ttl=3600, version_getter=None, version_check_interval=60
+    ) -> None:
+        """
+        Args:
+            maxsize (int): max amount of entries in cache
+            ttl (float): time to live of entry (in seconds)
+            version_getter: function without args, return current data version
+                            (None - cache is invalidated only by ttl)
+            version_check_interval (float): min interval (in seconds) between
+                            calls of version_getter
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version_getter = version_getter
+        self.version_check_interval = version_check_interval
+
+        self._data = OrderedDict()  # {key: (expire_time, value), ...}
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._version_checked = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _check_data_version(self):
+        """Clear cache if data version has changed (checked not more often
+        than once per version_check_interval)."""
+        now = time.monotonic()
+        if (
+            self.version_getter is None
+            or now - self._version_checked < self.version_check_interval
+        ):
+            return
+
+        self._version_checked = now
+        data_version = self.version_getter()
+
+        # None - version is unknown (e.g. db is unavailable), keep cache
+        if data_version is None:
+            return
+
+        with self._lock:
+            if data_version != self._data_version:
+                if self._data_version is not None and len(self._data) > 0:
+                    self._data.clear()
+                    self.invalidations += 1
+                self._data_version = data_version
+
+    def get(self, key):
+        """Return cached value or None if key not in cache (or expired)."""
+        self._check_data_version()
+
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                item = None
+
+            if item is None:
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        """Put value to cache, evict least recently used entries if needed."""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Return dict with cache counters."""
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "data_version": self._data_version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
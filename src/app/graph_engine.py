@@ -0,0 +1,359 @@
+"""Module for graph computations over news <-> ners links with integer codes
+(used by compute_triplets in the app).
+"""
+import re
+import time
+import numpy as np
+import pandas as pd
+
+# clean ner name for display name of graph node
+RE_CLEAN_NODE_NAME = re.compile(r"[^a-zA-Zа-яА-Я0-9 \-+№%]+")
+
+
+def build_csr(row_codes, col_codes, n_rows):
+    """Build CSR adjacency (rows -> cols) from pairs of integer codes.
+
+    Args:
+        row_codes (np.ndarray): row code for each pair (0 <= code < n_rows)
+        col_codes (np.ndarray): col code for each pair
+        n_rows (int): amount of rows
+
+    Returns:
+        tuple(indptr, indices): cols of row i are indices[indptr[i]:indptr[i + 1]]
+    """
+    order = np.argsort(row_codes, kind="stable")
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_codes, minlength=n_rows), out=indptr[1:])
+    return indptr, col_codes[order]
+
+
+def gather_csr(indptr, indices, rows):
+    """Get concatenated cols for rows of CSR adjacency (without python loop)."""
+    starts = indptr[rows]
+    lens = indptr[rows + 1] - starts
+    total = lens.sum()
+    if total == 0:
+        return indices[:0]
+    # position in indices for each output element:
+    # start of its row + offset inside the row
+    offsets = np.repeat(starts - (np.cumsum(lens) - lens), lens)
+    return indices[offsets + np.arange(total)]
+
+
+class NewsNerIndex:
+    """Inverted index news <-> ners (CSR adjacency in both directions over
+    integer codes), built once per query from links table.
+    """
+
+    def __init__(self, id_news, ner_keys) -> None:
+        """
+        Args:
+            id_news: id_news for each link
+            ner_keys: ner key (e.g. ner_name or id_ner) for each link
+        """
+        self.news_codes, self.news_uniques = pd.factorize(np.asarray(id_news))
+        self.ner_codes, ner_uniques = pd.factorize(np.asarray(ner_keys))
+        self.ner_uniques = pd.Index(ner_uniques)
+        self.n_news = len(self.news_uniques)
+        self.n_ners = len(self.ner_uniques)
+
+        self.news2ner = build_csr(self.news_codes, self.ner_codes, self.n_news)
+        self.ner2news = build_csr(self.ner_codes, self.news_codes, self.n_ners)
+
+    def expand(self, seed_ners, graph_depth):
+        """BFS from seed ners over news: at each level we take news (not visited
+        before) with ners of current level, next level is new ners from these
+        news. Only frontier is touched at each level.
+
+        Args:
+            seed_ners: list of ner keys (level 0)
+            graph_depth (int): amount of levels
+
+        Returns:
+            np.ndarray: bool mask of visited news (by news code)
+        """
+        visited_news = np.zeros(self.n_news, dtype=bool)
+        visited_ners = np.zeros(self.n_ners, dtype=bool)
+
+        frontier = self.ner_uniques.get_indexer(seed_ners)
+        frontier = frontier[frontier >= 0]
+        visited_ners[frontier] = True
+
+        for _ in range(graph_depth):
+            news = np.unique(gather_csr(*self.ner2news, frontier))
+            news = news[~visited_news[news]]
+            if len(news) == 0:
+                break
+            visited_news[news] = True
+
+            ners = np.unique(gather_csr(*self.news2ner, news))
+            frontier = ners[~visited_ners[ners]]
+            visited_ners[frontier] = True
+
+        return visited_news
+
+    def links_mask(self, news_mask):
+        """Get bool mask of links (in order of init arrays) for mask of news."""
+        return news_mask[self.news_codes]
+
+
+def aggregate_edges(news_codes, node_codes, n_nodes, min_news_count=1):
+    """Count co-occurrence of nodes in news (edges of graph) over integer codes.
+    For each news all pairs of its (unique) nodes are generated by vectorized
+    ops (grouped by amount of nodes in news).
+
+    Args:
+        news_codes (np.ndarray): news code for each link
+        node_codes (np.ndarray): node code for each link (0 <= code < n_nodes)
+        n_nodes (int): amount of nodes
+        min_news_count (int): drop edges with amount of news < min_news_count
+
+    Returns:
+        tuple(source, target, amount, indptr, news): edges (source < target by
+            code) sorted by (source, target) with amount of news, news codes
+            of edge i are news[indptr[i]:indptr[i + 1]]
+    """
+    news_codes = np.asarray(news_codes, dtype=np.int64)
+    node_codes = np.asarray(node_codes, dtype=np.int64)
+
+    # unique links sorted by news, then by node
+    links = np.unique(news_codes * n_nodes + node_codes)
+    news, nodes = np.divmod(links, n_nodes)
+
+    starts = np.flatnonzero(np.r_[True, news[1:] != news[:-1]])
+    sizes = np.diff(np.r_[starts, len(news)])
+
+    pairs_src, pairs_dst, pairs_news = [], [], []
+    for size in np.unique(sizes[sizes > 1]):
+        size_starts = starts[sizes == size][:, None]
+        idx_src, idx_dst = np.triu_indices(size, 1)
+        pairs_src.append(nodes[size_starts + idx_src].ravel())
+        pairs_dst.append(nodes[size_starts + idx_dst].ravel())
+        pairs_news.append(np.repeat(news[size_starts.ravel()], len(idx_src)))
+
+    if len(pairs_src) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, np.zeros(1, dtype=np.int64), empty
+
+    pairs = np.concatenate(pairs_src) * n_nodes + np.concatenate(pairs_dst)
+    pairs_news = np.concatenate(pairs_news)
+
+    order = np.lexsort((pairs_news, pairs))
+    pairs, pairs_news = pairs[order], pairs_news[order]
+    edges, amount = np.unique(pairs, return_counts=True)
+
+    keep = amount >= min_news_count
+    news = pairs_news[np.repeat(keep, amount)]
+    edges, amount = edges[keep], amount[keep]
+    indptr = np.r_[0, np.cumsum(amount)]
+
+    source, target = np.divmod(edges, n_nodes)
+    return source, target, amount, indptr, news
+
+
+def top_k_mask(weights, k):
+    """Get bool mask of k largest weights (top-k selection by argpartition,
+    without full sort)."""
+    mask = np.zeros(len(weights), dtype=bool)
+    if k >= len(weights):
+        mask[:] = True
+    elif k > 0:
+        mask[np.argpartition(-weights, k - 1)[:k]] = True
+    return mask
+
+
+def prune_edges(source, target, amount, n_nodes, max_nodes=0, max_edges=0):
+    """Limit size of graph: keep max_nodes nodes with the largest weighted
+    degree (sum of amount of its edges), then keep max_edges edges (between
+    kept nodes) with the largest amount.
+
+    Args:
+        source (np.ndarray): node code of source for each edge
+        target (np.ndarray): node code of target for each edge
+        amount (np.ndarray): weight (amount of news) for each edge
+        n_nodes (int): amount of nodes (0 <= code < n_nodes)
+        max_nodes (int): max amount of nodes (0 - no limit)
+        max_edges (int): max amount of edges (0 - no limit)
+
+    Returns:
+        tuple(keep, pruning): bool mask of kept edges and dict with sizes of
+            graph before and after pruning
+    """
+    keep = np.ones(len(amount), dtype=bool)
+    nodes_mask = np.zeros(n_nodes, dtype=bool)
+    nodes_mask[source] = True
+    nodes_mask[target] = True
+    n_nodes_total = int(nodes_mask.sum())
+
+    if 0 < max_nodes < n_nodes_total:
+        degree = np.bincount(source, amount, n_nodes) + np.bincount(
+            target, amount, n_nodes
+        )
+        nodes_mask = top_k_mask(degree, max_nodes)
+        keep &= nodes_mask[source] & nodes_mask[target]
+
+    if 0 < max_edges < keep.sum():
+        keep_pos = np.flatnonzero(keep)
+        keep[:] = False
+        keep[keep_pos[top_k_mask(amount[keep_pos], max_edges)]] = True
+
+    n_nodes_kept = len(np.union1d(source[keep], target[keep]))
+    pruning = {
+        "nodes_total": n_nodes_total,
+        "edges_total": len(amount),
+        "nodes_kept": n_nodes_kept,
+        "edges_kept": int(keep.sum()),
+        "pruned": bool(n_nodes_kept < n_nodes_total or not keep.all()),
+    }
+    return keep, pruning
+
+
+def lap_time(timings, stage, start):
+    """Add time since start to timings[stage] (if timings is not None).
+
+    Returns:
+        float: current time (start of the next stage)
+    """
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + now - start
+    return now
+
+
+def links_to_triplets(
+    df_news,
+    df_nlinks,
+    df_ners,
+    founded_ner="",
+    graph_depth=None,
+    min_news_count=1,
+    max_nodes=0,
+    max_edges=0,
+    timings=None,
+):
+    """Compute edges of graph (triplets) from links of news and ners.
+
+    Args:
+        df_news (pd.DataFrame): with index id_news and columns summary_text,
+                                news_date
+        df_nlinks (pd.DataFrame): with columns id_news, id_ner
+        df_ners (pd.DataFrame): with index id_ner and columns ner_name, ner_type
+        founded_ner (str): ner_name to expand graph from ("" - full graph)
+        graph_depth (int): amount of levels of graph expansion
+        min_news_count (int): drop edges with amount of news < min_news_count
+        max_nodes (int): max amount of nodes in graph (0 - no limit)
+        max_edges (int): max amount of edges in graph (0 - no limit)
+        timings (dict): if given, seconds of stages (filter, expand, aggregate,
+                        prune, news_texts) are added to it (for benchmarks)
+
+    Returns:
+        tuple(df_triples, news_texts):
+            df_triples (pd.DataFrame): with columns source, target ("name#TYPE"),
+                amount, news_ids (list of id_news sorted by text of news),
+                sizes of graph before and after pruning in attrs["pruning"]
+            news_texts (pd.Series): "date: summary" of news from df_triples
+                (index id_news)
+    """
+    # all computations below are over integer codes of news and ners,
+    # names and texts are attached only to the result edges
+    start = time.perf_counter()
+    # links of ners missing in df_ners (e.g. ners merged after links were
+    # cached) are dropped, get_indexer gives -1 for them
+    df_nlinks = df_nlinks[df_nlinks.id_ner.isin(df_ners.index)]
+    news_codes, _ = pd.factorize(df_nlinks.id_news.values)
+    news_counts = np.bincount(news_codes)
+
+    # удаляем новости с > 5 нер, пока не решится вопрос с комплексными
+    # сводками новостей (часто с ключевым словом "главное:"), где могут
+    # в виде списка приводится не связанные между собой новости,
+    # в настоящий момент все ner, упоминаемые в любой части тако сводки,
+    # окажутся связанными между собой, что не является верным; имеет смысл
+    # дробить такие новости на несколько, либо использовать схожий подход,
+    # когда ner будут связаны между обой только в пределах перечислений
+    df_nlinks = df_nlinks[((news_counts >= 2) & (news_counts <= 5))[news_codes]]
+
+    # codes of ners by ner_name (for graph expansion) and codes of graph nodes
+    # by display name "name#TYPE" (sorted, i.e. order of codes is the same as
+    # order of names)
+    ner_name_codes, ner_name_uniques = pd.factorize(df_ners.ner_name)
+    node_codes, node_names = pd.factorize(
+        df_ners.ner_name.map(lambda x: RE_CLEAN_NODE_NAME.sub("", x))
+        + "#"
+        + df_ners.ner_type.fillna(""),
+        sort=True,
+    )
+    nlinks_ner_pos = df_ners.index.get_indexer(df_nlinks.id_ner.values)
+    start = lap_time(timings, "filter", start)
+
+    nlinks_index = NewsNerIndex(
+        df_nlinks.id_news.values, ner_name_codes[nlinks_ner_pos]
+    )
+    if founded_ner != "":
+        # bfs over inverted index news <-> ners (by ner_name)
+        news_mask = nlinks_index.expand(
+            [ner_name_uniques.get_loc(founded_ner)], graph_depth
+        )
+    else:
+        news_mask = np.ones(nlinks_index.n_news, dtype=bool)
+    nlinks_mask = nlinks_index.links_mask(news_mask)
+    start = lap_time(timings, "expand", start)
+
+    source, target, amount, news_indptr, news = aggregate_edges(
+        nlinks_index.news_codes[nlinks_mask],
+        node_codes[nlinks_ner_pos][nlinks_mask],
+        len(node_names),
+        min_news_count,
+    )
+    start = lap_time(timings, "aggregate", start)
+
+    # limit size of graph before news texts are attached
+    keep, pruning = prune_edges(
+        source, target, amount, len(node_names), max_nodes, max_edges
+    )
+    if pruning["pruned"]:
+        news = news[np.repeat(keep, amount)]
+        source, target, amount = source[keep], target[keep], amount[keep]
+        news_indptr = np.r_[0, np.cumsum(amount)]
+    start = lap_time(timings, "prune", start)
+
+    # texts only for news of result edges
+    edges_news, edges_news_inv = np.unique(news, return_inverse=True)
+    edges_id_news = nlinks_index.news_uniques[edges_news]
+    df_news = df_news[~df_news.index.duplicated()].reindex(edges_id_news)
+    # "%Y-%m-%d %H:%M: summary" (datetime_as_string is much faster than strftime)
+    news_texts = (
+        pd.Series(
+            np.datetime_as_string(df_news.news_date.values, unit="m"),
+            index=df_news.index,
+        ).str.replace("T", " ", regex=False)
+        + ": "
+        + df_news.summary_text
+    ).values
+    del df_news
+
+    # sort news of each edge by text (as before, i.e. by date)
+    news_texts_rank = np.empty(len(news_texts), dtype=np.int64)
+    news_texts_rank[np.argsort(news_texts, kind="stable")] = np.arange(len(news_texts))
+    news_order = np.lexsort(
+        (
+            news_texts_rank[edges_news_inv],
+            np.repeat(np.arange(len(amount)), amount),
+        )
+    )
+    edges_news_ids = edges_id_news[edges_news_inv[news_order]].tolist()
+
+    df_triples = pd.DataFrame(
+        {
+            "source": node_names[source],
+            "target": node_names[target],
+            "amount": amount,
+            "news_ids": [
+                edges_news_ids[start:stop]
+                for start, stop in zip(news_indptr[:-1], news_indptr[1:])
+            ],
+        }
+    )
+    df_triples.attrs["pruning"] = pruning
+    lap_time(timings, "news_texts", start)
+
+    return df_triples, pd.Series(news_texts, index=edges_id_news)
@@ -0,0 +1,250 @@
+"""Module for in-memory rolling window store of news links (app process).
+
+The store keeps news (with summaries), news links and ners for the last
+window_days days. It is loaded once at start and then updated incrementally:
+the ner-pipeline sends NOTIFY on NEWS_LINKED_CHANNEL with ids of newly linked
+news (and on DATA_VERSION_CHANNEL after revision of ner names or merges of
+ners, then links and ners of the window are reloaded), days that fall out of
+the window are evicted. Queries with date range inside the window are
+answered from the store without postgres.
+"""
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+import pandas as pd
+import psycopg2
+from psycopg2 import Error
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from src.common_funcs import NEWS_LINKED_CHANNEL, DATA_VERSION_CHANNEL
+
+
+class RollingGraphStore:
+    """Rolling window store of news, news links and ners."""
+
+    def __init__(self, pg_conn_cfg, window_days=90, poll_interval=60) -> None:
+        """
+        Args:
+            pg_conn_cfg: dict with cfg connect to database
+            window_days (int): size of window (in days)
+            poll_interval (float): max wait (in seconds) of notifications before
+                                   eviction check
+        """
+        self.pg_conn_cfg = pg_conn_cfg
+        self.window_days = window_days
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.window_start = None  # None - store is not loaded
+        self._df_news = None  # index id_news, columns summary_text, news_date
+        self._df_nlinks = None  # columns id_news, id_ner
+        self._df_ners = None  # index id_ner, columns ner_name, ner_type
+
+    def _connect(self):
+        return psycopg2.connect(
+            dbname=self.pg_conn_cfg["dbname"],
+            user=self.pg_conn_cfg["user"],
+            password=self.pg_conn_cfg["password"],
+            host=self.pg_conn_cfg["host"],
+            port=self.pg_conn_cfg["port"],
+        )
+
+    def _read_news(self, pg_con, news_condition, params):
+        """Read news, links and ners for news selected by condition (on
+        columns id_news and news_date, which are in all tables of news)."""
+        query = f"""
+            SELECT id_news, summary_text, news_date
+            FROM (SELECT * FROM news WHERE {news_condition}) news
+                INNER JOIN (SELECT * FROM news_summary
+                            WHERE {news_condition}) news_summary
+                USING(id_news, news_date)
+        """
+        df_news = pd.read_sql(query, pg_con, params=params, index_col=["id_news"])
+
+        query = f"""
+            SELECT id_news, id_ner
+            FROM news_links
+            WHERE id_ner IS NOT Null AND {news_condition}
+        """
+        df_nlinks = pd.read_sql(query, pg_con, params=params)
+        return df_news[~df_news.index.duplicated()], df_nlinks
+
+    def _read_ners(self, pg_con, id_ners):
+        query = """
+            SELECT id_ner, ner_name, ner_type
+            FROM (SELECT * FROM ner WHERE id_ner = ANY(%(id_ners)s)) ner
+                 LEFT JOIN ner_types USING(id_ner_type)
+        """
+        return pd.read_sql(
+            query,
+            pg_con,
+            params={"id_ners": [int(i) for i in id_ners]},
+            index_col=["id_ner"],
+        )
+
+    def _get_window_start(self):
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        return today - timedelta(days=self.window_days)
+
+    def load(self, pg_con):
+        """Load all news of window from db."""
+        start = time.perf_counter()
+        window_start = self._get_window_start()
+        df_news, df_nlinks = self._read_news(
+            pg_con, "news_date >= %(window_start)s", {"window_start": window_start}
+        )
+        df_ners = self._read_ners(pg_con, df_nlinks.id_ner.unique())
+
+        with self._lock:
+            self._df_news, self._df_nlinks, self._df_ners = df_news, df_nlinks, df_ners
+            self.window_start = window_start
+
+        print(
+            f"Info: Graph store: {len(df_news)} news, {len(df_nlinks)} links loaded "
+            f"in {time.perf_counter() - start:.1f} s."
+        )
+
+    def add_news(self, pg_con, id_news):
+        """Add (or replace) news with ids id_news from db."""
+        df_news, df_nlinks = self._read_news(
+            pg_con,
+            "id_news = ANY(%(id_news)s) AND news_date >= %(window_start)s",
+            {"id_news": list(id_news), "window_start": self.window_start},
+        )
+
+        with self._lock:
+            df_news = pd.concat(
+                [self._df_news[~self._df_news.index.isin(id_news)], df_news]
+            )
+            df_nlinks = pd.concat(
+                [self._df_nlinks[~self._df_nlinks.id_news.isin(id_news)], df_nlinks],
+                ignore_index=True,
+            )
+        df_ners = self._read_ners(pg_con, df_nlinks.id_ner.unique())
+
+        with self._lock:
+            self._df_news, self._df_nlinks, self._df_ners = df_news, df_nlinks, df_ners
+
+    def reload_links(self, pg_con):
+        """Reload links and ners of window (names and types can be revised by
+        ner-pipeline, links of merged ners are moved by put_custom_ners)."""
+        df_nlinks = pd.read_sql(
+            """
+            SELECT id_news, id_ner
+            FROM news_links
+            WHERE id_ner IS NOT Null AND news_date >= %(window_start)s
+            """,
+            pg_con,
+            params={"window_start": self.window_start},
+        )
+        df_ners = self._read_ners(pg_con, df_nlinks.id_ner.unique())
+        with self._lock:
+            # links only of news of the store (news without summary are not
+            # in the store)
+            self._df_nlinks = df_nlinks[df_nlinks.id_news.isin(self._df_news.index)]
+            self._df_ners = df_ners
+
+    def evict(self):
+        """Drop news that fall out of the window."""
+        window_start = self._get_window_start()
+        if window_start == self.window_start:
+            return
+
+        with self._lock:
+            df_news = self._df_news[self._df_news.news_date >= window_start]
+            self._df_nlinks = self._df_nlinks[
+                self._df_nlinks.id_news.isin(df_news.index)
+            ]
+            self._df_news = df_news
+            self.window_start = window_start
+
+    def covers(self, date_min, date_max):
+        """Check if date range is inside window of the store."""
+        window_start = self.window_start
+        return window_start is not None and pd.Timestamp(date_min) >= window_start
+
+    def get_data(self, date_min, date_max):
+        """Get news, links and ners for date range (as get_db_data_for_triplets).
+
+        Returns:
+            tuple(df_news, df_nlinks, df_ners)
+        """
+        with self._lock:
+            df_news, df_nlinks, df_ners = self._df_news, self._df_nlinks, self._df_ners
+
+        df_news = df_news[
+            (df_news.news_date >= pd.Timestamp(date_min))
+            & (df_news.news_date <= pd.Timestamp(date_max))
+        ]
+        df_nlinks = df_nlinks[df_nlinks.id_news.isin(df_news.index)]
+        df_ners = df_ners[df_ners.index.isin(df_nlinks.id_ner.unique())]
+
+        return df_news, df_nlinks, df_ners
+
+    @staticmethod
+    def _pop_notifies(pg_con):
+        """Pop all received notifications (polls until burst of notifications,
+        e.g. chunks of ids of many news, is read).
+
+        Returns:
+            tuple(ids of linked news, True if data version is bumped)
+        """
+        id_news, ners_revised = set(), False
+        pg_con.poll()
+        while pg_con.notifies:
+            while pg_con.notifies:
+                notify = pg_con.notifies.pop(0)
+                if notify.channel == NEWS_LINKED_CHANNEL:
+                    id_news.update(map(int, notify.payload.split(",")))
+                else:
+                    ners_revised = True
+            pg_con.poll()
+        return id_news, ners_revised
+
+    def _listen(self):
+        """Load store and listen notifications (reconnect and reload on errors)."""
+        while not self._stop.is_set():
+            try:
+                pg_con = self._connect()
+                pg_con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                pg_cur = pg_con.cursor()
+                pg_cur.execute(f"LISTEN {NEWS_LINKED_CHANNEL};")
+                pg_cur.execute(f"LISTEN {DATA_VERSION_CHANNEL};")
+
+                # (re)load after LISTEN, so notifications are not missed
+                self.load(pg_con)
+
+                while not self._stop.is_set():
+                    # queries of updates on this connection can receive
+                    # notifications too (they are in pg_con.notifies)
+                    if (
+                        pg_con.notifies
+                        or select.select([pg_con], [], [], self.poll_interval)[0]
+                    ):
+                        id_news, ners_revised = self._pop_notifies(pg_con)
+                        if len(id_news) > 0:
+                            self.add_news(pg_con, id_news)
+                        if ners_revised:
+                            self.reload_links(pg_con)
+
+                    self.evict()
+
+            except (Exception, Error) as error:
+                print("Error graph store (PostgreSQL):\n", error)
+                self.window_start = None
+                self._stop.wait(self.poll_interval)
+
+            finally:
+                if "pg_con" in locals() and pg_con:
+                    pg_con.close()
+
+    def start(self):
+        """Start loading and listening in background thread."""
+        self._thread = threading.Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,295 @@
+"""Module for fast search of ners by synonyms (in-process trigram index).
+
+Similarity is the same as in postgres pg_trgm: words of text (lowercase
+alphanumeric sequences) are padded by two spaces at the beginning and one
+space at the end, similarity = shared trigrams / all trigrams of both texts.
+Index is loaded from ner_synonyms and ner tables and refreshed incrementally
+(only new rows of ner_synonyms) with periodical full reload.
+"""
+import re
+import time
+import threading
+import numpy as np
+import psycopg2
+from psycopg2 import Error
+
+RE_WORDS = re.compile(r"[^\W_]+")
+
+
+def get_trigrams(text):
+    """Get set of trigrams of text (as pg_trgm show_trgm)"""
+    trigrams = set()
+    for word in RE_WORDS.findall(text.lower()):
+        word = "  " + word + " "
+        trigrams.update(word[i : i + 3] for i in range(len(word) - 2))  # noqa E203
+    return trigrams
+
+
+def trigram_similarity(text_a, text_b):
+    """Trigram similarity of texts (as pg_trgm similarity)"""
+    trigrams_a, trigrams_b = get_trigrams(text_a), get_trigrams(text_b)
+    if len(trigrams_a) == 0 or len(trigrams_b) == 0:
+        return 0.0
+    shared = len(trigrams_a & trigrams_b)
+    return shared / (len(trigrams_a) + len(trigrams_b) - shared)
+
+
+def words_similar(text, synonym, threshold):
+    """Check that texts have the same amount of words and each word of text is
+    similar (trigram similarity >= threshold) to some word of synonym, e.g.
+    "Министерство обороны Украины" and "Министерство обороны России" are not
+    similar (words "Украины" and "России" have no shared trigrams)."""
+    words = RE_WORDS.findall(text.lower())
+    syn_words = RE_WORDS.findall(synonym.lower())
+    if len(words) != len(syn_words):
+        return False
+    return all(
+        any(trigram_similarity(word, syn_word) >= threshold for syn_word in syn_words)
+        for word in words
+    )
+
+
+def select_match(text, ner_type, found, threshold, margin, word_threshold):
+    """Select ner for text from result of NerLookup.search (k >= 2): the most
+    similar ner is selected if it has the same type, similarity >= threshold,
+    its synonym is similar to text by words (see words_similar) and the next
+    ner is less similar at least by margin.
+
+    Args:
+        text (str): searched text
+        ner_type (str): type of entity of text
+        found (list): result of NerLookup.search
+        threshold (float): min similarity of synonyms
+        margin (float): min difference of similarity of two the most similar
+                        ners
+        word_threshold (float): min similarity of words (None - words are not
+                                checked)
+
+    Returns:
+        int: id_ner or None
+    """
+    if (
+        len(found) > 0
+        and found[0]["similarity"] >= threshold
+        and found[0]["ner_type"] == ner_type
+        and (
+            len(found) == 1 or found[0]["similarity"] - found[1]["similarity"] >= margin
+        )
+        and (
+            word_threshold is None
+            or words_similar(text, found[0]["ner_synonym"], word_threshold)
+        )
+    ):
+        return found[0]["id_ner"]
+    return None
+
+
+class NerLookup:
+    """Trigram index over ner_synonyms for fuzzy search of ners."""
+
+    def __init__(self, pg_conn_cfg, refresh_interval=300, full_refresh_interval=3600):
+        """
+        Args:
+            pg_conn_cfg: dict with cfg connect to database
+            refresh_interval (float): min interval (in seconds) between incremental
+                                      refreshes (load of new synonyms)
+            full_refresh_interval (float): interval (in seconds) between full
+                                           reloads of index (synonyms can be
+                                           relinked to other ners)
+        """
+        self.pg_conn_cfg = pg_conn_cfg
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshed = 0.0
+        self._full_refreshed = 0.0
+        self._reset()
+
+    def _reset(self):
+        self._last_id_synonim = 0
+        self._syn_names = []  # synonym by position in index
+        self._syn_id_ners = []  # id_ner by position in index
+        self._syn_trigrams_count = []  # amount of trigrams by position in index
+        self._syn_name2pos = {}  # {ner_synonym: position in index}
+        self._postings = {}  # {trigram: [position in index, ...]}
+        # numpy copies for search (updated on refresh)
+        self._postings_arr = {}
+        self._syn_trigrams_count_arr = np.zeros(0, dtype=np.int32)
+        self._syn_len_arr = np.zeros(0, dtype=np.int32)
+        self._ners = {}  # {id_ner: (ner_name, ner_type)}
+
+    def _fetch(self, last_id_synonim):
+        """Get new synonyms (id_synonim > last_id_synonim) and all ners from db."""
+        try:
+            pg_con = psycopg2.connect(
+                dbname=self.pg_conn_cfg["dbname"],
+                user=self.pg_conn_cfg["user"],
+                password=self.pg_conn_cfg["password"],
+                host=self.pg_conn_cfg["host"],
+                port=self.pg_conn_cfg["port"],
+            )
+            pg_cur = pg_con.cursor()
+            pg_cur.execute(
+                """
+                SELECT id_synonim, id_ner, ner_synonym
+                FROM ner_synonyms
+                WHERE id_synonim > %s
+                ORDER BY id_synonim;
+                """,
+                (last_id_synonim,),
+            )
+            synonyms = pg_cur.fetchall()
+            pg_cur.execute(
+                """
+                SELECT id_ner, ner_name, ner_type
+                FROM ner LEFT JOIN ner_types USING(id_ner_type);
+                """
+            )
+            ners = pg_cur.fetchall()
+            pg_cur.close()
+
+        except (Exception, Error) as error:
+            print("Error connection to PostgreSQL:\n", error)
+            synonyms, ners = None, None
+
+        finally:
+            if "pg_con" in locals() and pg_con:
+                pg_con.close()
+
+        return synonyms, ners
+
+    def _add_synonyms(self, synonyms):
+        updated_trigrams = set()
+        for id_synonim, id_ner, ner_synonym in synonyms:
+            # skipped synonyms are not fetched again by incremental refresh
+            self._last_id_synonim = max(self._last_id_synonim, id_synonim)
+            if ner_synonym in self._syn_name2pos:
+                # keep first synonym (as "LIMIT 1" in sql search)
+                continue
+            pos = len(self._syn_names)
+            trigrams = get_trigrams(ner_synonym)
+            self._syn_names.append(ner_synonym)
+            self._syn_id_ners.append(id_ner)
+            self._syn_trigrams_count.append(len(trigrams))
+            self._syn_name2pos[ner_synonym] = pos
+            for trigram in trigrams:
+                self._postings.setdefault(trigram, []).append(pos)
+            updated_trigrams.update(trigrams)
+
+        for trigram in updated_trigrams:
+            self._postings_arr[trigram] = np.array(
+                self._postings[trigram], dtype=np.int32
+            )
+        self._syn_trigrams_count_arr = np.array(
+            self._syn_trigrams_count, dtype=np.int32
+        )
+        self._syn_len_arr = np.array(list(map(len, self._syn_names)), dtype=np.int32)
+
+    def refresh(self, full=False):
+        """Load new synonyms to index (full=True - rebuild index from scratch).
+        Only one refresh at a time, searches use current index meanwhile."""
+        is_loaded = self._full_refreshed > 0
+        if not self._refresh_lock.acquire(blocking=not is_loaded):
+            return
+        try:
+            synonyms, ners = self._fetch(0 if full else self._last_id_synonim)
+            if synonyms is None:
+                return
+            self.load(synonyms, ners, full)
+
+            self._refreshed = time.monotonic()
+            if full:
+                self._full_refreshed = self._refreshed
+                print(f"Info: Ner lookup index: {len(self._syn_names)} synonyms.")
+        finally:
+            self._refresh_lock.release()
+
+    def load(self, synonyms, ners, full=True):
+        """Load rows to index (full=True - instead of current index).
+
+        Args:
+            synonyms: list of tuples(id_synonim, id_ner, ner_synonym)
+            ners: list of tuples(id_ner, ner_name, ner_type)
+        """
+        with self._lock:
+            if full:
+                self._reset()
+            self._add_synonyms(synonyms)
+            self._ners = {id_ner: (name, ntype) for id_ner, name, ntype in ners}
+
+    def maybe_refresh(self):
+        now = time.monotonic()
+        if now - self._full_refreshed >= self.full_refresh_interval:
+            self.refresh(full=True)
+        elif now - self._refreshed >= self.refresh_interval:
+            self.refresh()
+
+    def search(self, text, k=10):
+        """Search top-k ners by synonyms similar to text.
+
+        Args:
+            text (str): text to search
+            k (int): max amount of ners in result
+
+        Returns:
+            list of dicts(id_ner, ner_name, ner_type, ner_synonym, similarity),
+            sorted by similarity desc, then by difference of synonym and text
+            length asc
+        """
+        if k <= 0:
+            return []
+        self.maybe_refresh()
+
+        with self._lock:
+            pos = self._syn_name2pos.get(text)
+            if pos is not None:
+                # exact match by synonym
+                candidates = np.array([pos])
+                similarity = np.ones(1)
+            else:
+                trigrams = get_trigrams(text)
+                postings = [
+                    self._postings_arr[trigram]
+                    for trigram in trigrams
+                    if trigram in self._postings_arr
+                ]
+                if len(postings) == 0:
+                    return []
+                shared = np.bincount(
+                    np.concatenate(postings), minlength=len(self._syn_names)
+                )
+                candidates = np.flatnonzero(shared)
+                shared = shared[candidates]
+                similarity = shared / (
+                    len(trigrams) + self._syn_trigrams_count_arr[candidates] - shared
+                )
+
+            len_diff = np.abs(self._syn_len_arr[candidates] - len(text))
+            order = np.lexsort((len_diff, -similarity))
+
+            result, added_ners = [], set()
+            for i in order:
+                id_ner = self._syn_id_ners[candidates[i]]
+                if id_ner in added_ners or id_ner not in self._ners:
+                    continue
+                added_ners.add(id_ner)
+                result.append(
+                    {
+                        "id_ner": id_ner,
+                        "ner_name": self._ners[id_ner][0],
+                        "ner_type": self._ners[id_ner][1],
+                        "ner_synonym": self._syn_names[candidates[i]],
+                        "similarity": round(float(similarity[i]), 4),
+                    }
+                )
+                if len(result) >= k:
+                    break
+
+        return result
+
+    def resolve(self, text):
+        """Get ner_name of the most similar ner (None if not found)"""
+        result = self.search(text, k=1)
+        return result[0]["ner_name"] if len(result) > 0 else None
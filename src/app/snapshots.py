@@ -0,0 +1,184 @@
+"""Module for pre-rendered graph snapshots of standard queries (app process).
+
+Graphs of STANDARD_QUERIES (default view of the index page and top ners of
+the last days) are rendered to node-link json at start, after each data
+update (the ner-pipeline sends NOTIFY on DATA_VERSION_CHANNEL after commit)
+and at the change of day (dates of queries are relative to today). Each
+snapshot is written atomically as plain and gzip-compressed file to
+snapshot_dir, which is served by nginx as static files (gzip_static), so
+requests of standard queries don't reach python: the page gets url of
+snapshot instead of /data (and /data redirects to it).
+"""
+import os
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+import psycopg2
+from psycopg2 import Error
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from src.common_funcs import DATA_VERSION_CHANNEL
+from src.app.wire_format import compress
+
+# {name: query params, days - date range from today - days to today}
+STANDARD_QUERIES = {
+    "default": {
+        "input_ner": "Россия",
+        "days": 14,
+        "graph_depth": 2,
+        "min_news_count": 4,
+    },
+    "top_1d": {"input_ner": "", "days": 1, "graph_depth": 0, "min_news_count": 4},
+    "top_7d": {"input_ner": "", "days": 7, "graph_depth": 0, "min_news_count": 4},
+    "top_14d": {"input_ner": "", "days": 14, "graph_depth": 0, "min_news_count": 4},
+}
+
+
+def get_standard_queries(today=None):
+    """Get graph queries (args of compute_triplets) of STANDARD_QUERIES.
+
+    Returns:
+        dict: {name: graph query}
+    """
+    today = today or datetime.now()
+    return {
+        name: {
+            "input_ner": params["input_ner"],
+            "date_min": (today - timedelta(days=params["days"])).strftime("%Y-%m-%d"),
+            "date_max": today.strftime("%Y-%m-%d"),
+            "graph_depth": params["graph_depth"],
+            "min_news_count": params["min_news_count"],
+        }
+        for name, params in STANDARD_QUERIES.items()
+    }
+
+
+class SnapshotBuilder:
+    """Builder of snapshots of standard queries (rebuilt in background thread
+    on notifications of data updates)."""
+
+    def __init__(
+        self,
+        pg_conn_cfg,
+        snapshot_dir,
+        render,
+        key_func,
+        url_prefix="/snapshots/",
+        delay=5,
+        poll_interval=60,
+    ) -> None:
+        """
+        Args:
+            pg_conn_cfg: dict with cfg connect to database
+            snapshot_dir (str): directory of snapshots (None - disabled)
+            render: function of graph query, returns serialized graph (bytes)
+                    or None for bad query
+            key_func: function of graph query, returns key of query (queries
+                      with the same key give the same graph)
+            url_prefix (str): url of snapshot_dir (location of nginx)
+            delay (float): wait (in seconds) after notification before rebuild
+                           (e.g. until graph store is updated)
+            poll_interval (float): max wait (in seconds) of notifications before
+                                   check of change of day
+        """
+        self.pg_conn_cfg = pg_conn_cfg
+        self.snapshot_dir = snapshot_dir
+        self.render = render
+        self.key_func = key_func
+        self.url_prefix = url_prefix
+        self.delay = delay
+        self.poll_interval = poll_interval
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._day = None  # day of built snapshots
+        self._urls = {}  # {key of query: url of snapshot}
+
+    def get_url(self, graph_query):
+        """Get url of snapshot of the query (None if there is no snapshot)."""
+        if graph_query is None or len(self._urls) == 0:
+            return None
+        return self._urls.get(self.key_func(graph_query))
+
+    def write(self, name, payload):
+        """Write plain and gzip-compressed snapshot (atomically by rename, so
+        nginx never serves partially written file).
+
+        Returns:
+            str: url of snapshot
+        """
+        path = os.path.join(self.snapshot_dir, f"{name}.json")
+        for file_path, data in (
+            (path + ".gz", compress(payload, "gzip")),
+            (path, payload),
+        ):
+            tmp_path = f"{file_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, file_path)
+        # version in url, so browsers don't use previous snapshot
+        return f"{self.url_prefix}{name}.json?v={int(time.time())}"
+
+    def build(self):
+        """Render and write snapshots of all standard queries."""
+        start = time.perf_counter()
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        today = datetime.now()
+        urls = {}
+        for name, graph_query in get_standard_queries(today).items():
+            payload = self.render(graph_query)
+            if payload is not None:
+                urls[self.key_func(graph_query)] = self.write(name, payload)
+
+        self._urls = urls
+        self._day = today.date()
+        print(
+            f"Info: Graph snapshots: {len(urls)} of {len(STANDARD_QUERIES)} built "
+            f"in {time.perf_counter() - start:.1f} s."
+        )
+
+    def _listen(self):
+        """Build snapshots and rebuild them on notifications (reconnect and
+        rebuild on errors)."""
+        while not self._stop.is_set():
+            try:
+                pg_con = psycopg2.connect(
+                    dbname=self.pg_conn_cfg["dbname"],
+                    user=self.pg_conn_cfg["user"],
+                    password=self.pg_conn_cfg["password"],
+                    host=self.pg_conn_cfg["host"],
+                    port=self.pg_conn_cfg["port"],
+                )
+                pg_con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                pg_cur = pg_con.cursor()
+                pg_cur.execute(f"LISTEN {DATA_VERSION_CHANNEL};")
+
+                # build after LISTEN, so notifications are not missed
+                self.build()
+
+                while not self._stop.is_set():
+                    if select.select([pg_con], [], [], self.poll_interval)[0]:
+                        # several updates in a row give one rebuild
+                        self._stop.wait(self.delay)
+                        pg_con.poll()
+                        pg_con.notifies.clear()
+                        self.build()
+                    elif datetime.now().date() != self._day:
+                        self.build()
+
+            except (Exception, Error) as error:
+                print("Error graph snapshots:\n", error)
+                self._urls = {}
+                self._stop.wait(self.poll_interval)
+
+            finally:
+                if "pg_con" in locals() and pg_con:
+                    pg_con.close()
+
+    def start(self):
+        """Start building and listening in background thread."""
+        self._thread = threading.Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
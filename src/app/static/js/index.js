@@ -34,7 +34,8 @@ var simulation = d3.forceSimulation()
   ;
 
 
-d3.json("/data", function (error, graph) {
+// url of graph: /data or pre-rendered snapshot of standard query
+d3.json(typeof DATA_URL !== "undefined" ? DATA_URL : "/data", function (error, graph) {
 
   if (error) throw error;
 
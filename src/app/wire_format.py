@@ -0,0 +1,157 @@
+"""Module for formats of graph response (/data route).
+
+Formats of graph:
+    - node_link: networkx node-link data, each edge with list of news texts
+    - compact: nodes list, edges in columns with ids of news, texts of news
+               are sent once in table {id_news: text}
+    - compact_lazy: as compact, but without table of news texts (texts can be
+                    loaded by ids later from /news route)
+
+Both formats carry sizes of graph before and after pruning (see prune_edges
+in graph_engine module) in "graph" field.
+
+Serialization (negotiated by Accept header): json (orjson if installed)
+or MessagePack (if msgpack is installed). Compression (negotiated by
+Accept-Encoding header): br (if brotli is installed), gzip or identity.
+"""
+import gzip
+import json
+import networkx as nx
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GRAPH_FORMATS = ("node_link", "compact", "compact_lazy")
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_MSGPACK = "application/x-msgpack"
+
+
+def graph_to_node_link(df_triples, news_texts):
+    """Graph in networkx node-link format (news texts in each edge).
+
+    Args:
+        df_triples (pd.DataFrame): with columns source, target, amount, news_ids
+        news_texts (pd.Series): texts of news (index id_news)
+    """
+    news_texts = news_texts.to_dict()
+    df_triples = df_triples.assign(
+        news=[[news_texts[i] for i in ids] for ids in df_triples.news_ids]
+    )
+
+    G = nx.from_pandas_edgelist(
+        df_triples,
+        source="source",
+        target="target",
+        edge_attr=["amount", "news"],
+        create_using=nx.Graph(),
+    )
+    G.graph.update(df_triples.attrs.get("pruning", {}))
+    return nx.node_link_data(G)
+
+
+def graph_to_compact(df_triples, news_texts, lazy=False):
+    """Graph in compact format: nodes are sent as list of names, edges are sent
+    in columns (source and target are positions in nodes), news texts are sent
+    once in table (or not sent, if lazy=True).
+
+    Args:
+        df_triples (pd.DataFrame): with columns source, target, amount, news_ids
+        news_texts (pd.Series): texts of news (index id_news)
+        lazy (bool): don't send news texts
+    """
+    nodes = sorted(set(df_triples.source) | set(df_triples.target))
+    node_pos = {node: i for i, node in enumerate(nodes)}
+
+    data = {
+        "graph": df_triples.attrs.get("pruning", {}),
+        "nodes": nodes,
+        "links": {
+            "source": [node_pos[node] for node in df_triples.source],
+            "target": [node_pos[node] for node in df_triples.target],
+            "amount": df_triples.amount.tolist(),
+            "news": df_triples.news_ids.tolist(),
+        },
+    }
+    if not lazy:
+        data["news"] = {str(i): text for i, text in news_texts.items()}
+
+    return data
+
+
+def graph_to_format(df_triples, news_texts, graph_format="node_link"):
+    if graph_format == "node_link":
+        return graph_to_node_link(df_triples, news_texts)
+    return graph_to_compact(df_triples, news_texts, graph_format == "compact_lazy")
+
+
+def negotiate_content_type(accept):
+    """Get content type of response by Accept header."""
+    if msgpack is not None and CONTENT_TYPE_MSGPACK in (accept or ""):
+        return CONTENT_TYPE_MSGPACK
+    return CONTENT_TYPE_JSON
+
+
+def parse_accept_encoding(accept_encoding):
+    """Parse Accept-Encoding header.
+
+    Returns:
+        dict: {encoding (lowercase): q-value}
+    """
+    qvalues = {}
+    for item in (accept_encoding or "").split(","):
+        encoding, *params = [part.strip() for part in item.split(";")]
+        if not encoding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[encoding.lower()] = q
+    return qvalues
+
+
+def negotiate_encoding(accept_encoding):
+    """Get content encoding of response by Accept-Encoding header (supported
+    encoding with the highest non-zero q-value, br is preferred on ties)."""
+    qvalues = parse_accept_encoding(accept_encoding)
+    supported = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_q = "identity", 0.0
+    for encoding in supported:
+        q = qvalues.get(encoding, qvalues.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def serialize(data, content_type=CONTENT_TYPE_JSON):
+    """Serialize data to bytes."""
+    if content_type == CONTENT_TYPE_MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def compress(payload, encoding="identity"):
+    """Compress payload (bytes) by content encoding."""
+    if encoding == "br":
+        return brotli.compress(payload, quality=5)
+    if encoding == "gzip":
+        return gzip.compress(payload, compresslevel=6)
+    return payload
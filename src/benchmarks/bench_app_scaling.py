@@ -0,0 +1,224 @@
+"""Scaling benchmark of the graph query of the app (compute_triplets and
+build_network) by stages over seeded benchmark database (see seed_app_db):
+    db_fetch - prepared queries of news, links and ners in date range (PgPool)
+    filter - filter of news by amount of ners, integer codes of ners
+    expand - bfs over inverted index news <-> ners (graph_depth)
+    aggregate - edges aggregation (co-occurrence of ners in news)
+    prune - limit of graph size (GRAPH_MAX_NODES, GRAPH_MAX_EDGES)
+    news_texts - texts of news of edges, result dataframe
+    networkx_build - networkx graph in node-link format
+    json_encode - serialization of graph to json
+    gzip - compression of json
+Each query (date range, graph_depth, min_news_count) is run once for warm up,
+then median time of --repeat runs is reported for each stage.
+
+Results are written to json (params, environment, runs), so runs can be
+compared over time.
+
+Run from cli (POSTGRES_* env as for pipelines, POSTGRES_DB is not used):
+    python src/benchmarks/bench_app_scaling.py --links 10000 100000 1000000
+    python src/benchmarks/bench_app_scaling.py --links 5000000 --ranges 7 30
+    python src/benchmarks/bench_app_scaling.py --no-seed --db news_bench
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+from datetime import datetime, timedelta
+import numpy as np
+from src.app.db import PgPool
+from src.app.graph_engine import links_to_triplets
+from src.app.wire_format import CONTENT_TYPE_JSON, graph_to_format, serialize, compress
+from src.benchmarks.seed_app_db import seed_app_db
+from src.benchmarks.synthetic_corpus import get_pg_conn_cfg
+from src.benchmarks.bench_pipeline import get_git_commit
+
+STAGES = [
+    "db_fetch",
+    "filter",
+    "expand",
+    "aggregate",
+    "prune",
+    "news_texts",
+    "networkx_build",
+    "json_encode",
+    "gzip",
+]
+
+
+def run_query(pg_pool, query, max_nodes, max_edges):
+    """Run graph query by stages as the app does (without graph cache).
+
+    Returns:
+        tuple(timings, sizes): seconds of stages and sizes of data and graph
+    """
+    timings = {}
+    start = time.perf_counter()
+    with pg_pool.cursor() as pg_cur:
+        params = (query["date_min"], query["date_max"])
+        df_news = pg_pool.read_df(pg_cur, "news_in_range", params, "id_news")
+        df_nlinks = pg_pool.read_df(pg_cur, "nlinks_in_range", params)
+        df_ners = pg_pool.read_df(pg_cur, "ners_in_range", params, "id_ner")
+    timings["db_fetch"] = time.perf_counter() - start
+
+    df_triples, news_texts = links_to_triplets(
+        df_news,
+        df_nlinks,
+        df_ners,
+        query["input_ner"],
+        query["graph_depth"],
+        query["min_news_count"],
+        max_nodes,
+        max_edges,
+        timings=timings,
+    )
+
+    start = time.perf_counter()
+    data = graph_to_format(df_triples, news_texts, "node_link")
+    timings["networkx_build"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    payload = serialize(data, CONTENT_TYPE_JSON)
+    timings["json_encode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compressed = compress(payload, "gzip")
+    timings["gzip"] = time.perf_counter() - start
+
+    sizes = {
+        "news": len(df_news),
+        "links": len(df_nlinks),
+        "edges": len(df_triples),
+        "edges_total": df_triples.attrs["pruning"]["edges_total"],
+        "json_kb": round(len(payload) / 1024, 1),
+        "gzip_kb": round(len(compressed) / 1024, 1),
+    }
+    return timings, sizes
+
+
+def get_date_max(pg_pool):
+    with pg_pool.cursor() as pg_cur:
+        pg_cur.execute("SELECT MAX(news_date) FROM news;")
+        return pg_cur.fetchone()[0]
+
+
+def bench_queries(pg_pool, args, n_links):
+    """Run all combinations of query params on the database.
+
+    Returns:
+        list: results of queries (params, sizes, median seconds of stages)
+    """
+    date_max = get_date_max(pg_pool)
+    results = []
+    print(
+        f"{'links':>8} {'days':>4} {'depth':>5} {'min':>3} {'news':>7} "
+        f"{'edges':>6} "
+        + " ".join(f"{stage[:9]:>9}" for stage in STAGES)
+        + f" {'total':>7}"
+    )
+    for range_days in args.ranges:
+        for graph_depth in args.depths:
+            for min_news_count in args.min_news_counts:
+                query = {
+                    "input_ner": args.ner,
+                    "date_min": (date_max - timedelta(days=range_days)).strftime(
+                        "%Y-%m-%d"
+                    ),
+                    "date_max": date_max.strftime("%Y-%m-%d"),
+                    "graph_depth": graph_depth,
+                    "min_news_count": min_news_count,
+                }
+                runs = [
+                    run_query(pg_pool, query, args.max_nodes, args.max_edges)
+                    for _ in range(args.repeat + 1)
+                ][1:]
+                seconds = {
+                    stage: float(np.median([timings[stage] for timings, _ in runs]))
+                    for stage in STAGES
+                }
+                sizes = runs[-1][1]
+                results.append(
+                    {
+                        "db_links": n_links,
+                        "range_days": range_days,
+                        **query,
+                        **sizes,
+                        "seconds": {k: round(v, 5) for k, v in seconds.items()},
+                        "total_seconds": round(sum(seconds.values()), 5),
+                    }
+                )
+                print(
+                    f"{n_links:>8} {range_days:>4} {graph_depth:>5} "
+                    f"{min_news_count:>3} {sizes['news']:>7} {sizes['edges']:>6} "
+                    + " ".join(f"{seconds[stage]:>9.4f}" for stage in STAGES)
+                    + f" {sum(seconds.values()):>7.3f}"
+                )
+    return results
+
+
+def bench_app_scaling(args):
+    pg_conn_cfg = get_pg_conn_cfg(args.db)
+    results, seeded = [], []
+    for n_links in [None] if args.no_seed else args.links:
+        if n_links is not None:
+            seeded.append(
+                seed_app_db(pg_conn_cfg, n_links, args.days, schema=args.schema)
+            )
+        pg_pool = PgPool(pg_conn_cfg, maxconn=1, statement_timeout=600000)
+        try:
+            results += bench_queries(pg_pool, args, n_links or 0)
+        finally:
+            pg_pool.closeall()
+
+    report = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": get_git_commit(),
+        "params": vars(args),
+        "environment": {
+            "host": socket.gethostname(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "seeded": seeded,
+        "queries": results,
+    }
+    output = args.output or os.path.join(
+        "reports",
+        "benchmarks",
+        "app_scaling_{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S")),
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Info: results are written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--db", default="news_bench", help="benchmark database")
+    parser.add_argument(
+        "--links", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--no-seed", action="store_true", help="use seeded --db")
+    parser.add_argument("--days", type=int, default=365, help="date range of data")
+    parser.add_argument(
+        "--ranges", type=int, nargs="+", default=[7, 30, 90], help="days of query"
+    )
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("--min-news-counts", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--ner", default="Россия")
+    parser.add_argument("--max-nodes", type=int, default=1000)
+    parser.add_argument("--max-edges", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--schema", default=None, help="sql script of schema (default - project)"
+    )
+    parser.add_argument("--output", default=None, help="json file of results")
+    args = parser.parse_args()
+    bench_app_scaling(args)
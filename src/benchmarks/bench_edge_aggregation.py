@@ -0,0 +1,104 @@
+"""Benchmark of edges aggregation in compute_triplets (full graph, without
+expansion): previous implementation with "name#TYPE" strings, combinations
+and explode vs integer codes (links_to_triplets). Reports time and peak
+memory (by tracemalloc).
+
+Run from cli:
+    python src/benchmarks/bench_edge_aggregation.py
+"""
+import re
+import time
+import argparse
+import tracemalloc
+from itertools import combinations
+from src.app.graph_engine import links_to_triplets
+from src.benchmarks.synthetic import gen_news_links, gen_news
+
+
+def triplets_strings(df_news, df_nlinks, min_news_count):
+    """Previous implementation of edges aggregation (for comparison),
+    df_nlinks with columns id_news, ner_name, ner_type."""
+    counts = df_nlinks.groupby(by="id_news").ner_name.count()
+    df_nlinks = df_nlinks[
+        ~df_nlinks.id_news.isin(counts[(counts < 2) | (counts > 5)].index)
+    ].copy()
+
+    re_clean_name = re.compile(r"[^a-zA-Zа-яА-Я0-9 \-+№%]+")
+    df_nlinks["ner_name"] = (
+        df_nlinks.ner_name.map(lambda x: re_clean_name.sub("", x))
+        + "#"
+        + df_nlinks.ner_type
+    )
+    df_nlinks.drop(columns="ner_type", inplace=True)
+    df_nlinks = df_nlinks.groupby("id_news").agg({"ner_name": sorted})
+    df_nlinks = df_nlinks.merge(df_news, how="left", left_index=True, right_index=True)
+    df_nlinks["ner_name"] = df_nlinks.ner_name.map(lambda x: list(combinations(x, 2)))
+    df_nlinks["news"] = (
+        df_nlinks.news_date.dt.strftime("%Y-%m-%d %H:%M: ") + df_nlinks.summary_text
+    )
+    df_triples = df_nlinks[["ner_name", "news"]].explode("ner_name")
+    del df_nlinks
+    df_triples = df_triples.groupby("ner_name", as_index=False).agg(
+        news=("news", sorted), amount=("news", len)
+    )
+    if min_news_count > 1:
+        df_triples = df_triples[df_triples.amount >= min_news_count]
+    return df_triples
+
+
+def measure(func, *args):
+    """Return (time in seconds, peak memory in MB, result)"""
+    start = time.perf_counter()
+    res = func(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return elapsed, peak, res
+
+
+def main(days_list, news_per_day, min_news_count):
+    print(
+        f"{'days':>5} {'links':>9} {'edges':>8} {'str, s':>8} {'int, s':>8} "
+        f"{'str, MB':>8} {'int, MB':>8}"
+    )
+    for n_days in days_list:
+        df_nlinks = gen_news_links(n_days, news_per_day=news_per_day)
+        df_news = gen_news(df_nlinks.id_news.values, n_days)
+        df_ners = df_nlinks.drop_duplicates("id_ner").set_index("id_ner")[
+            ["ner_name", "ner_type"]
+        ]
+
+        t_str, mem_str, res_str = measure(
+            triplets_strings,
+            df_news,
+            df_nlinks[["id_news", "ner_name", "ner_type"]],
+            min_news_count,
+        )
+        t_int, mem_int, res_int = measure(
+            links_to_triplets,
+            df_news,
+            df_nlinks[["id_news", "id_ner"]],
+            df_ners,
+            "",
+            None,
+            min_news_count,
+        )
+        assert len(res_str) == len(res_int)
+        assert res_str.amount.sum() == res_int.amount.sum()
+
+        print(
+            f"{n_days:>5} {len(df_nlinks):>9} {len(res_int):>8} {t_str:>8.2f} "
+            f"{t_int:>8.2f} {mem_str:>8.0f} {mem_int:>8.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=int, nargs="+", default=[7, 30, 90, 180, 365])
+    parser.add_argument("--news-per-day", type=int, default=500)
+    parser.add_argument("--min-news-count", type=int, default=1)
+    args = parser.parse_args()
+    main(args.days, args.news_per_day, args.min_news_count)
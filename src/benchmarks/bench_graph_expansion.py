@@ -0,0 +1,94 @@
+"""Scaling benchmark of graph expansion (graph_depth loop in compute_triplets):
+previous implementation with pandas isin filters vs inverted index NewsNerIndex.
+
+Run from cli:
+    python src/benchmarks/bench_graph_expansion.py
+"""
+import time
+import argparse
+from src.app.graph_engine import NewsNerIndex
+from src.benchmarks.synthetic import gen_news_links
+
+
+def expand_isin(df_nlinks, founded_ner, graph_depth):
+    """Previous implementation of graph expansion (for comparison)"""
+    lvl_ners = [[founded_ner]]
+    lvl_idx = []
+    prev_lvls_idx = []
+
+    for _ in range(graph_depth):
+        lvl_idx.append(
+            list(
+                set(
+                    df_nlinks[
+                        (
+                            df_nlinks.ner_name.isin(lvl_ners[-1])
+                            & (~df_nlinks.id_news.isin(prev_lvls_idx))
+                        )
+                    ].id_news
+                )
+            )
+        )
+        lvl_ners.append(
+            list(
+                set(df_nlinks[df_nlinks.id_news.isin(lvl_idx[-1])].ner_name)
+                - set(lvl_ners[-1])
+            )
+        )
+        prev_lvls_idx.extend(lvl_idx[-1])
+
+    return df_nlinks[df_nlinks.id_news.isin(prev_lvls_idx)]
+
+
+def expand_index(df_nlinks, founded_ner, graph_depth):
+    nlinks_index = NewsNerIndex(df_nlinks.id_news.values, df_nlinks.ner_name.values)
+    news_mask = nlinks_index.expand([founded_ner], graph_depth)
+    return df_nlinks[nlinks_index.links_mask(news_mask)]
+
+
+def timeit(func, *args, repeat=3):
+    """Return (best time in seconds, result of last call)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+
+def main(days_list, depths, news_per_day, founded_ner):
+    print(
+        f"{'days':>5} {'links':>9} {'depth':>5} {'news':>7} "
+        f"{'isin, s':>9} {'index, s':>9} {'speedup':>8}"
+    )
+    for n_days in days_list:
+        df_nlinks = gen_news_links(n_days, news_per_day=news_per_day)
+
+        # the same filter as in compute_triplets (news with 2..5 ners)
+        counts = df_nlinks.groupby("id_news").ner_name.count()
+        df_nlinks = df_nlinks[
+            ~df_nlinks.id_news.isin(counts[(counts < 2) | (counts > 5)].index)
+        ]
+
+        for graph_depth in depths:
+            t_isin, res_isin = timeit(expand_isin, df_nlinks, founded_ner, graph_depth)
+            t_index, res_index = timeit(
+                expand_index, df_nlinks, founded_ner, graph_depth
+            )
+            assert set(res_isin.id_news) == set(res_index.id_news)
+
+            print(
+                f"{n_days:>5} {len(df_nlinks):>9} {graph_depth:>5} "
+                f"{res_index.id_news.nunique():>7} {t_isin:>9.3f} {t_index:>9.3f} "
+                f"{t_isin / t_index:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=int, nargs="+", default=[14, 30, 90, 180, 365])
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--news-per-day", type=int, default=500)
+    parser.add_argument("--ner", default="Сущность 50")
+    args = parser.parse_args()
+    main(args.days, args.depths, args.news_per_day, args.ner)
@@ -0,0 +1,277 @@
+"""Labeled check of matching of entities by similar synonyms in local trigram
+index (NerLookup + select_match, step 02 of ner_pipeline) for grid of
+threshold, margin and word threshold (None - words are not checked).
+
+Labeled queries:
+    builtin - misspellings of known entities (positives) and entities, which
+        differ from known entities by a word (negatives, e.g. "Министерство
+        обороны Украины" with "Министерство обороны России" in index)
+    database (--db) - synonyms of ner_synonyms with a random typo (positives)
+        and synonyms of --holdout share of ners, which are removed from index
+        (negatives)
+Query is true positive if the ner of query is selected, false positive if
+other ner is selected (for negatives - any ner).
+
+Results are written to json (params, counts, precision and recall of each
+config), so runs can be compared over time.
+
+Run from cli (POSTGRES_* env as for pipelines, POSTGRES_DB is not used):
+    python src/benchmarks/bench_ner_index.py
+    python src/benchmarks/bench_ner_index.py --db news_db --queries 5000
+"""
+import os
+import json
+import random
+import argparse
+import itertools
+from datetime import datetime
+import psycopg2
+from src.app.ner_lookup import NerLookup, select_match
+from src.benchmarks.synthetic_corpus import get_pg_conn_cfg
+from src.benchmarks.bench_pipeline import get_git_commit
+
+# (ner_name, ner_type, synonyms in index)
+BUILTIN_NERS = [
+    ("Министерство обороны России", "ORG", ["Минобороны России", "Минобороны РФ"]),
+    ("Министерство иностранных дел России", "ORG", ["МИД России", "МИД РФ"]),
+    ("Государственная дума", "ORG", ["Госдума"]),
+    ("Центральный банк России", "ORG", ["Банк России", "ЦБ РФ"]),
+    ("Газпром", "ORG", []),
+    ("Газпром нефть", "ORG", []),
+    ("Владимир Путин", "PER", ["Путин", "Владимир Владимирович Путин"]),
+    ("Сергей Лавров", "PER", ["Лавров"]),
+    ("Эммануэль Макрон", "PER", ["Макрон"]),
+    ("Нижний Новгород", "LOC", []),
+    ("Санкт-Петербург", "LOC", ["Петербург"]),
+    ("Северная Корея", "LOC", ["КНДР"]),
+    ("Новая Зеландия", "LOC", []),
+]
+
+# (query, ner_type, ner_name or None - query must not be matched)
+BUILTIN_QUERIES = [
+    ("Министерство обороны Росии", "ORG", "Министерство обороны России"),
+    ("Минобороны Россиии", "ORG", "Министерство обороны России"),
+    (
+        "Министерство иностраных дел России",
+        "ORG",
+        "Министерство иностранных дел России",
+    ),
+    ("Государственая дума", "ORG", "Государственная дума"),
+    ("Центральный банк Росии", "ORG", "Центральный банк России"),
+    ("Газпромнефть", "ORG", "Газпром нефть"),
+    ("Владимир Путн", "PER", "Владимир Путин"),
+    ("Сергей Лавроф", "PER", "Сергей Лавров"),
+    ("Эмануэль Макрон", "PER", "Эммануэль Макрон"),
+    ("Нижний Новогород", "LOC", "Нижний Новгород"),
+    ("Санкт Петербург", "LOC", "Санкт-Петербург"),
+    ("Северная Карея", "LOC", "Северная Корея"),
+    ("Министерство обороны Украины", "ORG", None),
+    ("Министерство обороны Франции", "ORG", None),
+    ("Министерство иностранных дел Украины", "ORG", None),
+    ("Центральный банк Украины", "ORG", None),
+    ("Газпромбанк", "ORG", None),
+    ("Владимир Зеленский", "PER", None),
+    ("Сергей Шойгу", "PER", None),
+    ("Южная Корея", "LOC", None),
+    ("Новая Каледония", "LOC", None),
+    ("Нижний Тагил", "LOC", None),
+]
+
+
+def add_typo(text, rng):
+    """Random edit (delete, replace, insert or swap of letters) of a word of
+    text with at least 4 letters (text is returned as is if there is no such
+    word, numbers are not changed)"""
+    words = text.split(" ")
+    long_words = [
+        i for i, word in enumerate(words) if len(word) >= 4 and word.isalpha()
+    ]
+    if len(long_words) == 0:
+        return text
+    i = rng.choice(long_words)
+    letters = list(words[i])
+    pos = rng.randrange(1, len(letters) - 1)
+    edit = rng.choice(["delete", "replace", "insert", "swap"])
+    if edit == "delete":
+        del letters[pos]
+    elif edit == "replace":
+        letters[pos] = rng.choice("аеиоу")
+    elif edit == "insert":
+        letters.insert(pos, letters[pos])
+    else:
+        letters[pos - 1], letters[pos] = letters[pos], letters[pos - 1]
+    words[i] = "".join(letters)
+    return " ".join(words)
+
+
+def builtin_dataset():
+    """
+    Returns:
+        tuple(synonyms, ners, queries) - rows for NerLookup.load and list of
+        tuples(query, ner_type, id_ner or None)
+    """
+    synonyms, ners, name2id = [], [], {}
+    for id_ner, (ner_name, ner_type, ner_synonyms) in enumerate(BUILTIN_NERS, 1):
+        name2id[ner_name] = id_ner
+        ners.append((id_ner, ner_name, ner_type))
+        for ner_synonym in [ner_name] + ner_synonyms:
+            synonyms.append((len(synonyms) + 1, id_ner, ner_synonym))
+    queries = [
+        (query, ner_type, name2id.get(ner_name))
+        for query, ner_type, ner_name in BUILTIN_QUERIES
+    ]
+    return synonyms, ners, queries
+
+
+def db_dataset(pg_conn_cfg, n_queries, holdout, rng):
+    """Synonyms of database (ners of holdout share are removed from index).
+
+    Returns:
+        tuple(synonyms, ners, queries) as builtin_dataset
+    """
+    pg_con = psycopg2.connect(**pg_conn_cfg)
+    try:
+        pg_cur = pg_con.cursor()
+        pg_cur.execute(
+            """
+            SELECT id_synonim, id_ner, ner_synonym
+            FROM ner_synonyms
+            ORDER BY id_synonim;
+            """
+        )
+        all_synonyms = pg_cur.fetchall()
+        pg_cur.execute(
+            """
+            SELECT id_ner, ner_name, ner_type
+            FROM ner LEFT JOIN ner_types USING(id_ner_type);
+            """
+        )
+        ners = pg_cur.fetchall()
+        pg_cur.close()
+    finally:
+        pg_con.close()
+
+    ner_types = {id_ner: ner_type for id_ner, _, ner_type in ners}
+    removed = {id_ner for id_ner in ner_types if rng.random() < holdout}
+    synonyms = [row for row in all_synonyms if row[1] not in removed]
+    ners = [row for row in ners if row[0] not in removed]
+
+    queries = []
+    for _, id_ner, ner_synonym in rng.sample(
+        all_synonyms, min(n_queries, len(all_synonyms))
+    ):
+        if id_ner in removed:
+            queries.append((ner_synonym, ner_types[id_ner], None))
+        else:
+            queries.append((add_typo(ner_synonym, rng), ner_types[id_ner], id_ner))
+    return synonyms, ners, queries
+
+
+def evaluate(synonyms, ners, queries, configs):
+    """Match queries by each config (threshold, margin, word_threshold).
+
+    Returns:
+        list: dicts(config, tp, fp, fn, precision, recall)
+    """
+    index = NerLookup(None, refresh_interval=float("inf"))
+    index.full_refresh_interval = float("inf")
+    index.load(synonyms, ners)
+    found = [index.search(query, k=2) for query, _, _ in queries]
+
+    results = []
+    for threshold, margin, word_threshold in configs:
+        tp, fp, fn = 0, 0, 0
+        for (query, ner_type, id_ner), found_query in zip(queries, found):
+            matched = select_match(
+                query, ner_type, found_query, threshold, margin, word_threshold
+            )
+            if matched is not None and matched == id_ner:
+                tp += 1
+            elif matched is not None:
+                fp += 1
+            elif id_ner is not None:
+                fn += 1
+        results.append(
+            {
+                "threshold": threshold,
+                "margin": margin,
+                "word_threshold": word_threshold,
+                "tp": tp,
+                "fp": fp,
+                "fn": fn,
+                "precision": round(tp / max(tp + fp, 1), 4),
+                "recall": round(tp / max(tp + fn, 1), 4),
+            }
+        )
+    return results
+
+
+def print_results(name, n_queries, results):
+    print(f"{name}: {n_queries} queries")
+    print(
+        f"{'threshold':>9} {'margin':>6} {'words':>5} {'tp':>6} {'fp':>6} "
+        f"{'fn':>6} {'precision':>9} {'recall':>6}"
+    )
+    for r in results:
+        print(
+            f"{r['threshold']:>9} {r['margin']:>6} {str(r['word_threshold']):>5} "
+            f"{r['tp']:>6} {r['fp']:>6} {r['fn']:>6} {r['precision']:>9.3f} "
+            f"{r['recall']:>6.3f}"
+        )
+
+
+def bench_ner_index(args):
+    rng = random.Random(args.seed)
+    configs = list(
+        itertools.product(args.thresholds, args.margins, [None] + args.word_thresholds)
+    )
+    datasets = {"builtin": builtin_dataset()}
+    if args.db:
+        datasets["database"] = db_dataset(
+            get_pg_conn_cfg(args.db), args.queries, args.holdout, rng
+        )
+
+    report = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": get_git_commit(),
+        "params": vars(args),
+    }
+    for name, (synonyms, ners, queries) in datasets.items():
+        results = evaluate(synonyms, ners, queries, configs)
+        print_results(name, len(queries), results)
+        report[name] = {
+            "synonyms": len(synonyms),
+            "queries": len(queries),
+            "negatives": sum(id_ner is None for _, _, id_ner in queries),
+            "results": results,
+        }
+
+    output = args.output or os.path.join(
+        "reports",
+        "benchmarks",
+        "ner_index_{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S")),
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    print(f"Info: results are written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--db", default=None, help="database with ner_synonyms")
+    parser.add_argument("--queries", type=int, default=2000, help="queries from --db")
+    parser.add_argument(
+        "--holdout", type=float, default=0.2, help="share of ners removed from index"
+    )
+    parser.add_argument(
+        "--thresholds", type=float, nargs="+", default=[0.5, 0.6, 0.65, 0.7, 0.8]
+    )
+    parser.add_argument("--margins", type=float, nargs="+", default=[0.05, 0.1])
+    parser.add_argument("--word-thresholds", type=float, nargs="+", default=[0.3, 0.5])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="json file of results")
+    args = parser.parse_args()
+    bench_ner_index(args)
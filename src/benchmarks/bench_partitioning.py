@@ -0,0 +1,220 @@
+"""Benchmark of monthly partitioning of news, news_summary and news_links
+(see partition_news.py) by EXPLAIN ANALYZE of queries of the app and of the
+pipelines before and after migration on seeded benchmark database:
+    news_in_range, nlinks_in_range, ners_in_range - prepared queries of the
+        app (as PgPool runs them) for date ranges ending at the last news
+    summary_candidates, ner_candidates - anti-joins of the pipelines (news
+        without summaries and links), the last --backlog news are left
+        without summaries and links before the run
+For each query the median of --repeat runs of execution time is reported
+with planning time, shared buffers and amount of scanned relations
+(partitions) of the plan.
+
+Results are written to json (params, environment, plans stats before and
+after), so runs can be compared over time.
+
+Run from cli (POSTGRES_* env as for pipelines, POSTGRES_DB is not used):
+    python src/benchmarks/bench_partitioning.py --links 5000000 --days 730
+    python src/benchmarks/bench_partitioning.py --no-seed --db news_bench
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+import platform
+from datetime import datetime, timedelta
+import numpy as np
+import psycopg2
+from src.app.db import QUERIES
+from src.benchmarks.seed_app_db import seed_app_db
+from src.benchmarks.synthetic_corpus import get_pg_conn_cfg
+from src.benchmarks.bench_pipeline import get_git_commit
+from src.data.partition_news import migrate_to_partitions
+
+APP_QUERIES = ["news_in_range", "nlinks_in_range", "ners_in_range"]
+
+
+def get_pipeline_queries():
+    """Candidates queries of the pipelines (modules are imported only for
+    queries, models are not loaded).
+
+    Returns:
+        dict: {name: query with placeholder %(id_news)s}
+    """
+    from src.models.summarization_pipeline import QUERY_NEWS_TO_SUMMARY_CANDIDATES
+    from src.models.ner_pipeline import QUERY_NEWS_TO_NER_CANDIDATES
+
+    return {
+        "summary_candidates": QUERY_NEWS_TO_SUMMARY_CANDIDATES,
+        "ner_candidates": QUERY_NEWS_TO_NER_CANDIDATES,
+    }
+
+
+def make_backlog(pg_conn_cfg, n_news):
+    """Remove links of the last n_news news and summaries of the last half
+    of them (backlog of the pipelines)."""
+    pg_con = psycopg2.connect(**pg_conn_cfg)
+    try:
+        pg_cur = pg_con.cursor()
+        pg_cur.execute(
+            """
+            DELETE FROM news_links
+            WHERE id_news IN (SELECT id_news FROM news
+                              ORDER BY id_news DESC LIMIT %(n)s);
+            DELETE FROM news_summary
+            WHERE id_news IN (SELECT id_news FROM news
+                              ORDER BY id_news DESC LIMIT %(n)s / 2);
+            """,
+            {"n": n_news},
+        )
+        pg_con.commit()
+        pg_con.autocommit = True
+        pg_cur.execute("ANALYZE news_summary, news_links;")
+        pg_cur.close()
+    finally:
+        pg_con.close()
+
+
+def plan_stats(plan):
+    """Stats of plan of EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)"""
+    relations, nodes = set(), [plan["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        if "Relation Name" in node:
+            relations.add(node["Relation Name"])
+        nodes.extend(node.get("Plans", []))
+    return {
+        "execution_ms": plan["Execution Time"],
+        "planning_ms": plan["Planning Time"],
+        "shared_blocks": plan["Plan"]["Shared Hit Blocks"]
+        + plan["Plan"]["Shared Read Blocks"],
+        "relations": len(relations),
+    }
+
+
+def explain(pg_cur, query, params, repeat):
+    """EXPLAIN ANALYZE query repeat times.
+
+    Returns:
+        dict: stats of the last plan with median execution time
+    """
+    runs = []
+    for _ in range(repeat):
+        pg_cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+        runs.append(plan_stats(pg_cur.fetchone()[0][0]))
+    stats = runs[-1]
+    stats["execution_ms"] = round(
+        float(np.median([r["execution_ms"] for r in runs])), 3
+    )
+    return stats
+
+
+def bench_queries(pg_conn_cfg, args):
+    """Explain queries of the app (for each range of args.ranges) and of the
+    pipelines.
+
+    Returns:
+        list: dicts(query, range_days, stats of plan)
+    """
+    results = []
+    pg_con = psycopg2.connect(**pg_conn_cfg)
+    try:
+        pg_cur = pg_con.cursor()
+        # the last news of --backlog have no links
+        pg_cur.execute("SELECT MAX(news_date) FROM news_links;")
+        date_max = pg_cur.fetchone()[0]
+        for name in APP_QUERIES:
+            sql, n_params = QUERIES[name]
+            pg_cur.execute(f"PREPARE {name} AS {sql};")
+            for range_days in args.ranges:
+                params = (date_max - timedelta(days=range_days), date_max)
+                stats = explain(pg_cur, f"EXECUTE {name}(%s, %s)", params, args.repeat)
+                results.append({"query": name, "range_days": range_days, **stats})
+            pg_cur.execute(f"DEALLOCATE {name};")
+
+        for name, sql in get_pipeline_queries().items():
+            stats = explain(pg_cur, sql, {"id_news": None}, args.repeat)
+            results.append({"query": name, "range_days": None, **stats})
+        pg_cur.close()
+    finally:
+        pg_con.close()
+    return results
+
+
+def print_comparison(before, after):
+    print(
+        f"{'query':<20} {'days':>4} {'before ms':>10} {'after ms':>10} "
+        f"{'speedup':>7} {'rels':>9} {'blocks':>17}"
+    )
+    for b, a in zip(before, after):
+        print(
+            f"{b['query']:<20} {b['range_days'] or '':>4} {b['execution_ms']:>10.2f} "
+            f"{a['execution_ms']:>10.2f} "
+            f"{b['execution_ms'] / max(a['execution_ms'], 1e-3):>6.1f}x "
+            f"{b['relations']:>4}/{a['relations']:<4} "
+            f"{b['shared_blocks']:>8}/{a['shared_blocks']:<8}"
+        )
+
+
+def bench_partitioning(args):
+    pg_conn_cfg = get_pg_conn_cfg(args.db)
+    seeded = None
+    if not args.no_seed:
+        seeded = seed_app_db(pg_conn_cfg, args.links, args.days, schema=args.schema)
+        make_backlog(pg_conn_cfg, args.backlog)
+
+    before = bench_queries(pg_conn_cfg, args)
+    migrate_to_partitions(pg_conn_cfg, months_ahead=args.months_ahead)
+    after = bench_queries(pg_conn_cfg, args)
+    print_comparison(before, after)
+
+    report = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": get_git_commit(),
+        "params": vars(args),
+        "environment": {
+            "host": socket.gethostname(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "seeded": seeded,
+        "before": before,
+        "after": after,
+    }
+    output = args.output or os.path.join(
+        "reports",
+        "benchmarks",
+        "partitioning_{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S")),
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    print(f"Info: results are written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--db", default="news_bench", help="benchmark database")
+    parser.add_argument("--links", type=int, default=5000000)
+    parser.add_argument(
+        "--no-seed", action="store_true", help="use seeded (unpartitioned) --db"
+    )
+    parser.add_argument("--days", type=int, default=730, help="date range of data")
+    parser.add_argument(
+        "--ranges", type=int, nargs="+", default=[1, 7, 30], help="days of query"
+    )
+    parser.add_argument(
+        "--backlog", type=int, default=1000, help="news without links (seeding)"
+    )
+    parser.add_argument("--months-ahead", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--schema", default=None, help="sql script of schema (default - project)"
+    )
+    parser.add_argument("--output", default=None, help="json file of results")
+    args = parser.parse_args()
+    bench_partitioning(args)
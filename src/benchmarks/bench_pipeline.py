@@ -0,0 +1,247 @@
+"""Benchmark of ml-pipeline stages on synthetic corpus: the corpus is loaded
+to benchmark database (recreated with the project schema), then stages are
+run one by one with timing and peak memory:
+    load - loading of corpus to database
+    summarization - summarization_pipeline
+    ner_extraction - get_norm_ners_from_news
+    entity_linking - entity_linking (with stub of wikidata API)
+    ner_write - write_db_results_ner_pipeline
+    update_names - update_main_ner_names_and_types
+If summarization stage is not selected, summaries of the corpus are loaded.
+
+Peak memory is measured by tracemalloc (python allocations only, slows down
+pure python code, disable by --no-tracemalloc) and by max RSS of process.
+Results are written to json (params, environment, stages), so runs can be
+compared over time.
+
+Run from cli (POSTGRES_* env as for pipelines, POSTGRES_DB is not used):
+    python src/benchmarks/bench_pipeline.py --news 1000 --entities 500
+    python src/benchmarks/bench_pipeline.py --news 200 --stages load \
+ner_extraction entity_linking ner_write update_names --wikidata-latency 0.05
+"""
+import os
+import gc
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import resource
+import subprocess
+import tracemalloc
+from datetime import datetime
+from src import common_funcs
+from src.common_funcs import claim_news
+from src.benchmarks.synthetic_corpus import (
+    gen_corpus,
+    create_bench_db,
+    load_corpus,
+    default_schema_path,
+    get_pg_conn_cfg,
+)
+from src.benchmarks.wikidata_stub import start_wikidata_stub
+
+STAGES = [
+    "load",
+    "summarization",
+    "ner_extraction",
+    "entity_linking",
+    "ner_write",
+    "update_names",
+]
+
+
+def max_rss_mb():
+    # ru_maxrss in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stage(results, stage, n_items, func, *args, trace_memory=True):
+    """Run func(*args), append timing and memory of stage to results.
+
+    Returns:
+        result of func
+    """
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    peak_mb = None
+    if trace_memory:
+        peak_mb = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        tracemalloc.stop()
+
+    results.append(
+        {
+            "stage": stage,
+            "items": n_items,
+            "seconds": round(seconds, 4),
+            "items_per_second": round(n_items / seconds, 2) if seconds > 0 else None,
+            "tracemalloc_peak_mb": peak_mb,
+            "max_rss_mb": round(max_rss_mb(), 2),
+        }
+    )
+    print(
+        f"Info: stage {stage}: {n_items} items, {seconds:.3f} s, "
+        f"tracemalloc peak {peak_mb} MB, max rss {max_rss_mb():.0f} MB"
+    )
+    return result
+
+
+def run_ner_stages(pg_conn_cfg, stages, n_news, results, trace_memory):
+    """Run selected stages of the ner-pipeline (stages depend on previous)."""
+    # ner-pipeline (stanza, natasha) is imported only if its stages are run
+    from src.models import ner_pipeline
+
+    claimed = claim_news(
+        pg_conn_cfg,
+        ner_pipeline.CLAIM_STAGE,
+        ner_pipeline.QUERY_NEWS_TO_NER_CANDIDATES,
+        {"id_news": None},
+        n_news,
+        ner_pipeline.CLAIM_LEASE,
+    )
+    news_to_ner = ner_pipeline.select_news_to_ner_pip(pg_conn_cfg, claimed)
+    n_items = len(news_to_ner)
+
+    synonyms = run_stage(
+        results,
+        "ner_extraction",
+        n_items,
+        ner_pipeline.get_norm_ners_from_news,
+        news_to_ner,
+        trace_memory=trace_memory,
+    )
+    if "entity_linking" in stages:
+        synonyms = run_stage(
+            results,
+            "entity_linking",
+            n_items,
+            ner_pipeline.entity_linking,
+            pg_conn_cfg,
+            synonyms,
+            trace_memory=trace_memory,
+        )
+    if "ner_write" in stages:
+        run_stage(
+            results,
+            "ner_write",
+            n_items,
+            ner_pipeline.write_db_results_ner_pipeline,
+            pg_conn_cfg,
+            synonyms,
+            claimed,
+            trace_memory=trace_memory,
+        )
+    if "update_names" in stages:
+        run_stage(
+            results,
+            "update_names",
+            n_items,
+            ner_pipeline.update_main_ner_names_and_types,
+            pg_conn_cfg,
+            trace_memory=trace_memory,
+        )
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_pipeline(args):
+    pg_conn_cfg = get_pg_conn_cfg(args.db)
+    results = []
+    trace_memory = not args.no_tracemalloc
+
+    # wikidata stub for entity linking
+    server, common_funcs.URL_WIKIDATA_API = start_wikidata_stub(
+        hit_rate=args.wikidata_hit_rate, latency=args.wikidata_latency
+    )
+
+    df_corpus = gen_corpus(
+        args.news, args.entities, args.entity_density, args.days, seed=args.seed
+    )
+    create_bench_db(pg_conn_cfg, args.schema or default_schema_path())
+    run_stage(
+        results,
+        "load",
+        len(df_corpus),
+        load_corpus,
+        pg_conn_cfg,
+        df_corpus,
+        "summarization" not in args.stages,
+        trace_memory=trace_memory,
+    )
+
+    if "summarization" in args.stages:
+        from src.models.summarization_pipeline import summarization_pipeline
+
+        run_stage(
+            results,
+            "summarization",
+            len(df_corpus),
+            summarization_pipeline,
+            pg_conn_cfg,
+            trace_memory=trace_memory,
+        )
+
+    if "ner_extraction" in args.stages:
+        run_ner_stages(pg_conn_cfg, args.stages, len(df_corpus), results, trace_memory)
+
+    server.shutdown()
+
+    report = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": get_git_commit(),
+        "params": vars(args),
+        "environment": {
+            "host": socket.gethostname(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "stages": results,
+    }
+    output = args.output or os.path.join(
+        "reports",
+        "benchmarks",
+        "pipeline_{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S")),
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Info: results are written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--db", default="news_bench", help="benchmark database")
+    parser.add_argument("--news", type=int, default=1000)
+    parser.add_argument("--entities", type=int, default=1000)
+    parser.add_argument(
+        "--entity-density", type=float, default=3.0, help="mean mentions per news"
+    )
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--wikidata-hit-rate", type=float, default=0.8)
+    parser.add_argument(
+        "--wikidata-latency", type=float, default=0.0, help="seconds per request"
+    )
+    parser.add_argument(
+        "--schema", default=None, help="sql script of schema (default - project)"
+    )
+    parser.add_argument("--no-tracemalloc", action="store_true")
+    parser.add_argument("--output", default=None, help="json file of results")
+    args = parser.parse_args()
+    bench_pipeline(args)
@@ -0,0 +1,100 @@
+"""Benchmark of payload size and serialization time of /data response formats
+on the default query ("Россия", 14 days, graph_depth 2, min_news_count 4)
+over synthetic data.
+
+Run from cli:
+    python src/benchmarks/bench_wire_format.py
+"""
+import json
+import time
+import argparse
+from src.app.graph_engine import links_to_triplets
+from src.app.wire_format import (
+    GRAPH_FORMATS,
+    CONTENT_TYPE_JSON,
+    CONTENT_TYPE_MSGPACK,
+    graph_to_format,
+    serialize,
+    compress,
+    msgpack,
+    brotli,
+)
+from src.benchmarks.synthetic import gen_news_links, gen_news
+
+
+def timeit(func, repeat=5):
+    """Return (best time in seconds, result of last call)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func()
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+
+def main(n_days, news_per_day, input_ner, graph_depth, min_news_count):
+    df_nlinks = gen_news_links(n_days, news_per_day=news_per_day)
+    df_news = gen_news(df_nlinks.id_news.values, n_days)
+    df_ners = df_nlinks.drop_duplicates("id_ner").set_index("id_ner")[
+        ["ner_name", "ner_type"]
+    ]
+    df_triples, news_texts = links_to_triplets(
+        df_news,
+        df_nlinks[["id_news", "id_ner"]],
+        df_ners,
+        input_ner,
+        graph_depth,
+        min_news_count,
+    )
+    print(
+        f"Graph: {len(df_triples)} edges, {len(news_texts)} news, "
+        f"{df_triples.amount.sum()} news in edges"
+    )
+
+    content_types = [CONTENT_TYPE_JSON]
+    if msgpack is not None:
+        content_types.append(CONTENT_TYPE_MSGPACK)
+    encodings = ["identity", "gzip"] + (["br"] if brotli is not None else [])
+
+    print(f"{'format':<32} {'encoding':<9} {'size, KB':>9} {'time, ms':>9}")
+
+    # previous response: node_link by flask jsonify (ascii json, sorted keys)
+    t_format, data = timeit(
+        lambda: graph_to_format(df_triples, news_texts, "node_link")
+    )
+    t_dumps, payload = timeit(
+        lambda: json.dumps(
+            data, ensure_ascii=True, sort_keys=True, separators=(",", ":")
+        ).encode()
+    )
+    for encoding in encodings:
+        t_compress, res = timeit(lambda: compress(payload, encoding))
+        print(
+            f"{'node_link, jsonify (before)':<32} {encoding:<9} "
+            f"{len(res) / 1024:>9.1f} {(t_format + t_dumps + t_compress) * 1000:>9.1f}"
+        )
+
+    for graph_format in GRAPH_FORMATS:
+        t_format, data = timeit(
+            lambda: graph_to_format(df_triples, news_texts, graph_format)
+        )
+        for content_type in content_types:
+            t_dumps, payload = timeit(lambda: serialize(data, content_type))
+            for encoding in encodings:
+                t_compress, res = timeit(lambda: compress(payload, encoding))
+                name = f"{graph_format}, {content_type.split('/')[1]}"
+                print(
+                    f"{name:<32} {encoding:<9} {len(res) / 1024:>9.1f} "
+                    f"{(t_format + t_dumps + t_compress) * 1000:>9.1f}"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--news-per-day", type=int, default=500)
+    parser.add_argument("--ner", default="Россия")
+    parser.add_argument("--graph-depth", type=int, default=2)
+    parser.add_argument("--min-news-count", type=int, default=4)
+    args = parser.parse_args()
+    main(args.days, args.news_per_day, args.ner, args.graph_depth, args.min_news_count)
@@ -0,0 +1,106 @@
+"""Benchmark of work claiming by several local worker processes (replicas of
+ml-pipelines) against one postgres: each worker claims batches of news by
+claim_news and "processes" them (sleep), one worker crashes after its first
+claim (its news are claimed by other workers after lease expiry). Checks that
+every news is processed exactly once and reports throughput.
+
+Claims of the benchmark stage are deleted at the end (news are not changed).
+
+Run from cli (POSTGRES_* env as for pipelines):
+    python src/benchmarks/bench_work_claims.py --workers 1 4 --news 5000
+"""
+import os
+import time
+import argparse
+import multiprocessing
+from collections import Counter
+from src.common_funcs import claim_news, safe_pg_write_query
+
+STAGE = "bench"
+QUERY_CANDIDATES = """
+SELECT id_news FROM news
+WHERE id_news IN (SELECT id_news FROM news ORDER BY id_news LIMIT %(news)s)
+"""
+
+
+def get_pg_conn_cfg():
+    pg_conn_cfg = {
+        "dbname": os.environ.get("POSTGRES_DB"),
+        "user": os.environ.get("POSTGRES_USER"),
+        "host": os.environ.get("POSTGRES_HOST"),
+        "port": os.environ.get("POSTGRES_PORT"),
+    }
+    with open(os.environ.get("POSTGRES_PASSWORD_FILE"), "r") as f:
+        pg_conn_cfg["password"] = f.readlines()[0].rstrip("\n")
+    return pg_conn_cfg
+
+
+def worker(n_news, batch_size, work_time, crash, results):
+    """Claim and process news until there are no news to claim."""
+    pg_conn_cfg = get_pg_conn_cfg()
+    processed = []
+    # claims of the crashing worker expire in 1 s, of others - after benchmark
+    lease = 1 if crash else 3600
+    while True:
+        claimed = claim_news(
+            pg_conn_cfg, STAGE, QUERY_CANDIDATES, {"news": n_news}, batch_size, lease
+        )
+        if len(claimed) == 0 or crash:
+            break
+        time.sleep(work_time * len(claimed))
+        processed.extend(claimed)
+    results.put(processed)
+
+
+def run(n_workers, n_news, batch_size, work_time):
+    """Run workers (+1 crashing worker), return (duration, Counter of ids)"""
+    ctx = multiprocessing.get_context("spawn")  # own WORKER_ID in each process
+    results = ctx.Queue()
+    crashed = ctx.Process(target=worker, args=(n_news, batch_size, 0, True, results))
+    crashed.start()
+    crashed.join()
+    results.get()
+
+    start = time.perf_counter()
+    workers = [
+        ctx.Process(target=worker, args=(n_news, batch_size, work_time, False, results))
+        for _ in range(n_workers)
+    ]
+    for process in workers:
+        process.start()
+    processed = Counter()
+    for _ in workers:
+        processed.update(results.get())
+    for process in workers:
+        process.join()
+    return time.perf_counter() - start, processed
+
+
+def main(workers, n_news, batch_size, work_time):
+    pg_conn_cfg = get_pg_conn_cfg()
+    for n_workers in workers:
+        safe_pg_write_query(
+            pg_conn_cfg, "DELETE FROM work_claims WHERE stage = %s;", (STAGE,)
+        )
+        duration, processed = run(n_workers, n_news, batch_size, work_time)
+        duplicates = sum(count - 1 for count in processed.values())
+        print(
+            f"workers: {n_workers}, news processed: {len(processed)}, "
+            f"duplicates: {duplicates}, time: {duration:.2f} s, "
+            f"throughput: {len(processed) / duration:.0f} news/s"
+        )
+    safe_pg_write_query(
+        pg_conn_cfg, "DELETE FROM work_claims WHERE stage = %s;", (STAGE,)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--news", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument(
+        "--work-time", type=float, default=0.001, help="seconds of work per news"
+    )
+    args = parser.parse_args()
+    main(args.workers, args.news, args.batch_size, args.work_time)
@@ -0,0 +1,145 @@
+"""Load test of the running app: concurrent users, each user posts graph query
+to "/" (random ner and date range) and gets graph from "/data".
+Latency of "/data" (p50/p95/p99) and throughput (graph queries per second)
+are reported for each amount of users, results can be written to json.
+
+To load the db (not the graph cache), run the app with GRAPH_CACHE_MAXSIZE=0
+and GRAPH_STORE_DAYS=0. For the database seeded by seed_app_db use
+--date-max 2022-10-27 and ners of synthetic data (e.g. "Россия,Сущность 2").
+
+Run from cli (app is running on localhost:5000):
+    python src/benchmarks/load_test_app.py --users 8 --requests 20
+    python src/benchmarks/load_test_app.py --users 1 4 16 32 --requests 20 \
+--date-max 2022-10-27 --ners "Россия,Сущность 2,Сущность 10"
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+import requests
+
+
+def user_loop(url, ners, max_days, n_requests, seed, latencies, errors, now=None):
+    """One user: n_requests of (post query, get graph) in own session."""
+    rnd = random.Random(seed)
+    session = requests.Session()
+    now = now or datetime.now()
+    for _ in range(n_requests):
+        date_max = now - timedelta(days=rnd.randint(0, max_days))
+        date_min = date_max - timedelta(days=rnd.randint(1, max_days))
+        form = {
+            "input_ner": rnd.choice(ners),
+            "date_min": date_min.strftime("%Y-%m-%d"),
+            "date_max": date_max.strftime("%Y-%m-%d"),
+            "graph_depth": rnd.randint(1, 3),
+            "min_news_count": rnd.randint(1, 4),
+        }
+        try:
+            session.post(url + "/", data=form).raise_for_status()
+            start = time.perf_counter()
+            response = session.get(url + "/data", headers={"Accept-Encoding": "gzip"})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except requests.RequestException as error:
+            errors.append(str(error))
+
+
+def run_users(url, users, n_requests, ners, max_days, now=None):
+    """Run concurrent users.
+
+    Returns:
+        dict: amount of requests and errors, throughput and latency percentiles
+    """
+    latencies, errors = [], []
+    threads = [
+        threading.Thread(
+            target=user_loop,
+            args=(url, ners, max_days, n_requests, seed, latencies, errors, now),
+        )
+        for seed in range(users)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    result = {
+        "users": users,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": round(duration, 3),
+        "rps": round(len(latencies) / duration, 2),
+    }
+    print(f"users: {users}, requests: {len(latencies)}, errors: {len(errors)}")
+    if len(latencies) > 0:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        result.update(
+            p50_ms=round(p50, 1),
+            p95_ms=round(p95, 1),
+            p99_ms=round(p99, 1),
+            max_ms=round(max(latencies) * 1000, 1),
+        )
+        print(
+            f"rps: {result['rps']:.1f}, "
+            f"p50: {p50:.0f} ms, p95: {p95:.0f} ms, p99: {p99:.0f} ms, "
+            f"max: {result['max_ms']:.0f} ms"
+        )
+    for error in errors[:5]:
+        print("Error:", error)
+    return result
+
+
+def main(url, users_list, n_requests, ners, max_days, date_max=None, output=None):
+    now = datetime.strptime(date_max, "%Y-%m-%d") if date_max else None
+    results = [
+        run_users(url, users, n_requests, ners, max_days, now) for users in users_list
+    ]
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(
+                {
+                    "date": datetime.now().isoformat(timespec="seconds"),
+                    "url": url,
+                    "requests_per_user": n_requests,
+                    "ners": ners,
+                    "max_days": max_days,
+                    "date_max": date_max,
+                    "runs": results,
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+        print(f"Info: results are written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument(
+        "--users", type=int, nargs="+", default=[8], help="amounts of users"
+    )
+    parser.add_argument("--requests", type=int, default=20, help="per user")
+    parser.add_argument("--ners", default="Россия,Путин,")
+    parser.add_argument("--max-days", type=int, default=30)
+    parser.add_argument(
+        "--date-max", default=None, help="YYYY-MM-DD, last date of data (default now)"
+    )
+    parser.add_argument("--output", default=None, help="json file of results")
+    args = parser.parse_args()
+    main(
+        args.url,
+        args.users,
+        args.requests,
+        args.ners.split(","),
+        args.max_days,
+        args.date_max,
+        args.output,
+    )
@@ -0,0 +1,160 @@
+"""Seeding of benchmark database for the app with synthetic news, ners and
+news_links (see gen_news_links in synthetic module) of the given amount of
+links (from 10k to millions). The database is recreated with the project
+schema, tables are loaded by COPY and analyzed.
+
+Ner "Россия" is the most popular ner (id_ner 1), other ners are named
+"Сущность <id_ner>", each ner has one synonym (its name) for search of the app.
+News dates end at 2022-10-27.
+
+Run from cli (POSTGRES_* env as for pipelines, POSTGRES_DB is not used):
+    python src/benchmarks/seed_app_db.py --links 1000000 --days 365
+Then run the app on the database (without cache and in-memory store, so each
+query goes to db):
+    POSTGRES_DB=news_bench GRAPH_CACHE_MAXSIZE=0 GRAPH_STORE_DAYS=0 \
+python src/app/app.py
+"""
+import io
+import time
+import argparse
+import psycopg2
+from src.benchmarks.synthetic import gen_news_links, gen_news
+from src.benchmarks.synthetic_corpus import (
+    create_bench_db,
+    default_schema_path,
+    get_pg_conn_cfg,
+)
+
+# mean amount of (unique) links per news of gen_news_links with
+# max_ners_per_news=6
+LINKS_PER_NEWS = 3.15
+NER_TYPE_IDS = {"PER": 1, "LOC": 2, "ORG": 3, "MISC": 4}
+
+
+def gen_app_data(n_links, n_days=365, n_ners=20000, seed=0):
+    """Generate synthetic data for the app with about n_links links.
+
+    Returns:
+        tuple(df_nlinks, df_news): see gen_news_links and gen_news
+    """
+    news_per_day = max(1, round(n_links / (n_days * LINKS_PER_NEWS)))
+    df_nlinks = gen_news_links(n_days, news_per_day, n_ners, seed=seed)
+    df_news = gen_news(df_nlinks.id_news.values, n_days, seed=seed)
+    return df_nlinks, df_news
+
+
+def copy_df(pg_cur, df, table, columns):
+    """Load columns of df to table by COPY (csv in memory)."""
+    buf = io.StringIO()
+    df[columns].to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    pg_cur.copy_expert(
+        f"COPY {table}({', '.join(columns)}) FROM STDIN WITH (FORMAT csv);", buf
+    )
+
+
+def load_app_data(pg_conn_cfg, df_nlinks, df_news):
+    """Load synthetic data to tables news, news_summary, ner, ner_synonyms and
+    news_links (serial sequences are moved after loaded ids), analyze tables.
+    """
+    df_ners = df_nlinks.drop_duplicates("id_ner")[["id_ner", "ner_name", "ner_type"]]
+    df_ners = df_ners.assign(
+        id_ner_type=df_ners.ner_type.map(NER_TYPE_IDS), ner_synonym=df_ners.ner_name
+    )
+    df_news = df_news.reset_index().assign(
+        news_text=lambda df: df.summary_text,
+        news_source="synthetic",
+        date_collected=lambda df: df.news_date,
+        date_generated=lambda df: df.news_date,
+        id_model=1,
+    )
+    df_nlinks = df_nlinks.assign(
+        news_date=df_nlinks.id_news.map(df_news.set_index("id_news").news_date)
+    )
+
+    pg_con = psycopg2.connect(**pg_conn_cfg)
+    try:
+        pg_cur = pg_con.cursor()
+        copy_df(pg_cur, df_ners, "ner", ["id_ner", "ner_name", "id_ner_type"])
+        copy_df(pg_cur, df_ners, "ner_synonyms", ["id_ner", "ner_synonym"])
+        copy_df(
+            pg_cur,
+            df_news,
+            "news",
+            ["id_news", "news_text", "news_date", "news_source", "date_collected"],
+        )
+        copy_df(
+            pg_cur,
+            df_news,
+            "news_summary",
+            ["id_news", "news_date", "date_generated", "summary_text", "id_model"],
+        )
+        copy_df(pg_cur, df_nlinks, "news_links", ["id_news", "news_date", "id_ner"])
+        pg_cur.execute(
+            """
+            SELECT setval('news_id_news_seq', (SELECT MAX(id_news) FROM news));
+            SELECT setval('ner_id_ner_seq', (SELECT MAX(id_ner) FROM ner));
+            """
+        )
+        pg_con.commit()
+
+        pg_con.autocommit = True
+        pg_cur.execute("ANALYZE news, news_summary, ner, ner_synonyms, news_links;")
+        pg_cur.close()
+    finally:
+        pg_con.close()
+
+
+def seed_app_db(pg_conn_cfg, n_links, n_days=365, n_ners=20000, schema=None, seed=0):
+    """(Re)create benchmark database and load synthetic data with about
+    n_links links.
+
+    Returns:
+        dict: amount of news, ners and links, time of generation and loading
+    """
+    start = time.perf_counter()
+    df_nlinks, df_news = gen_app_data(n_links, n_days, n_ners, seed)
+    gen_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    create_bench_db(pg_conn_cfg, schema or default_schema_path())
+    load_app_data(pg_conn_cfg, df_nlinks, df_news)
+    load_seconds = time.perf_counter() - start
+
+    info = {
+        "links": len(df_nlinks),
+        "news": len(df_news),
+        "ners": int(df_nlinks.id_ner.nunique()),
+        "days": n_days,
+        "gen_seconds": round(gen_seconds, 2),
+        "load_seconds": round(load_seconds, 2),
+    }
+    print(
+        f"Info: {pg_conn_cfg['dbname']} is seeded: {info['links']} links, "
+        f"{info['news']} news, {info['ners']} ners ({gen_seconds:.1f} s generation, "
+        f"{load_seconds:.1f} s loading)"
+    )
+    return info
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--db", default="news_bench", help="benchmark database")
+    parser.add_argument("--links", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--ners", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--schema", default=None, help="sql script of schema (default - project)"
+    )
+    args = parser.parse_args()
+    seed_app_db(
+        get_pg_conn_cfg(args.db),
+        args.links,
+        args.days,
+        args.ners,
+        args.schema,
+        args.seed,
+    )
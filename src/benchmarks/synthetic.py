@@ -0,0 +1,65 @@
+"""Module for generation of synthetic data for benchmarks."""
+import numpy as np
+import pandas as pd
+
+
+def gen_news_links(
+    n_days, news_per_day=500, n_ners=20000, max_ners_per_news=6, zipf_a=1.3, seed=0
+):
+    """Generate synthetic news_links table (ner popularity has zipf distribution,
+    "Россия" is the most popular ner).
+
+    Args:
+        n_days (int): date range of news (in days)
+        news_per_day (int): amount of news per day
+        n_ners (int): amount of different ners
+        max_ners_per_news (int): max amount of ners in one news
+        zipf_a (float): parameter of zipf distribution of ners popularity
+        seed (int): random seed
+
+    Returns:
+        pd.DataFrame: with columns id_news, id_ner, ner_name, ner_type
+    """
+    rng = np.random.default_rng(seed)
+    n_news = n_days * news_per_day
+
+    ners_per_news = rng.integers(1, max_ners_per_news + 1, size=n_news)
+    id_news = np.repeat(np.arange(1, n_news + 1), ners_per_news)
+
+    # ner ranks by zipf distribution (rank 1 is the most popular)
+    id_ner = rng.zipf(zipf_a, size=len(id_news))
+    id_ner[id_ner > n_ners] = rng.integers(1, n_ners + 1, (id_ner > n_ners).sum())
+
+    df_nlinks = pd.DataFrame({"id_news": id_news, "id_ner": id_ner})
+    df_nlinks = df_nlinks.drop_duplicates(ignore_index=True)
+
+    ner_names = np.array(["Россия"] + [f"Сущность {i}" for i in range(2, n_ners + 1)])
+    ner_types = np.array(["PER", "LOC", "ORG", "MISC"])[rng.integers(0, 4, n_ners)]
+    df_nlinks["ner_name"] = ner_names[df_nlinks.id_ner.values - 1]
+    df_nlinks["ner_type"] = ner_types[df_nlinks.id_ner.values - 1]
+
+    return df_nlinks
+
+
+def gen_news(id_news, n_days, seed=0):
+    """Generate synthetic news table for news ids (news dates are uniform
+    in the date range).
+
+    Returns:
+        pd.DataFrame: with index id_news and columns summary_text, news_date
+    """
+    rng = np.random.default_rng(seed)
+    id_news = np.unique(id_news)
+    date_max = pd.Timestamp("2022-10-27")
+    news_date = date_max - pd.to_timedelta(
+        np.sort(rng.integers(0, n_days * 24 * 3600, len(id_news)))[::-1], unit="s"
+    )
+    return pd.DataFrame(
+        {
+            "summary_text": [
+                f"Синтетическая сводка новости номер {i}" for i in id_news
+            ],
+            "news_date": news_date,
+        },
+        index=pd.Index(id_news, name="id_news"),
+    )
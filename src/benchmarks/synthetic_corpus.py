@@ -0,0 +1,271 @@
+"""Module for generation of synthetic russian news corpus for benchmarks of
+ml-pipelines and its loading to database with the project schema.
+
+News are generated from templates of sentences with mentions of entities
+(persons, locations, organizations), popularity of entities has zipf
+distribution, amount of entities in news is set by entity density.
+"""
+import os
+import psycopg2
+import numpy as np
+import pandas as pd
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+# fmt: off
+FIRST_NAMES_MALE = [
+    "Владимир", "Алексей", "Сергей", "Дмитрий", "Игорь", "Павел", "Андрей",
+    "Михаил", "Николай", "Олег", "Юрий", "Виктор",
+]
+FIRST_NAMES_FEMALE = ["Мария", "Ольга", "Анна", "Елена", "Наталья", "Ирина"]
+SURNAMES = [
+    "Иванов", "Петров", "Смирнов", "Кузнецов", "Соколов", "Попов", "Лебедев",
+    "Козлов", "Новиков", "Морозов", "Волков", "Соловьев", "Васильев", "Зайцев",
+    "Павлов", "Семенов", "Голубев", "Виноградов", "Богданов", "Воробьев",
+]
+LOCATIONS = [
+    "Россия", "Москва", "Санкт-Петербург", "Казань", "Новосибирск", "Украина",
+    "Киев", "США", "Вашингтон", "Китай", "Пекин", "Германия", "Берлин",
+    "Франция", "Париж", "Турция", "Анкара", "Индия", "Япония", "Токио",
+    "Белоруссия", "Минск", "Казахстан", "Астана", "Крым", "Сибирь", "Европа",
+]
+ORGANIZATIONS = [
+    "Газпром", "Сбербанк", "Роскосмос", "Минобороны", "МИД", "ООН", "НАТО",
+    "Евросоюз", "Центробанк", "Госдума", "Совет Федерации", "Росстат",
+    "Аэрофлот", "РЖД", "МВФ", "ВОЗ", "ОПЕК", "Яндекс", "Лукойл", "Роснефть",
+]
+SYLLABLES = ["ал", "бер", "вин", "гор", "дар", "ель", "зар", "кам", "лес", "мир",
+             "нов", "ор", "пол", "рад", "сев", "тор", "ур", "фен", "хол", "яр"]
+# fmt: on
+SOURCES = ["news_channel_a", "news_channel_b", "news_channel_c", "news_channel_d"]
+
+TEMPLATES = {
+    # sentences with one, two or three entities (in nominative case)
+    1: [
+        "{0} заявил о необходимости новых мер поддержки.",
+        "Как сообщает {0}, решение будет принято в ближайшее время.",
+        "{0}: ситуация остается под контролем.",
+        "Представитель {0} прокомментировал последние события.",
+    ],
+    2: [
+        "{0} и {1} договорились о расширении сотрудничества.",
+        "{0} провел переговоры, передает {1}.",
+        "{0} обвинил {1} в нарушении договоренностей.",
+    ],
+    3: [
+        "{0}, {1} и {2} подписали совместное заявление.",
+        "{0} обсудил с {1} ситуацию, сообщает {2}.",
+    ],
+}
+FILLERS = [
+    "Подробности пока не сообщаются.",
+    "Эксперты оценивают последствия решения.",
+    "Ситуация остается напряженной.",
+    "Информация уточняется.",
+    "Официальные лица от комментариев отказались.",
+]
+EMOJIS = ["⚡️", "❗️", "🌏", "🔥", ""]
+
+
+def gen_entities(n_entities, seed=0):
+    """Generate list of tuples(name, ner_type), real names first, then
+    synthetic names (for large pools)."""
+    rng = np.random.default_rng(seed)
+    persons = [f"{first} {last}" for first in FIRST_NAMES_MALE for last in SURNAMES]
+    persons += [f"{first} {last}а" for first in FIRST_NAMES_FEMALE for last in SURNAMES]
+    rng.shuffle(persons)
+    entities = [(name, "LOC") for name in LOCATIONS]
+    entities += [(name, "ORG") for name in ORGANIZATIONS]
+    entities += [(name, "PER") for name in persons]
+
+    i = 0
+    while len(entities) < n_entities:
+        word = "".join(rng.choice(SYLLABLES, 3)).capitalize()
+        ner_type = ["PER", "LOC", "ORG"][i % 3]
+        if ner_type == "PER":
+            name = f"{rng.choice(FIRST_NAMES_MALE)} {word}ов"
+        elif ner_type == "LOC":
+            name = f"{word}ск"
+        else:
+            name = f"{word}пром"
+        entities.append((name, ner_type))
+        i += 1
+
+    # shuffle in windows of ~50 entities, so the most popular entities (by
+    # zipf) are of all types, but mostly real names
+    order = np.argsort(rng.random(len(entities)) + np.arange(len(entities)) / 50)
+    return [entities[i] for i in order[:n_entities]]
+
+
+def gen_corpus(
+    n_news,
+    n_entities=1000,
+    entity_density=3.0,
+    n_days=30,
+    zipf_a=1.3,
+    seed=0,
+):
+    """Generate synthetic news corpus.
+
+    Args:
+        n_news (int): amount of news
+        n_entities (int): amount of different entities
+        entity_density (float): mean amount of entity mentions in news
+        n_days (int): date range of news (in days)
+        zipf_a (float): parameter of zipf distribution of entities popularity
+        seed (int): random seed
+
+    Returns:
+        pd.DataFrame: with columns news_text, summary_text, news_date,
+                      news_source, date_collected
+    """
+    rng = np.random.default_rng(seed)
+    entities = gen_entities(n_entities, seed)
+    names = np.array([name for name, _ in entities])
+
+    n_mentions = rng.poisson(entity_density, n_news)
+    texts, summaries = [], []
+    for n in n_mentions:
+        ranks = rng.zipf(zipf_a, n)
+        ranks[ranks > n_entities] = rng.integers(
+            1, n_entities + 1, (ranks > n_entities).sum()
+        )
+        mentions = list(names[ranks - 1])
+
+        sentences = []
+        while len(mentions) > 0:
+            k = int(min(len(mentions), rng.integers(1, 4)))
+            template = TEMPLATES[k][rng.integers(len(TEMPLATES[k]))]
+            sentences.append(template.format(*mentions[:k]))
+            mentions = mentions[k:]
+        n_fillers = rng.integers(1, 3) if len(sentences) > 0 else rng.integers(2, 4)
+        sentences += list(rng.choice(FILLERS, n_fillers, replace=False))
+
+        texts.append(rng.choice(EMOJIS) + " ".join(sentences))
+        summaries.append(sentences[0])
+
+    date_max = pd.Timestamp.now().floor("s")
+    news_date = date_max - pd.to_timedelta(
+        np.sort(rng.integers(0, n_days * 24 * 3600, n_news))[::-1], unit="s"
+    )
+    return pd.DataFrame(
+        {
+            "news_text": texts,
+            "summary_text": summaries,
+            "news_date": news_date,
+            "news_source": rng.choice(SOURCES, n_news),
+            "date_collected": news_date
+            + pd.to_timedelta(rng.integers(1, 600, n_news), unit="s"),
+        }
+    )
+
+
+def get_pg_conn_cfg(dbname):
+    """Cfg of connection to benchmark database (POSTGRES_* env)"""
+    pg_conn_cfg = {
+        "dbname": dbname,
+        "user": os.environ.get("POSTGRES_USER"),
+        "host": os.environ.get("POSTGRES_HOST"),
+        "port": os.environ.get("POSTGRES_PORT"),
+    }
+    with open(os.environ.get("POSTGRES_PASSWORD_FILE"), "r") as f:
+        pg_conn_cfg["password"] = f.readlines()[0].rstrip("\n")
+    return pg_conn_cfg
+
+
+def create_bench_db(pg_conn_cfg, fname_schema_sql):
+    """(Re)create database pg_conn_cfg["dbname"] with the project schema and
+    default models. Name of database must contain "bench" (protection of
+    production database).
+    """
+    dbname = pg_conn_cfg["dbname"]
+    assert "bench" in dbname, f'Name of benchmark database "{dbname}" without "bench"'
+
+    pg_con = psycopg2.connect(**{**pg_conn_cfg, "dbname": "postgres"})
+    try:
+        pg_con.autocommit = True
+        pg_cur = pg_con.cursor()
+        pg_cur.execute(
+            sql.SQL("DROP DATABASE IF EXISTS {};").format(sql.Identifier(dbname))
+        )
+        pg_cur.execute(
+            sql.SQL("CREATE DATABASE {} ENCODING 'UTF8' TEMPLATE template0;").format(
+                sql.Identifier(dbname)
+            )
+        )
+        pg_cur.close()
+    finally:
+        pg_con.close()
+
+    with open(fname_schema_sql, "r") as f:
+        schema_sql = f.read()
+
+    pg_con = psycopg2.connect(**pg_conn_cfg)
+    try:
+        pg_cur = pg_con.cursor()
+        pg_cur.execute(schema_sql)
+        pg_cur.execute(
+            """
+            INSERT INTO models(id_model, id_model_type, id_model_stage,
+                               model_name, date_added)
+            VALUES (1, 1, 1, 'IlyaGusev/rut5_base_headline_gen_telegram', now()),
+                   (2, 2, 1, 'stanza+natasha', now());
+            """
+        )
+        pg_con.commit()
+        pg_cur.close()
+    finally:
+        pg_con.close()
+
+
+def load_corpus(pg_conn_cfg, df_corpus, with_summaries=False):
+    """Load corpus to news table (and news_summary if with_summaries, i.e.
+    summarization stage is skipped).
+
+    Returns:
+        list: ids of loaded news
+    """
+    pg_con = psycopg2.connect(**pg_conn_cfg)
+    try:
+        pg_cur = pg_con.cursor()
+        ids = execute_values(
+            pg_cur,
+            """
+            INSERT INTO news(news_text, news_date, news_source, date_collected)
+            VALUES %s RETURNING id_news;
+            """,
+            df_corpus[
+                ["news_text", "news_date", "news_source", "date_collected"]
+            ].itertuples(index=False, name=None),
+            page_size=1000,
+            fetch=True,
+        )
+        id_news = [row[0] for row in ids]
+        if with_summaries:
+            execute_values(
+                pg_cur,
+                """
+                INSERT INTO news_summary(id_news, news_date, date_generated,
+                                         summary_text, id_model)
+                VALUES %s;
+                """,
+                [
+                    (i, news_date, summary, 1)
+                    for i, news_date, summary in zip(
+                        id_news, df_corpus.news_date, df_corpus.summary_text
+                    )
+                ],
+                template="(%s, %s, now(), %s, %s)",
+                page_size=1000,
+            )
+        pg_con.commit()
+        pg_cur.close()
+    finally:
+        pg_con.close()
+    return id_news
+
+
+def default_schema_path():
+    return os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), "data", "create_db_schema.sql"
+    )
@@ -0,0 +1,72 @@
+"""Stub of wikidata API (action=wbsearchentities) for benchmarks of entity
+linking without network: qid of name is deterministic (by crc32 of name),
+share of found names and latency of response are configurable.
+
+Run from cli (then set URL_WIKIDATA_API=http://localhost:8800/w/api.php):
+    python src/benchmarks/wikidata_stub.py --port 8800 --latency 0.05
+"""
+import json
+import time
+import zlib
+import argparse
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(hit_rate, latency):
+    class WikidataStubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            form = parse_qs(self.rfile.read(length).decode())
+            name = form.get("search", [""])[0]
+
+            crc = zlib.crc32(name.encode())
+            if name != "" and crc % 1000 < hit_rate * 1000:
+                search = [{"id": f"Q{crc % 10000000}", "label": name}]
+            else:
+                search = []
+
+            time.sleep(latency)
+            body = json.dumps({"search": search}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return WikidataStubHandler
+
+
+def start_wikidata_stub(port=0, hit_rate=0.8, latency=0.0):
+    """Start stub server in background thread.
+
+    Args:
+        port (int): port (0 - any free port)
+        hit_rate (float): share of names found in "wikidata"
+        latency (float): latency of response in seconds
+
+    Returns:
+        tuple(server, url of api)
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(hit_rate, latency))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/w/api.php"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--hit-rate", type=float, default=0.8)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    server, url = start_wikidata_stub(args.port, args.hit_rate, args.latency)
+    print(f"Info: wikidata stub on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
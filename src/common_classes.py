@@ -5,6 +5,7 @@ import requests
 import datetime
 import pymorphy2
 from src.common_funcs import get_wikidata_qid
+from src.app.ner_lookup import select_match
 
 
 class SynNamedEntity:
@@ -77,6 +78,7 @@ class SynNamedEntities:
         self._ents = {}
         self.news_without_ents = []
         self.count_without_id_ner = 0
+        self.news_ents = {}  # {id_news: ents} (to reuse for near-duplicates)
 
     def add_ents_from_one_news(self, news_id, ents):
         """
@@ -84,6 +86,7 @@ class SynNamedEntities:
         ents: tuple of tuples((norm ner01, ner_type01),
                               (norm ner02, ner_type02), ...)
         """
+        self.news_ents[news_id] = ents
         if len(ents) > 0:
             for ent in ents:
                 if ent[0] not in self._ents:
@@ -130,6 +133,43 @@ class SynNamedEntities:
                     ent.id_ner = db_syn_match2id[ent.name_for_match]
                     self.count_without_id_ner -= 1
 
+    def search_in_ner_index(self, ner_index, threshold, margin, word_threshold):
+        """
+        Fuzzy search (by trigram similarity, e.g. misspelled synonyms) of
+        entities without id_ner in local index of ner_synonyms (before queries
+        to wikidata). Entity is matched if the most similar ner has the same
+        type, similarity >= threshold, synonym has the same amount of words
+        and similar words, and the next ner is less similar at least by
+        margin (see src.app.ner_lookup.select_match).
+
+        Args:
+            ner_index: NerLookup (see src.app.ner_lookup)
+            threshold (float): min similarity of synonyms
+            margin (float): min difference of similarity of two the most
+                            similar ners
+            word_threshold (float): min similarity of words of synonyms
+
+        Returns:
+            int: amount of matched entities
+        """
+        matched = 0
+        for ent in self._ents.values():
+            if ent.id_ner is not None:
+                continue
+            id_ner = select_match(
+                ent.name_syn,
+                ent.ntype(),
+                ner_index.search(ent.name_syn, k=2),
+                threshold,
+                margin,
+                word_threshold,
+            )
+            if id_ner is not None:
+                ent.id_ner = id_ner
+                self.count_without_id_ner -= 1
+                matched += 1
+        return matched
+
     def search_wikidata_qid(self):
         """
         Query to wikidata for get qid for entities without id_ner
@@ -174,6 +214,51 @@ class SynNamedEntities:
         if self.count_without_id_ner > 0:
             self.match_by_wikidata_qid(db_ner_qid2id)
 
+    def rematch_new_synonyms(self, db_syn_name2id, db_syn_match2id, db_ner_qid2id):
+        """
+        Repeat search in local db for entities not found in ner_synonym table
+        (call under lock of ner tables, entities can be added by other replica
+        of the ner-pipeline since search_in_synonym_table).
+
+        Args:
+            db_syn_name2id: dict {'ner_synonym01': id_ner01, ...}
+            db_syn_match2id: dict {'name_for_match01': id_ner01, ...}
+            db_ner_qid2id: dict {"qid_wikidata01": id_ner01, ...}
+        """
+        for ent in self._ents.values():
+            if ent.in_synonym_table:
+                continue
+            if ent.name_syn in db_syn_name2id:
+                ent.in_synonym_table = True
+                if ent.id_ner is None:
+                    self.count_without_id_ner -= 1
+                ent.id_ner = db_syn_name2id[ent.name_syn]
+            elif ent.id_ner is None and ent.name_for_match in db_syn_match2id:
+                ent.id_ner = db_syn_match2id[ent.name_for_match]
+                self.count_without_id_ner -= 1
+
+        self.match_by_wikidata_qid(db_ner_qid2id)
+
+    def remove_news(self, news_ids):
+        """
+        Remove news (e.g. claimed by other worker) from entities, entities
+        without news are removed.
+
+        Args:
+            news_ids: set of id_news
+        """
+        self.news_without_ents = [
+            id_news for id_news in self.news_without_ents if id_news not in news_ids
+        ]
+        for id_news in news_ids:
+            self.news_ents.pop(id_news, None)
+        for name_syn, ent in list(self._ents.items()):
+            ent.news_ids -= news_ids
+            if len(ent.news_ids) == 0:
+                if ent.id_ner is None:
+                    self.count_without_id_ner -= 1
+                del self._ents[name_syn]
+
     def get_rows_to_ner_table(self):
         """
         Generate list of tuples to insert new ents in db ner table.
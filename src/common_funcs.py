@@ -1,14 +1,27 @@
 """Module for common project functions
 """
+import os
 import sys
 import re
+import time
+import socket
 import psycopg2
 from psycopg2 import Error
 from psycopg2.extras import execute_values
+from src.common_metrics import inc, observe, MetricsCursor
 
 # GLOBAL COMMON CONSTANTS
-URL_WIKIDATA_API = "https://www.wikidata.org/w/api.php"
+# can be overridden, e.g. by stub server for benchmarks
+URL_WIKIDATA_API = os.environ.get(
+    "URL_WIKIDATA_API", "https://www.wikidata.org/w/api.php"
+)
 RE_WIKIDATA_CLEAN_QUERY = re.compile(r"[\"!'«».,()+?]")  # clean symbols
+# postgres LISTEN/NOTIFY channels
+NEWS_INSERTED_CHANNEL = "news_inserted"  # payload: ids of new news "1,2,3"
+NEWS_LINKED_CHANNEL = "news_linked"  # payload: ids of linked news "1,2,3"
+DATA_VERSION_CHANNEL = "data_version"  # payload: new data version
+# id of the worker in work_claims table (several replicas of ml-pipelines)
+WORKER_ID = "{}:{}".format(socket.gethostname(), os.getpid())
 
 
 def safe_pg_write_query(pg_conn_cfg, sql_query, placeholder=None, verbose=False):
@@ -21,7 +34,7 @@ def safe_pg_write_query(pg_conn_cfg, sql_query, placeholder=None, verbose=False)
             host=pg_conn_cfg["host"],
             port=pg_conn_cfg["port"],
         )
-        pg_cur = pg_con.cursor()
+        pg_cur = pg_con.cursor(cursor_factory=MetricsCursor)
 
         if isinstance(sql_query, list):
             for query in sql_query:
@@ -65,7 +78,7 @@ def safe_pg_read_query(pg_conn_cfg, sql_query, placeholder=None, verbose=False):
             host=pg_conn_cfg["host"],
             port=pg_conn_cfg["port"],
         )
-        pg_cur = pg_con.cursor()
+        pg_cur = pg_con.cursor(cursor_factory=MetricsCursor)
 
         if placeholder is None:
             pg_cur.execute(sql_query)
@@ -101,7 +114,7 @@ def safe_pg_execute_values(pg_conn_cfg, sql_query, placeholder, verbose=False):
             host=pg_conn_cfg["host"],
             port=pg_conn_cfg["port"],
         )
-        pg_cur = pg_con.cursor()
+        pg_cur = pg_con.cursor(cursor_factory=MetricsCursor)
 
         execute_values(pg_cur, sql_query, placeholder)
 
@@ -121,6 +134,177 @@ def safe_pg_execute_values(pg_conn_cfg, sql_query, placeholder, verbose=False):
                 print("Connection to PostgreSQL closed.")
 
 
+def bump_data_version(pg_conn_cfg):
+    """Increase data version in db (marker for the app to invalidate cached
+    results, should be called after data changes have been committed)"""
+    queries = [
+        """
+        UPDATE data_version
+        SET version = version + 1,
+            date_updated = now();
+        """,
+        f"""
+        SELECT pg_notify('{DATA_VERSION_CHANNEL}', version::text)
+        FROM data_version;
+        """,
+    ]
+    safe_pg_write_query(pg_conn_cfg, queries)
+
+
+def notify_news_linked(pg_cur, id_news, chunk_size=500):
+    """Send notification with ids of newly linked news (in chunks, payload
+    of NOTIFY is limited by 8000 bytes). Notifications are delivered only
+    when transaction is committed.
+
+    Args:
+        pg_cur: cursor of psycopg2 connection (in transaction)
+        id_news: list of ids of news
+    """
+    id_news = sorted(set(id_news))
+    for i in range(0, len(id_news), chunk_size):
+        pg_cur.execute(
+            "SELECT pg_notify(%s, %s);",
+            (
+                NEWS_LINKED_CHANNEL,
+                ",".join(map(str, id_news[i : i + chunk_size])),  # noqa E203
+            ),
+        )
+
+
+def upsert_ner_daily_mentions(pg_cur, id_news=None, date_min=None, date_max=None):
+    """Add mentions of ners in news to daily rollup table ner_daily_mentions
+    (day, id_ner, news_source) -> mentions (amount of news). Should be called
+    once for each news (in transaction of writing its links).
+
+    Args:
+        pg_cur: cursor of psycopg2 connection (in transaction)
+        id_news: list of ids of news (None - all news)
+        date_min (str): only news from date_min (None - without limit)
+        date_max (str): only news before date_max (None - without limit)
+    """
+    pg_cur.execute(
+        """
+        INSERT INTO ner_daily_mentions(day, id_ner, news_source, mentions)
+        SELECT news_date::date, id_ner, news_source, COUNT(DISTINCT id_news)
+        FROM news_links INNER JOIN news USING(id_news, news_date)
+        WHERE id_ner IS NOT Null AND
+              (%(id_news)s::integer[] IS Null OR id_news = ANY(%(id_news)s)) AND
+              (%(date_min)s::date IS Null OR news_date >= %(date_min)s) AND
+              (%(date_max)s::date IS Null OR news_date < %(date_max)s)
+        GROUP BY news_date::date, id_ner, news_source
+        ON CONFLICT (id_ner, day, news_source) DO UPDATE
+        SET mentions = ner_daily_mentions.mentions + EXCLUDED.mentions;
+        """,
+        {
+            "id_news": None if id_news is None else list(id_news),
+            "date_min": date_min,
+            "date_max": date_max,
+        },
+    )
+
+
+def claim_news(pg_conn_cfg, stage, candidates_query, placeholder, limit, lease):
+    """Claim news for processing by stage of ml-pipeline (for several replicas
+    of the pipeline). Claim is a row of work_claims table with lease: news
+    claimed by other worker are skipped until its lease is expired (e.g. the
+    worker crashed), candidate news locked by concurrent claim are skipped
+    (FOR NO KEY UPDATE SKIP LOCKED).
+
+    Args:
+        pg_conn_cfg: dict with cfg connect to database
+        stage (str): name of stage, e.g. "summarization"
+        candidates_query (str): query of ids of news to process (pyformat
+                                placeholders)
+        placeholder (dict): values of placeholders of candidates_query
+        limit (int): max amount of news to claim
+        lease (int): lease in seconds (max time of processing of claimed news)
+
+    Returns:
+        list: ids of claimed news
+    """
+    query = f"""
+    WITH candidates AS (
+        SELECT id_news
+        FROM news
+        WHERE id_news IN ({candidates_query}) AND
+              NOT EXISTS (SELECT 1 FROM work_claims
+                          WHERE stage = %(stage)s AND
+                                work_claims.id_news = news.id_news)
+        ORDER BY id_news
+        LIMIT %(limit)s
+        FOR NO KEY UPDATE SKIP LOCKED
+        )
+    INSERT INTO work_claims(stage, id_news, worker, lease_until)
+    SELECT %(stage)s, id_news, %(worker)s, now() + make_interval(secs => %(lease)s)
+    FROM candidates
+    ON CONFLICT (stage, id_news) DO NOTHING
+    RETURNING id_news;
+    """
+    try:
+        pg_con = psycopg2.connect(
+            dbname=pg_conn_cfg["dbname"],
+            user=pg_conn_cfg["user"],
+            password=pg_conn_cfg["password"],
+            host=pg_conn_cfg["host"],
+            port=pg_conn_cfg["port"],
+        )
+        pg_cur = pg_con.cursor(cursor_factory=MetricsCursor)
+
+        # claims of crashed workers
+        pg_cur.execute(
+            "DELETE FROM work_claims WHERE stage = %s AND lease_until < now();",
+            (stage,),
+        )
+        pg_cur.execute(
+            query,
+            {
+                **placeholder,
+                "stage": stage,
+                "worker": WORKER_ID,
+                "limit": limit,
+                "lease": lease,
+            },
+        )
+        id_news = sorted(row[0] for row in pg_cur.fetchall())
+
+        pg_con.commit()
+        pg_cur.close()
+
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+        sys.exit(str(error))
+    finally:
+        if "pg_con" in locals() and pg_con:
+            pg_cur.close()
+            pg_con.close()
+
+    return id_news
+
+
+def release_claims(pg_cur, stage, id_news):
+    """Delete claims of the worker (call in transaction of writing results).
+    Claims can be lost if lease is expired and news are claimed by other
+    worker, results of such news should not be written.
+
+    Args:
+        pg_cur: cursor of psycopg2 connection (in transaction)
+        stage (str): name of stage, e.g. "summarization"
+        id_news: list of ids of claimed news
+
+    Returns:
+        set: ids of news still claimed by the worker
+    """
+    pg_cur.execute(
+        """
+        DELETE FROM work_claims
+        WHERE stage = %s AND worker = %s AND id_news = ANY(%s)
+        RETURNING id_news;
+        """,
+        (stage, WORKER_ID, list(id_news)),
+    )
+    return {row[0] for row in pg_cur.fetchall()}
+
+
 def wbsearchentities(name, session):
     """Search entity in wikidata. Return raw results. Docs:
     https://www.wikidata.org/w/api.php?action=help&modules=wbsearchentities
@@ -133,6 +317,7 @@ def wbsearchentities(name, session):
                   None if not found
     """
 
+    start = time.perf_counter()
     res = session.post(
         URL_WIKIDATA_API,
         data={
@@ -143,6 +328,8 @@ def wbsearchentities(name, session):
             "format": "json",
         },
     )
+    inc("ml_wikidata_requests_total", status=res.status_code)
+    observe("ml_wikidata_request_seconds", time.perf_counter() - start)
     try:
         res_json = res.json()["search"][0]
     except:  # noqa E722
@@ -0,0 +1,193 @@
+"""Module for metrics of ml-pipelines (per-stage durations and throughput,
+backlog, wikidata requests, db round-trips, rows written, model load time).
+
+Metrics are collected in memory of the process and exported in Prometheus
+text format by export_metrics():
+    - to METRICS_TEXTFILE_DIR/<job>.prom (for textfile collector of
+      node_exporter, the file is replaced atomically)
+    - to Pushgateway METRICS_PUSH_URL (PUT /metrics/job/<job>)
+If none of them is set, export_metrics() does nothing. Job is METRICS_JOB or
+name of the running script (e.g. ner_pipeline).
+
+Usage:
+    with stage_timer("ner", "entity_linking") as stage:
+        ...
+        stage["items"] = len(news)
+"""
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+import requests
+from psycopg2.extensions import cursor
+from src.common_profiling import profile_stage
+
+METRICS_TEXTFILE_DIR = os.environ.get("METRICS_TEXTFILE_DIR")
+METRICS_PUSH_URL = os.environ.get("METRICS_PUSH_URL")
+METRICS_JOB = os.environ.get("METRICS_JOB") or (
+    os.path.splitext(os.path.basename(sys.argv[0]))[0] or "python"
+)
+
+# name: (type, help)
+METRICS_HELP = {
+    "ml_stage_duration_seconds": ("gauge", "Duration of the last run of stage"),
+    "ml_stage_items": ("gauge", "Items processed by the last run of stage"),
+    "ml_stage_items_per_second": ("gauge", "Throughput of the last run of stage"),
+    "ml_stage_runs_total": ("counter", "Runs of stage"),
+    "ml_stage_seconds_total": ("counter", "Total duration of runs of stage"),
+    "ml_stage_items_total": ("counter", "Total items processed by stage"),
+    "ml_backlog_news": ("gauge", "News waiting for the pipeline at start of run"),
+    "ml_last_success_timestamp_seconds": (
+        "gauge",
+        "Unix time of the last completed run of pipeline",
+    ),
+    "ml_ner_index_matches_total": (
+        "counter",
+        "Entities matched by similar synonyms in local index (without wikidata)",
+    ),
+    "ml_wikidata_requests_total": ("counter", "Requests to wikidata API"),
+    "ml_wikidata_request_seconds": ("summary", "Latency of requests to wikidata"),
+    "ml_db_roundtrips_total": ("counter", "Queries (round-trips) to database"),
+    "ml_rows_written_total": ("counter", "Rows written to database tables"),
+    "ml_stream_latency_seconds": (
+        "gauge",
+        "Latency from ingest (or publication) to graph visibility of last batch",
+    ),
+    "ml_near_duplicate_checks_total": ("counter", "News checked for near-duplicates"),
+    "ml_near_duplicate_hits_total": (
+        "counter",
+        "News with reused results of near-duplicates",
+    ),
+    "ml_near_duplicate_saved_seconds_total": (
+        "counter",
+        "Estimated time of models saved by near-duplicates",
+    ),
+}
+
+_lock = threading.Lock()
+_values = {}  # {(name, tuple of sorted labels): value}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Increase counter"""
+    with _lock:
+        key = _key(name, labels)
+        _values[key] = _values.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _values[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Add observation to summary (name_count and name_sum)"""
+    with _lock:
+        for suffix, add in (("_count", 1), ("_sum", value)):
+            key = _key(name + suffix, labels)
+            _values[key] = _values.get(key, 0) + add
+
+
+class MetricsCursor(cursor):
+    """Cursor of psycopg2 connection counting queries (round-trips) to
+    database, use by pg_con.cursor(cursor_factory=MetricsCursor)"""
+
+    def execute(self, query, vars=None):
+        inc("ml_db_roundtrips_total")
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        inc("ml_db_roundtrips_total", len(vars_list))
+        return super().executemany(query, vars_list)
+
+
+@contextmanager
+def stage_timer(pipeline, stage, items=None):
+    """Measure duration of stage of pipeline (and profile it, if profiling is
+    enabled, see common_profiling). Amount of processed items can be set by
+    items argument or by stage["items"] inside the block.
+    """
+    stage_info = {"items": items}
+    start = time.perf_counter()
+    with profile_stage(pipeline, stage):
+        yield stage_info
+    seconds = time.perf_counter() - start
+
+    labels = {"pipeline": pipeline, "stage": stage}
+    set_gauge("ml_stage_duration_seconds", seconds, **labels)
+    inc("ml_stage_runs_total", **labels)
+    inc("ml_stage_seconds_total", seconds, **labels)
+    if stage_info["items"] is not None:
+        set_gauge("ml_stage_items", stage_info["items"], **labels)
+        inc("ml_stage_items_total", stage_info["items"], **labels)
+        if seconds > 0:
+            set_gauge(
+                "ml_stage_items_per_second", stage_info["items"] / seconds, **labels
+            )
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def render_metrics():
+    """All metrics in Prometheus text format"""
+    with _lock:
+        values = sorted(_values.items())
+
+    lines = []
+    described = set()
+    for (name, labels), value in values:
+        base = name
+        if name.endswith(("_count", "_sum")) and name.rsplit("_", 1)[0] in METRICS_HELP:
+            base = name.rsplit("_", 1)[0]
+        if base not in described:
+            metric_type, metric_help = METRICS_HELP.get(base, ("untyped", base))
+            lines.append(f"# HELP {base} {metric_help}")
+            lines.append(f"# TYPE {base} {metric_type}")
+            described.add(base)
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def export_metrics(job=None):
+    """Write metrics to textfile and/or push to Pushgateway (errors of export
+    are printed, the pipeline is not stopped)."""
+    job = job or METRICS_JOB
+    if METRICS_TEXTFILE_DIR is None and METRICS_PUSH_URL is None:
+        return
+    text = render_metrics()
+
+    if METRICS_TEXTFILE_DIR is not None:
+        fname = os.path.join(METRICS_TEXTFILE_DIR, f"{job}.prom")
+        try:
+            with open(fname + ".tmp", "w") as f:
+                f.write(text)
+            os.replace(fname + ".tmp", fname)
+        except OSError as error:
+            print("Error metrics textfile:\n", error)
+
+    if METRICS_PUSH_URL is not None:
+        try:
+            requests.put(
+                f"{METRICS_PUSH_URL.rstrip('/')}/metrics/job/{job}",
+                data=text.encode(),
+                timeout=5,
+            ).raise_for_status()
+        except requests.RequestException as error:
+            print("Error metrics push:\n", error)
@@ -0,0 +1,206 @@
+"""Module for near-duplicate detection of news by MinHash LSH (reworded
+versions of the same story by different agencies), so results of ml-pipelines
+for processed news can be reused instead of running the models.
+
+MinHash signature (MINHASH_NUM_PERM hashes) is calculated over shingles
+(MINHASH_SHINGLE_WORDS consecutive words) of normalized text. Signatures are
+indexed by LSH (MINHASH_BANDS bands of signature), candidates from the index
+are checked by estimated jaccard similarity >= MINHASH_THRESHOLD.
+
+Signatures are stored in news_minhash table (with near-duplicate, whose
+results were reused), index is loaded from the table for news of the last
+MINHASH_WINDOW_DAYS days and reloaded every MINHASH_RELOAD_INTERVAL seconds.
+"""
+import os
+import re
+import time
+import zlib
+import unicodedata
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+from src.common_funcs import safe_pg_read_query, safe_pg_write_query
+from src.common_metrics import inc
+
+MINHASH_NUM_PERM = 128
+MINHASH_BANDS = 16  # 8 rows in band, probability of candidate is 0.5 at ~0.7
+MINHASH_SHINGLE_WORDS = 3
+MINHASH_THRESHOLD = float(os.environ.get("MINHASH_THRESHOLD", 0.8))
+MINHASH_WINDOW_DAYS = int(os.environ.get("MINHASH_WINDOW_DAYS", 7))
+MINHASH_RELOAD_INTERVAL = float(os.environ.get("MINHASH_RELOAD_INTERVAL", 600))
+
+RE_NOT_WORDS = re.compile(r"[\W_]+")
+
+# universal hashing (a * x + b) mod p for permutations of MinHash
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, _MERSENNE_PRIME, MINHASH_NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, _MERSENNE_PRIME, MINHASH_NUM_PERM, dtype=np.uint64)
+
+_index_cache = {}  # {query: MinHashLSH}
+
+
+def normalize_text(text):
+    """Lowercase letters and digits of text separated by single spaces"""
+    text = unicodedata.normalize("NFKC", text or "").lower().replace("ё", "е")
+    return RE_NOT_WORDS.sub(" ", text).strip()
+
+
+def minhash_signature(text):
+    """MinHash signature of text.
+
+    Returns:
+        np.ndarray: MINHASH_NUM_PERM hashes (uint32) or None for text without
+                    letters and digits
+    """
+    words = normalize_text(text).split()
+    if len(words) == 0:
+        return None
+    k = min(MINHASH_SHINGLE_WORDS, len(words))
+    shingles = {" ".join(words[i:][:k]) for i in range(len(words) - k + 1)}
+    hashes = np.array(
+        [zlib.crc32(shingle.encode()) for shingle in shingles], dtype=np.uint64
+    )
+    with np.errstate(over="ignore"):
+        permuted = ((hashes[:, None] * _PERM_A + _PERM_B) % _MERSENNE_PRIME) & _MAX_HASH
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+class MinHashLSH:
+    """LSH index of MinHash signatures with payload (e.g. summary) of each
+    key and new entries, which are not saved to db yet."""
+
+    def __init__(self, threshold=MINHASH_THRESHOLD, bands=MINHASH_BANDS) -> None:
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = MINHASH_NUM_PERM // bands
+        self.loaded = time.monotonic()
+        self._tables = [{} for _ in range(bands)]  # {band bytes: [keys]}
+        self._signatures = {}
+        self.payloads = {}
+        self.unsaved = []  # tuples(key, signature, similar key, similarity)
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def _band_keys(self, signature):
+        for i in range(self.bands):
+            yield signature[i * self.rows : (i + 1) * self.rows].tobytes()  # noqa E203
+
+    def add(self, key, signature, payload=None, similar=None, save=True):
+        """Add signature of key (similar - tuple(key, similarity) of found
+        near-duplicate, save - add to unsaved entries)"""
+        self._signatures[key] = signature
+        self.payloads[key] = payload
+        for table, band_key in zip(self._tables, self._band_keys(signature)):
+            table.setdefault(band_key, []).append(key)
+        if save:
+            self.unsaved.append((key, signature, *(similar or (None, None))))
+
+    def query(self, signature):
+        """Find the most similar key (with similarity >= threshold).
+
+        Returns:
+            tuple(key, similarity) or None
+        """
+        candidates = set()
+        for table, band_key in zip(self._tables, self._band_keys(signature)):
+            candidates.update(table.get(band_key, ()))
+        best = None
+        for key in candidates:
+            similarity = float(np.mean(self._signatures[key] == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
+
+    def take_unsaved(self):
+        """Pop unsaved entries (rows to write_minhash)
+
+        Returns:
+            list of tuples(key, signature bytes, similar key, similarity)
+        """
+        rows = [
+            (key, psycopg2.Binary(signature.tobytes()), similar, similarity)
+            for key, signature, similar, similarity in self.unsaved
+        ]
+        self.unsaved = []
+        return rows
+
+
+def get_minhash_index(pg_conn_cfg, query):
+    """Get index of news by query (loaded once per MINHASH_RELOAD_INTERVAL
+    seconds, e.g. for news processed by other replicas, signatures of news
+    out of window are removed from db before load).
+
+    Args:
+        pg_conn_cfg: dict with cfg connect to database
+        query (str): query of tuples(id_news, signature, payload) with
+                     placeholder %(window_days)s
+
+    Returns:
+        MinHashLSH
+    """
+    lsh = _index_cache.get(query)
+    if lsh is None or time.monotonic() - lsh.loaded > MINHASH_RELOAD_INTERVAL:
+        remove_old_minhash(pg_conn_cfg)
+        lsh = MinHashLSH()
+        rows = safe_pg_read_query(
+            pg_conn_cfg, query, {"window_days": MINHASH_WINDOW_DAYS}
+        )
+        for id_news, signature, payload in rows:
+            lsh.add(id_news, np.frombuffer(signature, np.uint32), payload, save=False)
+        print(f"Info: MinHash index is loaded: {len(lsh)} news.")
+        _index_cache[query] = lsh
+    return lsh
+
+
+def write_minhash(pg_cur, rows):
+    """Write signatures of news.
+
+    Args:
+        pg_cur: cursor of db connection (in transaction of caller)
+        rows: list of tuples(id_news, signature, id_news_similar, similarity),
+              see MinHashLSH.take_unsaved
+    """
+    if len(rows) == 0:
+        return
+    execute_values(
+        pg_cur,
+        """
+        INSERT INTO news_minhash(id_news, signature, id_news_similar, similarity)
+        VALUES %s
+        ON CONFLICT (id_news) DO UPDATE
+        SET signature = EXCLUDED.signature,
+            id_news_similar = EXCLUDED.id_news_similar,
+            similarity = EXCLUDED.similarity;
+        """,
+        rows,
+    )
+    inc("ml_rows_written_total", len(rows), table="news_minhash")
+
+
+def remove_old_minhash(pg_conn_cfg):
+    """Remove signatures of news out of window"""
+    query = """
+    DELETE FROM news_minhash
+    WHERE id_news IN (SELECT id_news FROM news
+                      WHERE news_date < now() - %s * interval '1 day');
+    """
+    safe_pg_write_query(pg_conn_cfg, query, (MINHASH_WINDOW_DAYS,))
+
+
+def report_near_duplicates(pipeline, n_news, n_reused, seconds_per_news):
+    """Print and add to metrics hit rate of near-duplicates and estimation
+    of saved time of models (by mean time of processed news)."""
+    if n_news == 0:
+        return
+    saved = n_reused * seconds_per_news
+    inc("ml_near_duplicate_checks_total", n_news, pipeline=pipeline)
+    inc("ml_near_duplicate_hits_total", n_reused, pipeline=pipeline)
+    inc("ml_near_duplicate_saved_seconds_total", saved, pipeline=pipeline)
+    print(
+        f"Info: {pipeline}: results of near-duplicates are reused for {n_reused} "
+        f"of {n_news} news (hit rate {n_reused / n_news:.1%}), ~{saved:.1f} s "
+        "of models are saved."
+    )
@@ -0,0 +1,128 @@
+"""Module for opt-in profiling of stages of ml-pipelines and of the app.
+
+Profiling is enabled by PROFILE_DIR env (or by enable_profiling(), e.g. from
+--profile flag of pipelines). For each profiled stage:
+    - cpu profile of cProfile: <stage>.prof (stats of all runs of the stage
+      in the process, view by snakeviz or python -m pstats)
+    - tracemalloc peak of allocations during the stage and top allocation
+      sites (by line) of memory, which is not freed at the end of the run
+      with the largest peak: <stage>.json
+Artifacts are saved to PROFILE_DIR/<job>/<run id>/, run id is start time
+and pid of the process (or id given by caller, e.g. id of request).
+
+When profiling is disabled, profile_stage() returns empty context (no
+profiler and no tracemalloc). Only one stage is profiled at a time: nested
+stages are included in the profile of outer stage, stages of other threads
+are not profiled meanwhile.
+
+Usage:
+    with profile_stage("ner", "entity_linking"):
+        ...
+"""
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+from datetime import datetime
+from contextlib import contextmanager, nullcontext
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+PROFILE_TOP_ALLOCATIONS = int(os.environ.get("PROFILE_TOP_ALLOCATIONS", 20))
+PROFILE_JOB = os.environ.get("METRICS_JOB") or (
+    os.path.splitext(os.path.basename(sys.argv[0]))[0] or "python"
+)
+RUN_ID = "{}_{}".format(datetime.now().strftime("%Y%m%d-%H%M%S"), os.getpid())
+
+_active_lock = threading.Lock()  # held while a stage is profiled
+_stats = {}  # {(run_id, stage name): (cProfile.Profile, dict of memory stats)}
+
+
+def enable_profiling(profile_dir=None):
+    """Enable profiling (profile_dir - directory of artifacts, by default
+    PROFILE_DIR env or reports/profiles)."""
+    global PROFILE_DIR
+    PROFILE_DIR = profile_dir or PROFILE_DIR or os.path.join("reports", "profiles")
+    print(f"Info: profiling is enabled, artifacts: {get_run_dir()}")
+
+
+def profiling_enabled():
+    return PROFILE_DIR is not None
+
+
+def get_run_dir(run_id=None):
+    return os.path.join(PROFILE_DIR, PROFILE_JOB, run_id or RUN_ID)
+
+
+def profile_stage(pipeline, stage, run_id=None):
+    """Context manager of profiling of the stage (empty if profiling is
+    disabled or another stage is being profiled), gives True if the stage
+    is profiled."""
+    if PROFILE_DIR is None or not _active_lock.acquire(blocking=False):
+        return nullcontext(False)
+    return _profile_stage(f"{pipeline}.{stage}", run_id or RUN_ID)
+
+
+@contextmanager
+def _profile_stage(name, run_id):
+    try:
+        profile, memory = _stats.setdefault(
+            (run_id, name),
+            (cProfile.Profile(), {"runs": 0, "seconds": 0.0, "peak_mb": 0.0}),
+        )
+        # if tracemalloc is already started (e.g. by benchmark), it is not
+        # restarted and peak includes allocations before the stage
+        own_tracing = not tracemalloc.is_tracing()
+        if own_tracing:
+            tracemalloc.start()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield True
+        finally:
+            profile.disable()
+            memory["runs"] += 1
+            memory["seconds"] += time.perf_counter() - start
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+            if peak_mb >= memory["peak_mb"]:
+                memory["peak_mb"] = peak_mb
+                memory["top_allocations"] = top_allocations()
+            if own_tracing:
+                tracemalloc.stop()
+            save_stage(run_id, name, profile, memory)
+            if run_id != RUN_ID:
+                # own run (e.g. request) is not continued
+                del _stats[(run_id, name)]
+    finally:
+        _active_lock.release()
+
+
+def top_allocations():
+    """Top allocation sites (by size of traced memory blocks, which are not
+    freed yet)."""
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    return [
+        {
+            "site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "count": stat.count,
+        }
+        for stat in snapshot.statistics("lineno")[:PROFILE_TOP_ALLOCATIONS]
+    ]
+
+
+def save_stage(run_id, name, profile, memory):
+    """Save cpu profile and memory stats of the stage (errors of saving are
+    printed, the pipeline is not stopped)."""
+    run_dir = get_run_dir(run_id)
+    try:
+        os.makedirs(run_dir, exist_ok=True)
+        profile.dump_stats(os.path.join(run_dir, f"{name}.prof"))
+        with open(os.path.join(run_dir, f"{name}.json"), "w") as f:
+            json.dump({"run_id": run_id, "stage": name, **memory}, f, indent=2)
+    except OSError as error:
+        print("Error profile saving:\n", error)
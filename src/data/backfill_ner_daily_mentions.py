@@ -0,0 +1,80 @@
+"""Script to build daily rollup table ner_daily_mentions from history
+(news_links joined with news). Rows of the date range are deleted and
+rebuilt in single transaction, so the script can be rerun at any time.
+
+Run from cli:
+    python src/data/backfill_ner_daily_mentions.py
+    python src/data/backfill_ner_daily_mentions.py --date-min 2022-10-01
+"""
+import os
+import time
+import argparse
+from src.common_funcs import upsert_ner_daily_mentions
+import psycopg2
+from psycopg2 import Error
+
+# Hyperparameters
+PG_CONN_CFG = {
+    "dbname": os.environ.get("POSTGRES_DB"),
+    "user": os.environ.get("POSTGRES_USER"),
+    "host": os.environ.get("POSTGRES_HOST"),
+    "port": os.environ.get("POSTGRES_PORT"),
+}
+with open(os.environ.get("POSTGRES_PASSWORD_FILE"), "r") as f:
+    PG_CONN_CFG["password"] = f.readlines()[0].rstrip("\n")
+
+
+def backfill_ner_daily_mentions(pg_conn_cfg, date_min=None, date_max=None):
+    """
+    Rebuild ner_daily_mentions for news in date range.
+    Args:
+        pg_conn_cfg: dict with cfg connect to database
+        date_min (str): first day of range, e.g. "2022-10-01" (None - all history)
+        date_max (str): day after the last day of range (None - until now)
+    """
+    start = time.perf_counter()
+    try:
+        pg_con = psycopg2.connect(
+            dbname=pg_conn_cfg["dbname"],
+            user=pg_conn_cfg["user"],
+            password=pg_conn_cfg["password"],
+            host=pg_conn_cfg["host"],
+            port=pg_conn_cfg["port"],
+        )
+        pg_cur = pg_con.cursor()
+
+        # lock rollup against concurrent upserts of the ner-pipeline
+        pg_cur.execute("LOCK TABLE ner_daily_mentions IN EXCLUSIVE MODE;")
+        pg_cur.execute(
+            """
+            DELETE FROM ner_daily_mentions
+            WHERE (%(date_min)s::date IS Null OR day >= %(date_min)s) AND
+                  (%(date_max)s::date IS Null OR day < %(date_max)s);
+            """,
+            {"date_min": date_min, "date_max": date_max},
+        )
+        upsert_ner_daily_mentions(pg_cur, date_min=date_min, date_max=date_max)
+        pg_cur.execute("SELECT COUNT(*) FROM ner_daily_mentions;")
+        rows_count = pg_cur.fetchone()[0]
+
+        pg_con.commit()
+        pg_cur.close()
+        print(
+            f"Info: Table ner_daily_mentions: {rows_count} rows "
+            f"({time.perf_counter() - start:.1f} s)."
+        )
+
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+
+    finally:
+        if "pg_con" in locals() and pg_con:
+            pg_con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--date-min", default=None)
+    parser.add_argument("--date-max", default=None)
+    args = parser.parse_args()
+    backfill_ner_daily_mentions(PG_CONN_CFG, args.date_min, args.date_max)
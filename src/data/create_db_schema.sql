@@ -25,13 +25,15 @@ CREATE TABLE ner (
     qid_wikidata TEXT,
     name_is_custom INTEGER,
     id_ner_type INTEGER,
-    FOREIGN KEY (id_ner_type) REFERENCES ner_types (id_ner_type);
+    FOREIGN KEY (id_ner_type) REFERENCES ner_types (id_ner_type)
     );
 
---Create news_links table
+--Create news_links table (news_date - date of the news, for filters by date
+--without join with news and for partitioning, see partition_news.py)
 CREATE TABLE news_links (
     id_news_links SERIAL NOT NULL PRIMARY KEY,
     id_news INTEGER NOT NULL,
+    news_date timestamp NOT NULL,
     id_ner INTEGER,
     FOREIGN KEY (id_news) REFERENCES news (id_news) ON DELETE CASCADE,
     FOREIGN KEY (id_ner) REFERENCES ner (id_ner) ON DELETE CASCADE
@@ -71,14 +73,15 @@ CREATE TABLE models (
     FOREIGN KEY (id_model_stage) REFERENCES model_stages (id_model_stage)
     );
 
---Create news_summary table
+--Create news_summary table (news_date - date of the news, as in news_links)
 CREATE TABLE news_summary (
     id_summary SERIAL NOT NULL PRIMARY KEY,
     id_news INTEGER NOT NULL,
+    news_date timestamp NOT NULL,
     date_generated timestamp NOT NULL,
     summary_text TEXT NOT NULL,
     id_model INTEGER NOT NULL,
-    FOREIGN KEY (id_news) REFERENCES news (id_news) ON DELETE CASCADE
+    FOREIGN KEY (id_news) REFERENCES news (id_news) ON DELETE CASCADE,
     FOREIGN KEY (id_model) REFERENCES models (id_model)
     );
 
@@ -112,5 +115,97 @@ VALUES (1, 'PER'),
         (3, 'ORG'),
         (4, 'MISC');
 
+--Create data_version table (one row, version is bumped by the ner-pipeline
+--after commit, used by the app to invalidate cached graphs)
+CREATE TABLE data_version (
+    id_data_version INTEGER NOT NULL PRIMARY KEY,
+    version BIGINT NOT NULL,
+    date_updated timestamp NOT NULL
+    );
+
+INSERT INTO data_version(id_data_version, version, date_updated)
+VALUES (1, 0, now());
+
+--Create ner_metrics table (centrality and communities of ners in co-occurrence
+--graph for standard windows, filled by graph_metrics_pipeline)
+CREATE TABLE ner_metrics (
+    window_days INTEGER NOT NULL,
+    id_ner INTEGER NOT NULL,
+    news_count INTEGER NOT NULL,
+    weighted_degree DOUBLE PRECISION NOT NULL,
+    pagerank DOUBLE PRECISION NOT NULL,
+    community INTEGER NOT NULL,
+    date_calc timestamp NOT NULL,
+    PRIMARY KEY (window_days, id_ner),
+    FOREIGN KEY (id_ner) REFERENCES ner (id_ner) ON DELETE CASCADE
+    );
+
+CREATE INDEX ner_metrics_pagerank_idx ON ner_metrics (window_days, pagerank DESC);
+CREATE INDEX ner_metrics_degree_idx ON ner_metrics (window_days, weighted_degree DESC);
+
+--Create ner_daily_mentions table (daily rollup of news_links: amount of news
+--with the ner by day and source, maintained by the ner-pipeline, can be
+--rebuilt by backfill_ner_daily_mentions.py)
+CREATE TABLE ner_daily_mentions (
+    day date NOT NULL,
+    id_ner INTEGER NOT NULL,
+    news_source TEXT NOT NULL,
+    mentions INTEGER NOT NULL,
+    PRIMARY KEY (id_ner, day, news_source),
+    FOREIGN KEY (id_ner) REFERENCES ner (id_ner) ON DELETE CASCADE
+    );
+
+--Create news_text_hashes table (hash of normalized news text, used by the
+--parser to skip duplicates of news, e.g. forwards and reposts)
+CREATE TABLE news_text_hashes (
+    text_hash TEXT NOT NULL PRIMARY KEY,
+    id_news INTEGER NOT NULL,
+    FOREIGN KEY (id_news) REFERENCES news (id_news) ON DELETE CASCADE
+    );
+
+--Create news_duplicates table (duplicates are not written to news table,
+--only recorded with the id of the original news)
+CREATE TABLE news_duplicates (
+    id_news_duplicate SERIAL NOT NULL PRIMARY KEY,
+    id_news INTEGER NOT NULL,
+    news_source TEXT NOT NULL,
+    news_date timestamp NOT NULL,
+    date_collected timestamp NOT NULL,
+    FOREIGN KEY (id_news) REFERENCES news (id_news) ON DELETE CASCADE
+    );
+
+--Create parser_checkpoints table (last message id of channel written by
+--backfill of the parser, to resume backfill)
+CREATE TABLE parser_checkpoints (
+    chat_id BIGINT NOT NULL PRIMARY KEY,
+    news_source TEXT,
+    last_message_id BIGINT NOT NULL,
+    date_updated timestamp NOT NULL
+    );
+
+--Create work_claims table (news claimed for processing by a replica of
+--ml-pipelines, claims of crashed workers are expired by lease_until)
+CREATE TABLE work_claims (
+    stage TEXT NOT NULL,
+    id_news INTEGER NOT NULL,
+    worker TEXT NOT NULL,
+    lease_until timestamp NOT NULL,
+    PRIMARY KEY (stage, id_news),
+    FOREIGN KEY (id_news) REFERENCES news (id_news) ON DELETE CASCADE
+    );
+
+--Create news_minhash table (MinHash signatures of news texts for search of
+--near-duplicates, results of ml-pipelines of the similar news are reused,
+--ents - normalized ners (normal, type) extracted by the ner-pipeline)
+CREATE TABLE news_minhash (
+    id_news INTEGER NOT NULL PRIMARY KEY,
+    signature BYTEA NOT NULL,
+    id_news_similar INTEGER,
+    similarity REAL,
+    ents JSONB,
+    FOREIGN KEY (id_news) REFERENCES news (id_news) ON DELETE CASCADE,
+    FOREIGN KEY (id_news_similar) REFERENCES news (id_news) ON DELETE SET NULL
+    );
+
 --for fuzzy search by SIMILARITY
 CREATE EXTENSION pg_trgm;
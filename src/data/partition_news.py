@@ -0,0 +1,471 @@
+"""Script to move tables news, news_summary and news_links to monthly
+partitioning by news_date (declarative partitioning of postgres) and to
+maintain partitions.
+
+Commands:
+    upgrade - add news_date to news_summary and news_links of database
+              created before it (tables stay unpartitioned): the column is
+              added, filled from news and set NOT NULL in single transaction.
+              Writers and queries of the app and pipelines require the column,
+              so run it (or migrate) at deployment, it does nothing for
+              upgraded databases (run by the app at start and by maintain).
+    migrate - convert tables of create_db_schema.sql to partitioned tables
+              (single transaction, stop the app and pipelines before it):
+              tables are recreated with primary keys (id, news_date),
+              foreign keys (id_news, news_date) of news_summary and news_links
+              to news and local indexes, rows are copied to monthly partitions
+              from the first month of news to MONTHS_AHEAD months ahead.
+              Foreign keys of other tables to news (news_text_hashes,
+              news_duplicates, work_claims, news_minhash) are dropped, as
+              id_news alone is not unique key of partitioned news.
+              Partitionwise join is enabled for the database, so anti-joins
+              of the pipelines (news without summaries and links) join
+              matching partitions instead of whole tables.
+    maintain - create partitions for MONTHS_AHEAD months ahead and move rows
+               from default partitions (e.g. old news of backfill of the
+               parser) to their monthly partitions (nothing to do if tables
+               are not partitioned, but upgrade is run), run periodically
+               (e.g. with pipelines).
+
+Queries filter news_summary and news_links by their news_date (date of the
+news), so only partitions of the date range are scanned.
+
+Run from cli:
+    python src/data/partition_news.py upgrade
+    python src/data/partition_news.py migrate
+    python src/data/partition_news.py maintain --months-ahead 3
+"""
+import os
+import time
+import argparse
+from datetime import date
+import psycopg2
+from psycopg2 import Error
+
+# Hyperparameters
+PG_CONN_CFG = {
+    "dbname": os.environ.get("POSTGRES_DB"),
+    "user": os.environ.get("POSTGRES_USER"),
+    "host": os.environ.get("POSTGRES_HOST"),
+    "port": os.environ.get("POSTGRES_PORT"),
+}
+with open(os.environ.get("POSTGRES_PASSWORD_FILE"), "r") as f:
+    PG_CONN_CFG["password"] = f.readlines()[0].rstrip("\n")
+
+MONTHS_AHEAD = int(os.environ.get("PARTITION_MONTHS_AHEAD", 3))
+
+# partitioned tables (in order of foreign keys) {table: serial column}
+PARTITIONED_TABLES = {
+    "news": "id_news",
+    "news_summary": "id_summary",
+    "news_links": "id_news_links",
+}
+
+# ddl of partitioned tables (format fields - names of sequences of serial
+# columns), local indexes are created on each partition
+PARTITIONED_DDL = """
+CREATE TABLE news (
+    id_news INTEGER NOT NULL DEFAULT nextval('{news}'),
+    news_text TEXT NOT NULL,
+    news_date timestamp NOT NULL,
+    news_source TEXT NOT NULL,
+    date_collected timestamp NOT NULL,
+    PRIMARY KEY (id_news, news_date)
+    ) PARTITION BY RANGE (news_date);
+
+CREATE TABLE news_summary (
+    id_summary INTEGER NOT NULL DEFAULT nextval('{news_summary}'),
+    id_news INTEGER NOT NULL,
+    news_date timestamp NOT NULL,
+    date_generated timestamp NOT NULL,
+    summary_text TEXT NOT NULL,
+    id_model INTEGER NOT NULL,
+    PRIMARY KEY (id_summary, news_date),
+    FOREIGN KEY (id_news, news_date) REFERENCES news (id_news, news_date)
+        ON DELETE CASCADE,
+    FOREIGN KEY (id_model) REFERENCES models (id_model)
+    ) PARTITION BY RANGE (news_date);
+
+CREATE TABLE news_links (
+    id_news_links INTEGER NOT NULL DEFAULT nextval('{news_links}'),
+    id_news INTEGER NOT NULL,
+    news_date timestamp NOT NULL,
+    id_ner INTEGER,
+    PRIMARY KEY (id_news_links, news_date),
+    FOREIGN KEY (id_news, news_date) REFERENCES news (id_news, news_date)
+        ON DELETE CASCADE,
+    FOREIGN KEY (id_ner) REFERENCES ner (id_ner) ON DELETE CASCADE
+    ) PARTITION BY RANGE (news_date);
+
+--news in date range, lookups of news by id (e.g. anti-joins of pipelines)
+CREATE INDEX news_news_date_idx ON news (news_date);
+CREATE INDEX news_id_news_idx ON news (id_news);
+CREATE INDEX news_summary_id_news_idx ON news_summary (id_news, news_date);
+--links in date range (with ners), links of news, links of ner (merges)
+CREATE INDEX news_links_news_date_idx ON news_links (news_date, id_ner);
+CREATE INDEX news_links_id_news_idx ON news_links (id_news, news_date);
+CREATE INDEX news_links_id_ner_idx ON news_links (id_ner);
+
+CREATE TABLE news_default PARTITION OF news DEFAULT;
+CREATE TABLE news_summary_default PARTITION OF news_summary DEFAULT;
+CREATE TABLE news_links_default PARTITION OF news_links DEFAULT;
+"""
+
+# copy of rows of unpartitioned tables (news_date of news_summary and
+# news_links is taken from news)
+COPY_QUERIES = [
+    """
+    INSERT INTO news(id_news, news_text, news_date, news_source, date_collected)
+    SELECT id_news, news_text, news_date, news_source, date_collected
+    FROM news_unpartitioned;
+    """,
+    """
+    INSERT INTO news_summary(id_summary, id_news, news_date, date_generated,
+                             summary_text, id_model)
+    SELECT s.id_summary, s.id_news, n.news_date, s.date_generated,
+           s.summary_text, s.id_model
+    FROM news_summary_unpartitioned AS s
+         INNER JOIN news_unpartitioned AS n USING(id_news);
+    """,
+    """
+    INSERT INTO news_links(id_news_links, id_news, news_date, id_ner)
+    SELECT l.id_news_links, l.id_news, n.news_date, l.id_ner
+    FROM news_links_unpartitioned AS l
+         INNER JOIN news_unpartitioned AS n USING(id_news);
+    """,
+]
+
+
+def add_months(month, n):
+    """First day of month n months after month (date of first day)"""
+    n_months = month.year * 12 + month.month - 1 + n
+    return date(n_months // 12, n_months % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_y{month:%Y}m{month:%m}"
+
+
+def is_partitioned(pg_cur):
+    pg_cur.execute(
+        """
+        SELECT EXISTS (SELECT 1 FROM pg_partitioned_table
+                       WHERE partrelid = to_regclass('news'));
+        """
+    )
+    return pg_cur.fetchone()[0]
+
+
+def get_partitions(pg_cur, table):
+    """Names of partitions of table"""
+    pg_cur.execute(
+        """
+        SELECT inhrelid::regclass::text
+        FROM pg_inherits
+        WHERE inhparent = %s::regclass;
+        """,
+        (table,),
+    )
+    return {row[0] for row in pg_cur.fetchall()}
+
+
+def create_month_partitions(pg_cur, month):
+    """Create partitions of month for all partitioned tables, rows of the month
+    are moved from default partitions (partitions are created as tables and
+    attached, attach checks that default partition has no rows of the month).
+    Tables are locked for writes first (in order of writers, attach of
+    partitions of links and summaries locks news), so rows inserted between
+    copy and delete are not lost.
+    """
+    month_end = add_months(month, 1)
+    pg_cur.execute(
+        "LOCK TABLE {} IN EXCLUSIVE MODE;".format(", ".join(PARTITIONED_TABLES))
+    )
+    for table in PARTITIONED_TABLES:
+        partition = partition_name(table, month)
+        pg_cur.execute(
+            f"""
+            CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS);
+            INSERT INTO {partition}
+            SELECT * FROM {table}_default
+            WHERE news_date >= %(month)s AND news_date < %(month_end)s;
+            """,
+            {"month": month, "month_end": month_end},
+        )
+    # links and summaries first (foreign keys to news)
+    for table in reversed(PARTITIONED_TABLES):
+        pg_cur.execute(
+            f"""
+            DELETE FROM {table}_default
+            WHERE news_date >= %(month)s AND news_date < %(month_end)s;
+            """,
+            {"month": month, "month_end": month_end},
+        )
+    for table in PARTITIONED_TABLES:
+        pg_cur.execute(
+            f"""
+            ALTER TABLE {table} ATTACH PARTITION {partition_name(table, month)}
+            FOR VALUES FROM (%(month)s) TO (%(month_end)s);
+            """,
+            {"month": month, "month_end": month_end},
+        )
+
+
+def get_months_to_create(pg_cur, months_ahead, month_first=None):
+    """Months without partitions: months of rows in default partitions and
+    from month_first (or current month) to months_ahead months ahead.
+
+    Returns:
+        list: first days of months
+    """
+    current_month = date.today().replace(day=1)
+    month = min(month_first or current_month, current_month)
+    months = set()
+    while month <= add_months(current_month, months_ahead):
+        months.add(month)
+        month = add_months(month, 1)
+
+    pg_cur.execute(
+        " UNION ".join(
+            f"SELECT date_trunc('month', news_date)::date FROM {table}_default"
+            for table in PARTITIONED_TABLES
+        )
+    )
+    months.update(row[0] for row in pg_cur.fetchall())
+
+    partitions = get_partitions(pg_cur, "news")
+    return sorted(m for m in months if partition_name("news", m) not in partitions)
+
+
+def get_tables_without_news_date(pg_cur):
+    pg_cur.execute(
+        """
+        SELECT table_name
+        FROM (VALUES ('news_summary'), ('news_links')) AS t(table_name)
+        WHERE NOT EXISTS (SELECT 1 FROM information_schema.columns AS c
+                          WHERE c.table_schema = current_schema() AND
+                                c.table_name = t.table_name AND
+                                c.column_name = 'news_date');
+        """
+    )
+    return [row[0] for row in pg_cur.fetchall()]
+
+
+def add_news_date(pg_conn_cfg):
+    """Add news_date (date of the news) to news_summary and news_links of
+    database created before the column (single transaction, tables are
+    locked).
+
+    Returns:
+        list: upgraded tables
+    """
+    tables = []
+    try:
+        pg_con = psycopg2.connect(
+            dbname=pg_conn_cfg["dbname"],
+            user=pg_conn_cfg["user"],
+            password=pg_conn_cfg["password"],
+            host=pg_conn_cfg["host"],
+            port=pg_conn_cfg["port"],
+        )
+        pg_cur = pg_con.cursor()
+        if len(get_tables_without_news_date(pg_cur)) > 0:
+            # concurrent runs wait here and find upgraded tables
+            pg_cur.execute(
+                "LOCK TABLE news_summary, news_links IN ACCESS EXCLUSIVE MODE;"
+            )
+            tables = get_tables_without_news_date(pg_cur)
+        for table in tables:
+            pg_cur.execute(
+                f"""
+                ALTER TABLE {table} ADD COLUMN news_date timestamp;
+                UPDATE {table}
+                SET news_date = news.news_date
+                FROM news
+                WHERE news.id_news = {table}.id_news AND
+                      {table}.news_date IS Null;
+                ALTER TABLE {table} ALTER COLUMN news_date SET NOT NULL;
+                """
+            )
+        pg_con.commit()
+        if len(tables) > 0:
+            pg_con.autocommit = True
+            pg_cur.execute(f"ANALYZE {', '.join(tables)};")
+            print(f"Info: Column news_date is added to {', '.join(tables)}.")
+        pg_cur.close()
+
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+
+    finally:
+        if "pg_con" in locals() and pg_con:
+            pg_con.close()
+
+    return tables
+
+
+def maintain_partitions(pg_conn_cfg, months_ahead=MONTHS_AHEAD):
+    """Create partitions of future months and of months of rows in default
+    partitions (each month in single transaction).
+
+    Returns:
+        list: first days of months of created partitions
+    """
+    months = []
+    try:
+        pg_con = psycopg2.connect(
+            dbname=pg_conn_cfg["dbname"],
+            user=pg_conn_cfg["user"],
+            password=pg_conn_cfg["password"],
+            host=pg_conn_cfg["host"],
+            port=pg_conn_cfg["port"],
+        )
+        pg_cur = pg_con.cursor()
+        if not is_partitioned(pg_cur):
+            print("Info: Table news is not partitioned (see migrate command).")
+            add_news_date(pg_conn_cfg)
+            return months
+
+        for month in get_months_to_create(pg_cur, months_ahead):
+            create_month_partitions(pg_cur, month)
+            pg_con.commit()
+            months.append(month)
+        print(
+            "Info: Partitions are created for months: "
+            f"{', '.join(f'{m:%Y-%m}' for m in months) or 'none'}."
+        )
+
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+
+    finally:
+        if "pg_con" in locals() and pg_con:
+            pg_con.close()
+
+    return months
+
+
+def rename_unpartitioned(pg_cur):
+    """Rename unpartitioned tables and their indexes (suffix _unpartitioned),
+    detach their sequences and drop foreign keys of other tables to news.
+
+    Returns:
+        dict: {table: name of sequence of serial column}
+    """
+    sequences = {}
+    for table, column in PARTITIONED_TABLES.items():
+        pg_cur.execute("SELECT pg_get_serial_sequence(%s, %s);", (table, column))
+        sequences[table] = pg_cur.fetchone()[0]
+        pg_cur.execute(f"ALTER SEQUENCE {sequences[table]} OWNED BY NONE;")
+
+    pg_cur.execute(
+        """
+        SELECT conrelid::regclass::text, conname
+        FROM pg_constraint
+        WHERE contype = 'f' AND confrelid = 'news'::regclass AND
+              conrelid <> ALL(%s::regclass[]);
+        """,
+        (list(PARTITIONED_TABLES),),
+    )
+    for table, constraint in pg_cur.fetchall():
+        print(f"Info: Foreign key {constraint} of {table} is dropped.")
+        pg_cur.execute(f"ALTER TABLE {table} DROP CONSTRAINT {constraint};")
+
+    for table in PARTITIONED_TABLES:
+        pg_cur.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = %s;", (table,)
+        )
+        for (index,) in pg_cur.fetchall():
+            pg_cur.execute(f"ALTER INDEX {index} RENAME TO {index}_unpartitioned;")
+        pg_cur.execute(f"ALTER TABLE {table} RENAME TO {table}_unpartitioned;")
+    return sequences
+
+
+def migrate_to_partitions(pg_conn_cfg, months_ahead=MONTHS_AHEAD, keep_old=False):
+    """Convert unpartitioned tables news, news_summary and news_links to
+    partitioned tables in single transaction (tables are locked).
+
+    Args:
+        pg_conn_cfg: dict with cfg connect to database
+        months_ahead (int): amount of months ahead of current month with
+                            partitions
+        keep_old (bool): keep unpartitioned tables (with suffix _unpartitioned)
+    """
+    start = time.perf_counter()
+    try:
+        pg_con = psycopg2.connect(
+            dbname=pg_conn_cfg["dbname"],
+            user=pg_conn_cfg["user"],
+            password=pg_conn_cfg["password"],
+            host=pg_conn_cfg["host"],
+            port=pg_conn_cfg["port"],
+        )
+        pg_cur = pg_con.cursor()
+        if is_partitioned(pg_cur):
+            print("Info: Table news is already partitioned.")
+            return
+
+        pg_cur.execute(
+            """
+            LOCK TABLE news, news_summary, news_links IN ACCESS EXCLUSIVE MODE;
+            SELECT date_trunc('month', MIN(news_date))::date FROM news;
+            """
+        )
+        month_first = pg_cur.fetchone()[0]
+
+        sequences = rename_unpartitioned(pg_cur)
+        pg_cur.execute(PARTITIONED_DDL.format(**sequences))
+        for month in get_months_to_create(pg_cur, months_ahead, month_first):
+            create_month_partitions(pg_cur, month)
+
+        for query in COPY_QUERIES:
+            pg_cur.execute(query)
+        pg_cur.execute("SELECT COUNT(*) FROM news_default;")
+        n_default = pg_cur.fetchone()[0]
+
+        for table, column in PARTITIONED_TABLES.items():
+            pg_cur.execute(
+                f"ALTER SEQUENCE {sequences[table]} OWNED BY {table}.{column};"
+            )
+            if not keep_old:
+                pg_cur.execute(f"DROP TABLE {table}_unpartitioned CASCADE;")
+
+        pg_cur.execute(
+            f"ALTER DATABASE {pg_conn_cfg['dbname']} "
+            "SET enable_partitionwise_join = on;"
+        )
+        pg_con.commit()
+        pg_con.autocommit = True
+        pg_cur.execute("ANALYZE news, news_summary, news_links;")
+        print(
+            f"Info: Tables {', '.join(PARTITIONED_TABLES)} are partitioned by "
+            f"months ({len(get_partitions(pg_cur, 'news')) - 1} partitions, "
+            f"{n_default} news in default partition) in "
+            f"{time.perf_counter() - start:.1f} s."
+        )
+        pg_cur.close()
+
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+
+    finally:
+        if "pg_con" in locals() and pg_con:
+            pg_con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("command", choices=["upgrade", "migrate", "maintain"])
+    parser.add_argument("--months-ahead", type=int, default=MONTHS_AHEAD)
+    parser.add_argument(
+        "--keep-old", action="store_true", help="keep unpartitioned tables"
+    )
+    args = parser.parse_args()
+    if args.command == "upgrade":
+        add_news_date(PG_CONN_CFG)
+    elif args.command == "migrate":
+        migrate_to_partitions(PG_CONN_CFG, args.months_ahead, args.keep_old)
+    else:
+        maintain_partitions(PG_CONN_CFG, args.months_ahead)
@@ -1,24 +1,42 @@
 """Script to put custom ners to database.
-Custom ners in /data/inherim/custom_ners.csv
-
-Important! This script does not revise the news_links table, but only
-revises the default name for ners (additionally sets the custom flag
-for them), in addition, adds and changes synonym links to new ners. In
-total, all links to ner for already processed news will remain the same.
-If we only set the default name, then everything is fine, but if we
-rebuilt the links of several synonyms to the new ner, then the old ners
-will remain in the table.
-In general, now the script is fully suitable for an empty base, or for
-revising names, but not for matching several ners into one (for these
-purposes, the script should be finalized, it's not difficult, but not
-relevant at the moment).
+Custom ners in /data/inherim/custom_ners.csv (columns ner_name, qid_wikidata,
+ner_synonym, one row per synonym).
+
+Missing qid_wikidata are resolved concurrently (WIKIDATA_WORKERS threads),
+names already known in the ner table with qid are not requested.
+
+All changes are applied in single transaction by set-based queries: the csv
+is loaded to staging table, then each custom ner is matched with existing
+ners (by qid_wikidata, by ner_name and by ners of its synonyms). If several
+ners are matched, they are merged into one (the ner matched by qid, else by
+name, else the oldest): links of news, synonyms and daily mentions are moved
+to it and the other ners are deleted (the app is notified about news with
+moved links, see notify_news_linked). The remaining ner gets custom name
+(name_is_custom = 1), synonyms are linked to it (new synonyms are added).
+Unmatched custom ners are added. Ner tables are locked from the ner-pipeline
+during the transaction.
+
+Run from cli:
+    python src/data/put_custom_ners.py
+    python src/data/put_custom_ners.py --csv ./custom_ners.csv
 """
+import io
 import os
+import sys
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import pandas as pd
-import numpy as np
 import pymorphy2
-from src.common_funcs import safe_pg_write_query, get_wikidata_qid
+import psycopg2
+from psycopg2 import Error
+from src.common_funcs import (
+    safe_pg_read_query,
+    get_wikidata_qid,
+    bump_data_version,
+    notify_news_linked,
+)
 from src.common_classes import SynNamedEntities
 
 # Hyperparameters
@@ -31,6 +49,249 @@ PG_CONN_CFG = {
 with open(os.environ.get("POSTGRES_PASSWORD_FILE"), "r") as f:
     PG_CONN_CFG["password"] = f.readlines()[0].rstrip("\n")
 
+WIKIDATA_WORKERS = int(os.environ.get("WIKIDATA_WORKERS", 8))
+
+# set-based queries of put_custom_ners (in order, single transaction)
+QUERIES_PUT_CUSTOM_NERS = [
+    # custom ners (ner_name, qid_wikidata)
+    """
+    CREATE TEMP TABLE custom_ner ON COMMIT DROP AS
+    SELECT ner_name, MAX(qid_wikidata) AS qid_wikidata
+    FROM custom_ners_stage
+    GROUP BY ner_name;
+    """,
+    # existing ners matched with custom ners, each ner is matched with one
+    # custom ner (priority: by qid, by name, by synonym)
+    """
+    CREATE TEMP TABLE ner_match ON COMMIT DROP AS
+    SELECT DISTINCT ON (id_ner) id_ner, ner_name, priority
+    FROM (SELECT ner.id_ner, custom_ner.ner_name, 1 AS priority
+          FROM custom_ner INNER JOIN ner
+          ON ner.qid_wikidata = custom_ner.qid_wikidata
+          UNION ALL
+          SELECT ner.id_ner, custom_ner.ner_name, 2
+          FROM custom_ner INNER JOIN ner USING(ner_name)
+          UNION ALL
+          SELECT ner_synonyms.id_ner, custom_ners_stage.ner_name, 3
+          FROM custom_ners_stage INNER JOIN ner_synonyms
+          USING(ner_synonym)) matches
+    ORDER BY id_ner, priority, ner_name;
+    """,
+    # target ner of each matched custom ner
+    """
+    CREATE TEMP TABLE ner_target ON COMMIT DROP AS
+    SELECT DISTINCT ON (ner_name) ner_name, id_ner
+    FROM ner_match
+    ORDER BY ner_name, priority, id_ner;
+    """,
+    # insert unmatched custom ners
+    """
+    WITH inserted AS (
+        INSERT INTO ner(ner_name, qid_wikidata, name_is_custom)
+        SELECT ner_name, qid_wikidata, 1
+        FROM custom_ner
+        WHERE ner_name NOT IN (SELECT ner_name FROM ner_target)
+        RETURNING ner_name, id_ner
+        )
+    INSERT INTO ner_target(ner_name, id_ner)
+    SELECT ner_name, id_ner FROM inserted;
+    """,
+    # set custom names (and missing qid) of target ners
+    """
+    UPDATE ner
+    SET ner_name = custom_ner.ner_name,
+        qid_wikidata = COALESCE(ner.qid_wikidata, custom_ner.qid_wikidata),
+        name_is_custom = 1
+    FROM ner_target INNER JOIN custom_ner USING(ner_name)
+    WHERE ner.id_ner = ner_target.id_ner;
+    """,
+    # ners to merge into target ners
+    """
+    CREATE TEMP TABLE ner_merge ON COMMIT DROP AS
+    SELECT ner_match.id_ner AS id_ner_old, ner_target.id_ner AS id_ner_new
+    FROM ner_match INNER JOIN ner_target USING(ner_name)
+    WHERE ner_match.id_ner <> ner_target.id_ner;
+    """,
+    # news with links of merged ners (the app reloads them, see
+    # notify_news_linked)
+    """
+    CREATE TEMP TABLE news_merged ON COMMIT DROP AS
+    SELECT DISTINCT id_news
+    FROM news_links
+    WHERE id_ner IN (SELECT id_ner_old FROM ner_merge);
+    """,
+    # move news links, drop links duplicated after the move
+    """
+    UPDATE news_links
+    SET id_ner = ner_merge.id_ner_new
+    FROM ner_merge
+    WHERE news_links.id_ner = ner_merge.id_ner_old;
+    """,
+    """
+    DELETE FROM news_links
+    USING news_links AS kept
+    WHERE news_links.id_news = kept.id_news AND
+          news_links.id_ner = kept.id_ner AND
+          news_links.id_news_links > kept.id_news_links AND
+          news_links.id_ner IN (SELECT id_ner_new FROM ner_merge);
+    """,
+    # move synonyms of merged ners
+    """
+    UPDATE ner_synonyms
+    SET id_ner = ner_merge.id_ner_new
+    FROM ner_merge
+    WHERE ner_synonyms.id_ner = ner_merge.id_ner_old;
+    """,
+    # link custom synonyms to target ners
+    """
+    UPDATE ner_synonyms
+    SET id_ner = ner_target.id_ner
+    FROM custom_ners_stage INNER JOIN ner_target USING(ner_name)
+    WHERE ner_synonyms.ner_synonym = custom_ners_stage.ner_synonym AND
+          ner_synonyms.id_ner <> ner_target.id_ner;
+    """,
+    # add new custom synonyms
+    """
+    INSERT INTO ner_synonyms(id_ner, ner_synonym, name_for_match)
+    SELECT DISTINCT ON (ner_synonym) id_ner, ner_synonym, name_for_match
+    FROM custom_ners_stage INNER JOIN ner_target USING(ner_name)
+    WHERE ner_synonym NOT IN (SELECT ner_synonym FROM ner_synonyms)
+    ORDER BY ner_synonym, ner_name;
+    """,
+    # delete merged ners (their daily mentions and metrics are deleted by
+    # cascade, metrics are recalculated by graph_metrics_pipeline)
+    """
+    DELETE FROM ner WHERE id_ner IN (SELECT id_ner_old FROM ner_merge);
+    """,
+    # rebuild daily mentions of target ners of merges
+    """
+    DELETE FROM ner_daily_mentions
+    WHERE id_ner IN (SELECT id_ner_new FROM ner_merge);
+    """,
+    """
+    INSERT INTO ner_daily_mentions(day, id_ner, news_source, mentions)
+    SELECT news_date::date, id_ner, news_source, COUNT(DISTINCT id_news)
+    FROM news_links INNER JOIN news USING(id_news, news_date)
+    WHERE id_ner IN (SELECT id_ner_new FROM ner_merge)
+    GROUP BY news_date::date, id_ner, news_source;
+    """,
+]
+
+
+def resolve_qids(pg_conn_cfg, names, max_workers=WIKIDATA_WORKERS):
+    """Get qid_wikidata of names: from ner table (if exist) or by concurrent
+    requests to wikidata API.
+
+    Args:
+        pg_conn_cfg: dict with cfg connect to database
+        names: list of names
+        max_workers (int): amount of concurrent requests to wikidata
+
+    Returns:
+        dict {name: qid_wikidata or None}
+    """
+    names = list(set(names))
+    query = """
+    SELECT DISTINCT ON (ner_name) ner_name, qid_wikidata
+    FROM ner
+    WHERE qid_wikidata IS NOT Null AND ner_name = ANY(%s)
+    ORDER BY ner_name, id_ner;
+    """
+    name2qid = dict(safe_pg_read_query(pg_conn_cfg, query, (names,)))
+    names_to_request = [name for name in names if name not in name2qid]
+
+    # requests session per thread
+    local = threading.local()
+
+    def request_qid(name):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return get_wikidata_qid(name, local.session)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        name2qid.update(
+            zip(names_to_request, executor.map(request_qid, names_to_request))
+        )
+
+    print(
+        f"Info: qid_wikidata of {len(names)} names: "
+        f"{len(names) - len(names_to_request)} from ner table, "
+        f"{len(names_to_request)} requested to wikidata."
+    )
+    return name2qid
+
+
+def write_custom_ners(pg_conn_cfg, custom_ners_stage):
+    """Load custom ners to staging table and apply QUERIES_PUT_CUSTOM_NERS in
+    single transaction.
+
+    Args:
+        pg_conn_cfg: dict with cfg connect to database
+        custom_ners_stage: DataFrame with columns ner_name, qid_wikidata,
+                           ner_synonym, name_for_match
+
+    Returns:
+        tuple(amount of added ners, amount of merged ners)
+    """
+    try:
+        pg_con = psycopg2.connect(
+            dbname=pg_conn_cfg["dbname"],
+            user=pg_conn_cfg["user"],
+            password=pg_conn_cfg["password"],
+            host=pg_conn_cfg["host"],
+            port=pg_conn_cfg["port"],
+        )
+        pg_cur = pg_con.cursor()
+
+        # lock ner tables from writes of the ner-pipeline (reads are not blocked)
+        pg_cur.execute("LOCK TABLE ner, ner_synonyms IN SHARE ROW EXCLUSIVE MODE;")
+
+        pg_cur.execute(
+            """
+            CREATE TEMP TABLE custom_ners_stage (
+                ner_name TEXT NOT NULL,
+                qid_wikidata TEXT,
+                ner_synonym TEXT NOT NULL,
+                name_for_match TEXT
+                ) ON COMMIT DROP;
+            """
+        )
+        csv_buffer = io.StringIO()
+        custom_ners_stage[
+            ["ner_name", "qid_wikidata", "ner_synonym", "name_for_match"]
+        ].to_csv(csv_buffer, index=False, header=False)
+        csv_buffer.seek(0)
+        pg_cur.copy_expert("COPY custom_ners_stage FROM STDIN WITH CSV", csv_buffer)
+
+        for query in QUERIES_PUT_CUSTOM_NERS:
+            pg_cur.execute(query)
+
+        pg_cur.execute(
+            """
+            SELECT (SELECT COUNT(*) FROM ner_target) -
+                   (SELECT COUNT(DISTINCT ner_name) FROM ner_match),
+                   (SELECT COUNT(*) FROM ner_merge);
+            """
+        )
+        count_added, count_merged = pg_cur.fetchone()
+
+        # links of news are changed (delivered on commit)
+        pg_cur.execute("SELECT id_news FROM news_merged;")
+        notify_news_linked(pg_cur, [row[0] for row in pg_cur.fetchall()])
+
+        pg_con.commit()
+        pg_cur.close()
+
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+        sys.exit(str(error))
+    finally:
+        if "pg_con" in locals() and pg_con:
+            pg_cur.close()
+            pg_con.close()
+
+    return count_added, count_merged
+
 
 def put_custom_ners(pg_conn_cfg, fname_custom_ners_csv):
     """
@@ -42,15 +303,14 @@ def put_custom_ners(pg_conn_cfg, fname_custom_ners_csv):
     """
 
     custom_ners = pd.read_csv(fname_custom_ners_csv)
-    custom_ners
-
-    session = requests.Session()
-    custom_ners["qid_wikidata"] = custom_ners.apply(
-        lambda x: get_wikidata_qid(x.ner_name, session)
-        if x.qid_wikidata is np.NaN
-        else x.qid_wikidata,
-        axis=1,
+
+    missing_qid = custom_ners.qid_wikidata.isna()
+    name2qid = resolve_qids(
+        pg_conn_cfg, custom_ners.loc[missing_qid, "ner_name"].tolist()
     )
+    custom_ners.loc[missing_qid, "qid_wikidata"] = custom_ners.loc[
+        missing_qid, "ner_name"
+    ].map(name2qid)
 
     # check custom_ners not exist different ner_names with same qid_wikidata
     assert (
@@ -62,75 +322,32 @@ def put_custom_ners(pg_conn_cfg, fname_custom_ners_csv):
         .sum()
     )
 
-    to_ner_table = list(
-        set(
-            custom_ners[["ner_name", "qid_wikidata"]].itertuples(index=False, name=None)
-        )
-    )
-
-    to_ner_table = [{"name": row[0], "qid": row[1]} for row in to_ner_table]
-
-    # Update ners to custom, if ner with same Qid exist
-    query = """
-    UPDATE ner
-        SET ner_name = %(name)s,
-            name_is_custom = 1
-    WHERE (qid_wikidata IS NOT Null AND
-        qid_wikidata = %(qid)s) OR
-        (ner_name = %(name)s);
-    """
-    safe_pg_write_query(pg_conn_cfg, query, to_ner_table)
+    # synonyms of custom ners (including ner_name itself)
+    custom_ners_stage = pd.concat(
+        [
+            custom_ners[["ner_name", "qid_wikidata", "ner_synonym"]],
+            custom_ners[["ner_name", "qid_wikidata"]].assign(
+                ner_synonym=custom_ners.ner_name
+            ),
+        ]
+    ).drop_duplicates()
 
-    # INSERT custom ners if ner not exist
-    query = """
-    INSERT INTO ner(ner_name, qid_wikidata, name_is_custom)
-    SELECT %(name)s, %(qid)s, 1
-    WHERE NOT EXISTS(SELECT 1 FROM ner
-                    WHERE ner_name = %(name)s AND
-                    qid_wikidata = %(qid)s);
-    """
-    safe_pg_write_query(pg_conn_cfg, query, to_ner_table)
-
-    to_ner_synonyms_table = list(
-        custom_ners[["ner_synonym", "ner_name"]].itertuples(index=False, name=None)
-    )
-    to_ner_synonyms_table.extend(
-        list(custom_ners[["ner_name", "ner_name"]].itertuples(index=False, name=None))
+    morph = pymorphy2.MorphAnalyzer()
+    custom_ners_stage["name_for_match"] = custom_ners_stage.ner_synonym.map(
+        lambda syn: SynNamedEntities.gen_name_for_match(syn, morph)
     )
-    to_ner_synonyms_table = list(set(to_ner_synonyms_table))
 
-    morph = pymorphy2.MorphAnalyzer()
-    to_ner_synonyms_table = [
-        {
-            "syn": row[0],
-            "name": row[1],
-            "for_match": SynNamedEntities.gen_name_for_match(row[0], morph),
-        }
-        for row in to_ner_synonyms_table
-    ]
-    to_ner_synonyms_table[:5]
-
-    # Update synonyms to custom ners, if synonym exist
-    query = """
-    UPDATE ner_synonyms
-        SET id_ner = (SELECT id_ner FROM ner
-                    WHERE ner_name = %(name)s)
-    WHERE ner_synonym = %(syn)s;
-    """
-    safe_pg_write_query(pg_conn_cfg, query, to_ner_synonyms_table)
+    count_added, count_merged = write_custom_ners(pg_conn_cfg, custom_ners_stage)
+    print(
+        f"Info: {custom_ners.ner_name.nunique()} custom ners put to database: "
+        f"{count_added} ners added, {count_merged} ners merged."
+    )
 
-    # INSERT custom synonyms if synonym not exist
-    query = """
-    INSERT INTO ner_synonyms(id_ner, ner_synonym, name_for_match)
-    SELECT (SELECT id_ner FROM ner
-            WHERE ner_name = %(name)s),
-            %(syn)s,
-            %(for_match)s
-    WHERE NOT EXISTS(SELECT 1 FROM ner_synonyms
-                    WHERE ner_synonym = %(syn)s);
-    """
-    safe_pg_write_query(pg_conn_cfg, query, to_ner_synonyms_table)
+    bump_data_version(pg_conn_cfg)
 
 
 if __name__ == "__main__":
-    put_custom_ners(PG_CONN_CFG, "/data/inherim/custom_ners.csv")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--csv", default="/data/inherim/custom_ners.csv")
+    args = parser.parse_args()
+    put_custom_ners(PG_CONN_CFG, args.csv)
@@ -0,0 +1,260 @@
+"""Graph metrics pipeline script (run from cli).
+
+Description of the algorithm (for each standard window: 1, 7 and 30 days):
+1. We select news links of the window (only news with 2-5 ners, as in the
+   graph of the app)
+2. We build co-occurrence graph of ners as sparse matrix A = B.T @ B, where B
+   is incidence matrix news x ners (weight of edge = amount of common news)
+3. We compute weighted degree, PageRank (power iteration over sparse matrix)
+   and communities (weighted label propagation over sparse matrix)
+4. We replace the results of the window in the ner_metrics table (the app
+   returns top ners from it, see /top_ners route)
+"""
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import psycopg2
+from psycopg2 import Error
+from psycopg2.extras import execute_values
+from src.common_funcs import safe_pg_read_query
+from src.common_metrics import (
+    MetricsCursor,
+    stage_timer,
+    inc,
+    set_gauge,
+    export_metrics,
+)
+
+
+# Hyperparameters
+PG_CONN_CFG = {
+    "dbname": os.environ.get("POSTGRES_DB"),
+    "user": os.environ.get("POSTGRES_USER"),
+    "host": os.environ.get("POSTGRES_HOST"),
+    "port": os.environ.get("POSTGRES_PORT"),
+}
+with open(os.environ.get("POSTGRES_PASSWORD_FILE"), "r") as f:
+    PG_CONN_CFG["password"] = f.readlines()[0].rstrip("\n")
+
+WINDOWS_DAYS = (1, 7, 30)
+
+
+def select_window_links(pg_conn_cfg, window_days):
+    """Select links of news (with 2-5 ners) for last window_days days.
+
+    Returns:
+        pd.DataFrame: with columns id_news, id_ner (unique pairs)
+    """
+    query = """
+    SELECT DISTINCT id_news, id_ner
+    FROM news_links
+    WHERE id_ner IS NOT Null AND
+          news_date >= now() - %s * INTERVAL '1 day';
+    """
+    df_nlinks = pd.DataFrame(
+        safe_pg_read_query(pg_conn_cfg, query, (window_days,)),
+        columns=["id_news", "id_ner"],
+    )
+
+    news_counts = df_nlinks.id_news.map(df_nlinks.id_news.value_counts())
+    return df_nlinks[(news_counts >= 2) & (news_counts <= 5)]
+
+
+def build_cooccurrence(df_nlinks):
+    """Build co-occurrence matrix of ners.
+
+    Args:
+        df_nlinks (pd.DataFrame): with columns id_news, id_ner (unique pairs)
+
+    Returns:
+        tuple(adj, id_ners, news_count): adj - sparse csr matrix (ners x ners,
+            weight = amount of common news, zero diagonal), id_ners - id_ner
+            for each row, news_count - amount of news for each row
+    """
+    news_codes, _ = pd.factorize(df_nlinks.id_news)
+    ner_codes, id_ners = pd.factorize(df_nlinks.id_ner)
+    incidence = sparse.csr_matrix(
+        (np.ones(len(news_codes)), (news_codes, ner_codes)),
+        shape=(news_codes.max() + 1, len(id_ners)),
+    )
+    adj = (incidence.T @ incidence).tocsr()
+    news_count = adj.diagonal().astype(np.int64)
+    adj.setdiag(0)
+    adj.eliminate_zeros()
+    return adj, np.asarray(id_ners), news_count
+
+
+def pagerank(adj, damping=0.85, tol=1e-8, max_iter=100):
+    """PageRank of weighted undirected graph (power iteration).
+
+    Args:
+        adj: sparse csr matrix of weights (symmetric)
+        damping (float): damping factor
+        tol (float): stop when L1 change of ranks < n * tol
+
+    Returns:
+        np.ndarray: ranks (sum = 1)
+    """
+    n = adj.shape[0]
+    degree = np.asarray(adj.sum(axis=1)).ravel()
+    dangling = degree == 0
+    inv_degree = np.divide(1.0, degree, out=np.zeros(n), where=~dangling)
+    # column-stochastic transition: rank_new = adj.T @ (rank / degree)
+    adj_t = adj.T.tocsr()
+
+    rank = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        rank_prev = rank
+        rank = damping * (adj_t @ (rank_prev * inv_degree))
+        rank += (damping * rank_prev[dangling].sum() + 1.0 - damping) / n
+        if np.abs(rank - rank_prev).sum() < n * tol:
+            break
+    return rank
+
+
+def label_propagation(adj, max_iter=50, seed=0):
+    """Communities by weighted label propagation over sparse matrix: at each
+    iteration a random half of nodes takes the label with the largest sum
+    of edge weights among neighbors (updating only a half of nodes prevents
+    oscillations of synchronous updates).
+
+    Returns:
+        np.ndarray: community for each node (0 - the largest community)
+    """
+    n = adj.shape[0]
+    rng = np.random.default_rng(seed)
+    adj = adj.tocoo()
+    labels = np.arange(n)
+    rows = np.arange(n)
+
+    for _ in range(max_iter):
+        # weights of labels for each node (with small bonus to current label,
+        # so node keeps its label in case of tie)
+        label_weights = sparse.csr_matrix(
+            (
+                np.r_[adj.data, np.full(n, 1e-6)],
+                (np.r_[adj.row, rows], np.r_[labels[adj.col], labels]),
+            ),
+            shape=(n, n),
+        )
+        best_labels = np.asarray(label_weights.argmax(axis=1)).ravel()
+        update = (best_labels != labels) & (rng.random(n) < 0.5)
+        if not update.any():
+            if (best_labels == labels).all():
+                break
+            continue
+        labels[update] = best_labels[update]
+
+    # number communities by size
+    _, labels, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    order = np.argsort(-sizes, kind="stable")
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank[labels]
+
+
+def compute_window_metrics(df_nlinks):
+    """Compute metrics of ners in co-occurrence graph.
+
+    Returns:
+        pd.DataFrame: with columns id_ner, news_count, weighted_degree,
+                      pagerank, community
+    """
+    if len(df_nlinks) == 0:
+        return pd.DataFrame(
+            columns=["id_ner", "news_count", "weighted_degree", "pagerank", "community"]
+        )
+
+    adj, id_ners, news_count = build_cooccurrence(df_nlinks)
+    return pd.DataFrame(
+        {
+            "id_ner": id_ners,
+            "news_count": news_count,
+            "weighted_degree": np.asarray(adj.sum(axis=1)).ravel(),
+            "pagerank": pagerank(adj),
+            "community": label_propagation(adj),
+        }
+    )
+
+
+def write_window_metrics(pg_conn_cfg, window_days, df_metrics):
+    """Replace metrics of the window in ner_metrics table (in one transaction)."""
+    try:
+        pg_con = psycopg2.connect(
+            dbname=pg_conn_cfg["dbname"],
+            user=pg_conn_cfg["user"],
+            password=pg_conn_cfg["password"],
+            host=pg_conn_cfg["host"],
+            port=pg_conn_cfg["port"],
+        )
+        pg_cur = pg_con.cursor(cursor_factory=MetricsCursor)
+        pg_cur.execute(
+            "DELETE FROM ner_metrics WHERE window_days = %s;", (window_days,)
+        )
+        execute_values(
+            pg_cur,
+            """
+            INSERT INTO ner_metrics (window_days, id_ner, news_count,
+                                     weighted_degree, pagerank, community,
+                                     date_calc)
+            VALUES %s;
+            """,
+            [
+                (
+                    window_days,
+                    int(row.id_ner),
+                    int(row.news_count),
+                    float(row.weighted_degree),
+                    float(row.pagerank),
+                    int(row.community),
+                )
+                for row in df_metrics.itertuples()
+            ],
+            template="(%s, %s, %s, %s, %s, %s, now())",
+            page_size=1000,
+        )
+        pg_con.commit()
+        pg_cur.close()
+        inc("ml_rows_written_total", len(df_metrics), table="ner_metrics")
+
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+        sys.exit(str(error))
+
+    finally:
+        if "pg_con" in locals() and pg_con:
+            pg_con.close()
+
+
+def graph_metrics_pipeline(pg_conn_cfg, windows_days=WINDOWS_DAYS):
+    """All graph metrics pipeline function."""
+    for window_days in windows_days:
+        start = time.perf_counter()
+        # 1. Select news links of the window
+        with stage_timer("graph_metrics", f"select_{window_days}d") as stage:
+            df_nlinks = select_window_links(pg_conn_cfg, window_days)
+            stage["items"] = len(df_nlinks)
+        # 2-3. Build co-occurrence graph and compute metrics
+        with stage_timer("graph_metrics", f"compute_{window_days}d", len(df_nlinks)):
+            df_metrics = compute_window_metrics(df_nlinks)
+        # 4. Write results to database
+        with stage_timer("graph_metrics", f"db_write_{window_days}d", len(df_metrics)):
+            write_window_metrics(pg_conn_cfg, window_days, df_metrics)
+
+        print(
+            f"Info: Graph metrics for {window_days} days: {len(df_metrics)} ners, "
+            f"{df_metrics.community.nunique()} communities "
+            f"({time.perf_counter() - start:.1f} s)."
+        )
+
+    set_gauge(
+        "ml_last_success_timestamp_seconds", time.time(), pipeline="graph_metrics"
+    )
+    export_metrics()
+
+
+if __name__ == "__main__":
+    graph_metrics_pipeline(PG_CONN_CFG)
@@ -1,27 +1,53 @@
 """Ner-pipeline script (run from cli).
 
 Description of the algorithm:
-1. We select news for their transfer to the ner-pipeline (the main selection
-   criteria: its summary is already available for the news, the news has not
-   yet been processed by the ner-pipeline)
+1. We claim a batch of news for their transfer to the ner-pipeline (the main
+   selection criteria: its summary is already available for the news, the news
+   has not yet been processed by the ner-pipeline and is not claimed by other
+   replica of the pipeline), steps 2-5 are repeated for each batch
 2. We extract ner and bring them to normal form (note: first of all, we try
    to extract NER from the summary, if in total we have >= 2 NER, then we stop
-   there, otherwise (NER < 2), we try to extract NER from full text of the news)
+   there, otherwise (NER < 2), we try to extract NER from full text of the news),
+   for near-duplicates of processed news (see common_minhash) their NER are reused
 3. We carry out the Entity linking procedure, we try to match based on the
-   local database, if it doesn't work, through an external request to wikidata
+   local database (by synonyms, then by similar synonyms in trigram index of
+   ner_synonyms), if it doesn't work, through an external request to wikidata
    (we additionally save the results of the request to wikidata in local databases)
 4. We enter the results of the work into the database (tables news_links, ner,
-   ner_synonyms, synonyms_stats)
+   ner_synonyms, synonyms_stats, ner_daily_mentions), ner tables are locked
+   from other replicas and entities are re-matched under the lock
 5. We review the default names for ner in the ner table (based on usage statistics,
    and it is desirable to review only for ners for which new values were added to
    the ner_synonyms table as a result of the pipeline)
 """
 import re
 import os
+import json
 import sys
+import time
+import argparse
 import warnings
-from src.common_funcs import safe_pg_read_query, safe_pg_write_query
+from functools import lru_cache
+from src.common_funcs import (
+    safe_pg_read_query,
+    safe_pg_write_query,
+    bump_data_version,
+    notify_news_linked,
+    upsert_ner_daily_mentions,
+    claim_news,
+    release_claims,
+)
 from src.common_classes import SynNamedEntities
+from src.app.ner_lookup import NerLookup
+from src.common_metrics import (
+    MetricsCursor,
+    stage_timer,
+    inc,
+    set_gauge,
+    export_metrics,
+)
+from src.common_minhash import report_near_duplicates
+from src.common_profiling import enable_profiling
 import psycopg2
 from psycopg2 import Error
 from psycopg2.extras import execute_values
@@ -41,8 +67,34 @@ PG_CONN_CFG = {
 with open(os.environ.get("POSTGRES_PASSWORD_FILE"), "r") as f:
     PG_CONN_CFG["password"] = f.readlines()[0].rstrip("\n")
 
+# work claiming (for several replicas of the pipeline): news are claimed by
+# batches, claim of crashed worker is expired after lease (in seconds)
+CLAIM_STAGE = "ner"
+CLAIM_BATCH_SIZE = int(os.environ.get("NER_CLAIM_BATCH", 1000))
+CLAIM_LEASE = int(os.environ.get("CLAIM_LEASE", 3600))
+
+# fuzzy search of entities in local trigram index of ner_synonyms (before
+# wikidata), new synonyms are loaded to index once per NER_INDEX_REFRESH seconds
+# (thresholds are checked by src/benchmarks/bench_ner_index.py)
+NER_INDEX_THRESHOLD = float(os.environ.get("NER_INDEX_THRESHOLD", 0.65))
+NER_INDEX_MARGIN = float(os.environ.get("NER_INDEX_MARGIN", 0.1))
+NER_INDEX_WORD_THRESHOLD = float(os.environ.get("NER_INDEX_WORD_THRESHOLD", 0.3))
+NER_INDEX_REFRESH = float(os.environ.get("NER_INDEX_REFRESH", 60))
+
+
+# ids of news to the ner-pipeline (criteria 1-3 of select_news_to_ner_pip),
+# candidates to claim (anti-join by id_news and news_date, as for summarization)
+QUERY_NEWS_TO_NER_CANDIDATES = """
+SELECT id_news
+FROM news_summary
+WHERE NOT EXISTS (SELECT 1 FROM news_links
+                  WHERE news_links.id_news = news_summary.id_news AND
+                        news_links.news_date = news_summary.news_date) AND
+      (%(id_news)s::integer[] IS Null OR id_news = ANY(%(id_news)s))
+"""
+
 
-def select_news_to_ner_pip(pg_conn_cfg):
+def select_news_to_ner_pip(pg_conn_cfg, id_news=None):
     """
     Select news to transfer them to the ner-pipeline.
     Selection criteria:
@@ -52,6 +104,7 @@ def select_news_to_ner_pip(pg_conn_cfg):
     news_links table there are no records for it, i.e. missing id_news (for
     news for which we cannot extract any ner, in the table news_links is
     written with id_news and id_ner = Null)
+    3) If id_news is set, only news from id_news
 
     Returns:
         list of tuples(id_news, news_text, summary_text)
@@ -59,23 +112,103 @@ def select_news_to_ner_pip(pg_conn_cfg):
 
     query_news_to_ner_pipeline = """
     SELECT news.id_news, news_text, summary_text
-    FROM (SELECT id_news, news_text
+    FROM (SELECT id_news, news_date, news_text
           FROM news
-          WHERE id_news NOT IN (SELECT DISTINCT id_news
-                                FROM news_links)) AS news
+          WHERE NOT EXISTS (SELECT 1 FROM news_links
+                            WHERE news_links.id_news = news.id_news AND
+                                  news_links.news_date = news.news_date) AND
+                (%(id_news)s::integer[] IS Null OR
+                 id_news = ANY(%(id_news)s))) AS news
          INNER JOIN news_summary
-         ON news.id_news = news_summary.id_news;
+         ON news.id_news = news_summary.id_news AND
+            news.news_date = news_summary.news_date;
     """
     # list of tuples(id_news, news_text, summary_text)
-    return safe_pg_read_query(pg_conn_cfg, query_news_to_ner_pipeline)
+    return safe_pg_read_query(
+        pg_conn_cfg,
+        query_news_to_ner_pipeline,
+        {"id_news": None if id_news is None else list(id_news)},
+    )
+
+
+def select_similar_news_ents(pg_conn_cfg, id_news):
+    """Select near-duplicates of news (found by the summarization pipeline,
+    see common_minhash) with ners of processed near-duplicates.
+
+    Returns:
+        dict: {id_news: (id_news_similar, tuple of tuples(norm ner, ner_type)
+               or None if near-duplicate is not processed yet)}
+    """
+    query = """
+    SELECT m.id_news, m.id_news_similar, src.ents
+    FROM news_minhash AS m
+         LEFT JOIN news_minhash AS src
+         ON src.id_news = m.id_news_similar
+    WHERE m.id_news = ANY(%s) AND m.id_news_similar IS NOT Null;
+    """
+    rows = safe_pg_read_query(pg_conn_cfg, query, (list(id_news),))
+    return {
+        id_news: (
+            id_similar,
+            None if ents is None else tuple(tuple(ent) for ent in ents),
+        )
+        for id_news, id_similar, ents in rows
+    }
+
 
+_ner_index = None
 
-def get_norm_ners_from_news(news_to_ner):  # noqa C901
+
+def get_ner_index(pg_conn_cfg):
+    """Trigram index of ner_synonyms (loaded once per process, then refreshed
+    incrementally by new synonyms)
+
+    Returns:
+        NerLookup
+    """
+    global _ner_index
+    if _ner_index is None:
+        _ner_index = NerLookup(pg_conn_cfg, refresh_interval=NER_INDEX_REFRESH)
+    return _ner_index
+
+
+@lru_cache(maxsize=1)
+def get_nlp_models():
+    """Load stanza and natasha models (once per process, e.g. for stream
+    pipeline)
+
+    Returns:
+        tuple(stanza_nlp, natasha_segmenter, natasha_morph_vocab,
+              natasha_morph_tagger, natasha_ner_tagger)
+    """
+    with stage_timer(CLAIM_STAGE, "model_load"):
+        # for stanza nlp-pipline
+        stanza_nlp = stanza.Pipeline(lang="ru", processors="tokenize,ner")
+
+        # for natasha nlp-pipline
+        natasha_segmenter = natasha.Segmenter()
+        natasha_morph_vocab = natasha.MorphVocab()
+        natasha_emb = natasha.NewsEmbedding()
+        natasha_morph_tagger = natasha.NewsMorphTagger(natasha_emb)
+        natasha_ner_tagger = natasha.NewsNERTagger(natasha_emb)
+
+    return (
+        stanza_nlp,
+        natasha_segmenter,
+        natasha_morph_vocab,
+        natasha_morph_tagger,
+        natasha_ner_tagger,
+    )
+
+
+def get_norm_ners_from_news(news_to_ner, similar=None):  # noqa C901
     """Get normalized ners for list news (from summary or full text). If amount
-    of ners from summary < 2, trying to get ners from full text.
+    of ners from summary < 2, trying to get ners from full text. Ners of
+    near-duplicates are reused (from db or from news of the batch).
 
     Args:
         news_to_ner: list of tuples(id, text, summary)
+        similar: dict of near-duplicates, see select_similar_news_ents
     Returns:
         SynNamedEntities: with .ents (filled .name_syn, .ntype, .news_ids),
                                .news_without_ents
@@ -171,20 +304,46 @@ def get_norm_ners_from_news(news_to_ner):  # noqa C901
     # pattern to clean news text from ⚡️🎾❗️🌏... and other
     clean_re = re.compile(r"[^\x20-\xFFа-яА-ЯёЁ№\n]+|__|\*\*")
 
-    # for stanza nlp-pipline
-    stanza_nlp = stanza.Pipeline(lang="ru", processors="tokenize,ner")
-
-    # for natasha nlp-pipline
-    natasha_segmenter = natasha.Segmenter()
-    natasha_morph_vocab = natasha.MorphVocab()
-    natasha_emb = natasha.NewsEmbedding()
-    natasha_morph_tagger = natasha.NewsMorphTagger(natasha_emb)
-    natasha_ner_tagger = natasha.NewsNERTagger(natasha_emb)
+    # stanza and natasha nlp-piplines (loaded once per process)
+    (
+        stanza_nlp,
+        natasha_segmenter,
+        natasha_morph_vocab,
+        natasha_morph_tagger,
+        natasha_ner_tagger,
+    ) = get_nlp_models()
+
+    # {id_news: ((norm ner01, ner_type01), (norm ner02, ner_type02), ...)}
+    similar = similar or {}
+    start = time.perf_counter()
+    ents = {
+        news[0]: get_norm_ners_from_one_news(news)
+        for news in news_to_ner
+        if news[0] not in similar
+    }
+    n_extracted = len(ents)
+    seconds_per_news = (time.perf_counter() - start) / max(n_extracted, 1)
+
+    for news in news_to_ner:
+        if news[0] not in similar:
+            continue
+        id_similar, similar_ents = similar[news[0]]
+        if similar_ents is None:
+            similar_ents = ents.get(id_similar)
+        if similar_ents is None:
+            similar_ents = get_norm_ners_from_one_news(news)
+            n_extracted += 1
+        ents[news[0]] = similar_ents
+
+    report_near_duplicates(
+        CLAIM_STAGE,
+        len(news_to_ner),
+        len(news_to_ner) - n_extracted,
+        seconds_per_news,
+    )
 
     # list of tuple(id_news, ((norm ner01, ner_type01), (norm ner02, ner_type02), ...)
-    news_with_ents = list(
-        map(lambda x: (x[0], get_norm_ners_from_one_news(x)), news_to_ner)
-    )
+    news_with_ents = [(news[0], ents[news[0]]) for news in news_to_ner]
 
     synonyms = SynNamedEntities()
     synonyms.add_ents_from_news(news_with_ents)
@@ -194,9 +353,10 @@ def get_norm_ners_from_news(news_to_ner):  # noqa C901
 
 def entity_linking(pg_conn_cfg, synonyms):
     """Entity linking and preparation of data for writing to the database.
-    Algorithm: We try to match based on the local database, if it doesn’t
-    work, through an external request to wikidata (we additionally save
-    the results of the request to wikidata in local databases).
+    Algorithm: We try to match based on the local database (by synonyms,
+    then by similar synonyms in local index), if it doesn’t work, through an
+    external request to wikidata (we additionally save the results of the
+    request to wikidata in local databases).
 
     Args:
         synonyms (SynNamedEntities): with
@@ -235,7 +395,22 @@ def entity_linking(pg_conn_cfg, synonyms):
     db_syn_match2id = dict(safe_pg_read_query(pg_conn_cfg, query))
     synonyms.search_in_synonym_table(db_syn_name2id, db_syn_match2id)
 
-    # 02. Attempt to match entity by qid_wikidata in ner table
+    # 02. Attempt to find similar synonyms (e.g. misspelled) in local index
+    if synonyms.count_without_id_ner > 0:
+        n_unmatched = synonyms.count_without_id_ner
+        matched = synonyms.search_in_ner_index(
+            get_ner_index(pg_conn_cfg),
+            NER_INDEX_THRESHOLD,
+            NER_INDEX_MARGIN,
+            NER_INDEX_WORD_THRESHOLD,
+        )
+        inc("ml_ner_index_matches_total", matched)
+        print(
+            f"Info: {matched} of {n_unmatched} entities are matched by similar "
+            "synonyms in local index."
+        )
+
+    # 03. Attempt to match entity by qid_wikidata in ner table
 
     if synonyms.count_without_id_ner > 0:
         # query to wikidata API for get qid for entities without id_ner
@@ -252,7 +427,37 @@ def entity_linking(pg_conn_cfg, synonyms):
     return synonyms
 
 
-def write_db_results_ner_pipeline(pg_conn_cfg, synonyms):
+def rematch_entities(pg_cur, synonyms):
+    """Repeat local entity linking for entities not found in ner_synonyms
+    table (call under lock of ner tables).
+    """
+    # get dict {ner_synonym01: id_ner01, ...}
+    pg_cur.execute("SELECT DISTINCT ner_synonym, id_ner FROM ner_synonyms;")
+    db_syn_name2id = dict(pg_cur.fetchall())
+
+    # get dict {name_for_match01: id_ner01, ...}
+    pg_cur.execute(
+        """
+        SELECT DISTINCT name_for_match, id_ner
+        FROM ner_synonyms
+        WHERE name_for_match IS NOT Null;
+        """
+    )
+    db_syn_match2id = dict(pg_cur.fetchall())
+
+    # get dict {qid_wikidata01: id_ner01, ...}
+    pg_cur.execute(
+        """
+        SELECT qid_wikidata, id_ner FROM ner
+        WHERE qid_wikidata IS NOT Null;
+        """
+    )
+    db_ner_qid2id = dict(pg_cur.fetchall())
+
+    synonyms.rematch_new_synonyms(db_syn_name2id, db_syn_match2id, db_ner_qid2id)
+
+
+def write_db_results_ner_pipeline(pg_conn_cfg, synonyms, id_news):
     """Write to the database in single transaction the results of the ner-pipeline.
 
     Args:
@@ -267,9 +472,10 @@ def write_db_results_ner_pipeline(pg_conn_cfg, synonyms):
                         self.id_ner - for ents founded in local database by
                                       syn_name or wikidata_qid),
                  .news_without_ents
+        id_news: list of ids of news claimed by the worker
 
     Returns:
-        None: Results write to database.
+        list: ids of linked news (results are written to database)
 
     """
 
@@ -284,9 +490,20 @@ def write_db_results_ner_pipeline(pg_conn_cfg, synonyms):
             host=pg_conn_cfg["host"],
             port=pg_conn_cfg["port"],
         )
-        pg_cur = pg_con.cursor()
+        pg_cur = pg_con.cursor(cursor_factory=MetricsCursor)
+
+        # 00. Lock ner tables from writes of other replicas of the ner-pipeline
+        # (reads are not blocked), release claims (skip news claimed by other
+        # worker after expired lease) and re-match entities added by other
+        # replicas since entity linking
+        pg_cur.execute("LOCK TABLE ner, ner_synonyms IN SHARE ROW EXCLUSIVE MODE;")
+        claimed = release_claims(pg_cur, CLAIM_STAGE, id_news)
+        synonyms.remove_news(set(id_news) - claimed)
+        if synonyms.count_without_id_ner > 0:
+            rematch_entities(pg_cur, synonyms)
 
         # 01. Insert new ents (without .id_ner) to ner table
+        rows_to_ner_table = []
         if synonyms.count_without_id_ner > 0:
             rows_to_ner_table = synonyms.get_rows_to_ner_table()
             query = """
@@ -331,7 +548,10 @@ def write_db_results_ner_pipeline(pg_conn_cfg, synonyms):
         # 04. Insert rows to db news_links table
         rows_to_news_links = synonyms.get_rows_to_news_links_table()
         query = """
-        INSERT INTO news_links(id_news, id_ner) VALUES %s;
+        INSERT INTO news_links(id_news, news_date, id_ner)
+        SELECT data.id_news, news.news_date, data.id_ner::integer
+        FROM (VALUES %s) AS data(id_news, id_ner)
+             INNER JOIN news USING(id_news);
         """
         execute_values(pg_cur, query, rows_to_news_links)
         print(f"Info: Table news_links: {len(rows_to_news_links)} rows added.")
@@ -356,10 +576,39 @@ def write_db_results_ner_pipeline(pg_conn_cfg, synonyms):
 
         print(f"Info: Table synonyms_stats: {len(rows_to_syn_stats)} rows added.")
 
+        # 06. Add mentions of the news to daily rollup table
+        linked_id_news = sorted({row[0] for row in rows_to_news_links})
+        upsert_ner_daily_mentions(pg_cur, linked_id_news)
+
+        # 07. Notify listeners (e.g. app graph store) about newly linked news
+        # (notifications are delivered on commit)
+        notify_news_linked(pg_cur, linked_id_news)
+
+        # 08. Save ners of news with MinHash signatures (to reuse for
+        # near-duplicates, see common_minhash)
+        rows_to_minhash = [
+            (news_id, json.dumps([list(ent) for ent in ents], ensure_ascii=False))
+            for news_id, ents in synonyms.news_ents.items()
+        ]
+        if len(rows_to_minhash) > 0:
+            query = """
+            UPDATE news_minhash SET ents = data.ents::jsonb
+            FROM (VALUES %s) AS data(id_news, ents)
+            WHERE news_minhash.id_news = data.id_news;
+            """
+            execute_values(pg_cur, query, rows_to_minhash)
+
         ##########################
         # END SINGLE TRANSACTION #
         pg_con.commit()
         print("Info: Data has been successfully committed to the database.")
+        for table, rows in (
+            ("ner", rows_to_ner_table),
+            ("ner_synonyms", rows_to_ner_syn),
+            ("news_links", rows_to_news_links),
+            ("synonyms_stats", rows_to_syn_stats),
+        ):
+            inc("ml_rows_written_total", len(rows), table=table)
         pg_cur.close()
 
     except (Exception, Error) as error:
@@ -370,6 +619,8 @@ def write_db_results_ner_pipeline(pg_conn_cfg, synonyms):
             pg_cur.close()
             pg_con.close()
 
+    return linked_id_news
+
 
 def update_main_ner_names_and_types(pg_conn_cfg):
     # Update main ner names.
@@ -444,27 +695,89 @@ def update_main_ner_names_and_types(pg_conn_cfg):
     safe_pg_write_query(pg_conn_cfg, query)
 
 
-def ner_pipeline(pg_conn_cfg):
-    """All ner pipeline function."""
+def ner_pipeline(pg_conn_cfg, id_news=None):
+    """All ner pipeline function. News are processed by batches claimed by
+    the worker (several replicas of the pipeline process different news).
+    Metrics of stages are exported by export_metrics.
 
-    # 1. Select news for their transfer to the ner-pipeline
-    news_to_ner = select_news_to_ner_pip(pg_conn_cfg)
+    Args:
+        pg_conn_cfg: dict with cfg connect to database
+        id_news: list of ids of news to process (None - all news selected by
+                 select_news_to_ner_pip)
 
-    # Unit-Test
-    # news_to_ner = news_to_ner[:5000]
+    Returns:
+        list: ids of processed news
+    """
+    placeholder = {"id_news": None if id_news is None else list(id_news)}
+    backlog = safe_pg_read_query(
+        pg_conn_cfg,
+        f"SELECT COUNT(*) FROM ({QUERY_NEWS_TO_NER_CANDIDATES}) candidates;",
+        placeholder,
+    )[0][0]
+    set_gauge("ml_backlog_news", backlog, pipeline=CLAIM_STAGE)
+
+    processed = []
+    while True:
+        # 1. Claim and select news for their transfer to the ner-pipeline
+        with stage_timer(CLAIM_STAGE, "select") as stage:
+            claimed = claim_news(
+                pg_conn_cfg,
+                CLAIM_STAGE,
+                QUERY_NEWS_TO_NER_CANDIDATES,
+                placeholder,
+                CLAIM_BATCH_SIZE,
+                CLAIM_LEASE,
+            )
+            news_to_ner = []
+            if len(claimed) > 0:
+                news_to_ner = select_news_to_ner_pip(pg_conn_cfg, claimed)
+            stage["items"] = len(news_to_ner)
+        if len(claimed) == 0:
+            break
+
+        # Unit-Test
+        # news_to_ner = news_to_ner[:5000]
+
+        print("Info: {} news selected to ner pipeline.".format(len(news_to_ner)))
+
+        if len(news_to_ner) > 0:
+            # 2. Ner extraction and normilization
+            with stage_timer(CLAIM_STAGE, "ner_extraction", len(news_to_ner)):
+                synonyms = get_norm_ners_from_news(
+                    news_to_ner, select_similar_news_ents(pg_conn_cfg, claimed)
+                )
+            # 3. Entity linking
+            with stage_timer(CLAIM_STAGE, "entity_linking", len(news_to_ner)):
+                synonyms = entity_linking(pg_conn_cfg, synonyms)
+            # 4. Write results to database
+            with stage_timer(CLAIM_STAGE, "db_write", len(news_to_ner)):
+                processed.extend(
+                    write_db_results_ner_pipeline(pg_conn_cfg, synonyms, claimed)
+                )
+            # 5. Update default тук names if needed
+            with stage_timer(CLAIM_STAGE, "update_names"):
+                update_main_ner_names_and_types(pg_conn_cfg)
 
-    print("Info: {} news selected to ner pipeline.".format(len(news_to_ner)))
+    if len(processed) > 0:
+        # 6. Notify the app that data has been changed
+        bump_data_version(pg_conn_cfg)
 
-    if len(news_to_ner) > 0:
-        # 2. Ner extraction and normilization
-        synonyms = get_norm_ners_from_news(news_to_ner)
-        # 3. Entity linking
-        synonyms = entity_linking(pg_conn_cfg, synonyms)
-        # 4. Write results to database
-        write_db_results_ner_pipeline(pg_conn_cfg, synonyms)
-        # 5. Update default тук names if needed
-        update_main_ner_names_and_types(pg_conn_cfg)
+    set_gauge("ml_last_success_timestamp_seconds", time.time(), pipeline=CLAIM_STAGE)
+    export_metrics()
+    return processed
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="DIR",
+        help="profile stages (cpu and memory), artifacts to DIR or PROFILE_DIR env",
+    )
+    args = parser.parse_args()
+    if args.profile is not None:
+        enable_profiling(args.profile or None)
     ner_pipeline(PG_CONN_CFG)
@@ -0,0 +1,312 @@
+"""Overlapped ml-pipeline script (run from cli), alternative to sequential run
+of summarization_pipeline.py and ner_pipeline.py for backlog of news.
+
+Description of the algorithm:
+Stages of both pipelines are run by separate workers (threads) connected by
+bounded queues, so a batch of news goes to the ner stages as soon as its
+summaries are written (not after the whole backlog of summarization):
+1. summarization select - claim batch of news without summary
+   (PIPE_BATCH_SIZE news)
+2. summarization inference - summarization model
+3. summarization db_write - write summaries and claim the news for the
+   ner-pipeline
+4. ner select - claim news, which had summary but were not linked at start
+   (backlog of the ner-pipeline)
+5. ner ner_extraction - stanza and natasha
+6. ner entity_linking - local database and wikidata requests
+7. ner db_write - write results of the ner-pipeline (ner tables are locked
+   and entities are re-matched, as for replicas of the ner-pipeline)
+8. At the end we update default names of ners and bump data version
+
+Each queue holds at most PIPE_QUEUE_SIZE batches, a stage waits while its
+output queue is full (backpressure), so wall time of backlog approaches time
+of the slowest stage instead of sum of all stages. Models and I/O release
+GIL, so threads are enough (and models are loaded once).
+
+If any worker fails, other workers are stopped and the script exits with
+error, claims of unprocessed news are expired after CLAIM_LEASE.
+"""
+import os
+import sys
+import time
+import queue
+import threading
+from src.common_funcs import safe_pg_read_query, claim_news, bump_data_version
+from src.common_metrics import stage_timer, set_gauge, export_metrics
+from src.common_minhash import get_minhash_index
+from src.models import summarization_pipeline as summ
+from src.models import ner_pipeline as ner
+
+# Hyperparameters
+PG_CONN_CFG = {
+    "dbname": os.environ.get("POSTGRES_DB"),
+    "user": os.environ.get("POSTGRES_USER"),
+    "host": os.environ.get("POSTGRES_HOST"),
+    "port": os.environ.get("POSTGRES_PORT"),
+}
+with open(os.environ.get("POSTGRES_PASSWORD_FILE"), "r") as f:
+    PG_CONN_CFG["password"] = f.readlines()[0].rstrip("\n")
+
+PIPE_BATCH_SIZE = int(os.environ.get("PIPE_BATCH_SIZE", 100))
+PIPE_QUEUE_SIZE = int(os.environ.get("PIPE_QUEUE_SIZE", 2))
+QUEUE_POLL = 1.0  # seconds between checks of failure of other workers
+
+STOP = None  # end of batches of producer
+
+
+class WorkerStopped(Exception):
+    """Other worker failed"""
+
+
+class StageWorkers:
+    """Stages run by threads, connected by bounded queues (stage gets batches
+    from input queue, puts results to output queue, results None are
+    skipped)."""
+
+    def __init__(self, queue_size=PIPE_QUEUE_SIZE) -> None:
+        self.queue_size = queue_size
+        self.failed = threading.Event()
+        self.errors = []
+        self.busy = {}  # {"pipeline.stage": seconds of processing}
+        self._queues = {}  # {name: (queue, amount of producers)}
+        self._threads = []
+
+    def _queue(self, name):
+        return self._queues.setdefault(name, [queue.Queue(self.queue_size), 0])
+
+    def put(self, name, item):
+        """Put item to queue (wait while it is full, unless other worker
+        failed)"""
+        while not self.failed.is_set():
+            try:
+                self._queues[name][0].put(item, timeout=QUEUE_POLL)
+                return
+            except queue.Full:
+                pass
+        raise WorkerStopped()
+
+    def iter_queue(self, name):
+        """Items of queue until all its producers are stopped"""
+        q, n_producers = self._queues[name]
+        stopped = 0
+        while stopped < n_producers:
+            try:
+                item = q.get(timeout=QUEUE_POLL)
+            except queue.Empty:
+                if self.failed.is_set():
+                    raise WorkerStopped()
+                continue
+            if item is STOP:
+                stopped += 1
+            else:
+                yield item
+
+    def add_stage(self, pipeline, stage, process, source, output=None):
+        """Add stage.
+
+        Args:
+            pipeline (str): name of pipeline (label of metrics)
+            stage (str): name of stage
+            process: function of batch, returns (result, amount of items)
+            source: name of input queue or iterable of batches
+            output (str): name of output queue (None - results are dropped)
+        """
+        if output is not None:
+            self._queue(output)[1] += 1
+        self._threads.append(
+            threading.Thread(
+                target=self._run_stage,
+                args=(pipeline, stage, process, source, output),
+                name=stage,
+                daemon=True,
+            )
+        )
+
+    def _run_stage(self, pipeline, stage, process, source, output):
+        try:
+            batches = self.iter_queue(source) if isinstance(source, str) else source
+            for batch in batches:
+                start = time.perf_counter()
+                with stage_timer(pipeline, stage) as info:
+                    result, info["items"] = process(batch)
+                key = f"{pipeline}.{stage}"
+                self.busy[key] = self.busy.get(key, 0.0) + time.perf_counter() - start
+                if result is not None and output is not None:
+                    self.put(output, result)
+            if output is not None:
+                self.put(output, STOP)
+        except WorkerStopped:
+            pass
+        except BaseException as error:  # incl. sys.exit of db functions
+            print(f"Error in stage {stage}:\n", error)
+            self.errors.append((stage, error))
+            self.failed.set()
+
+    def run(self):
+        """Run all stages, wait for their end.
+
+        Returns:
+            bool: True if all stages are completed without errors
+        """
+        for thread in self._threads:
+            thread.start()
+        for thread in self._threads:
+            thread.join()
+        return len(self.errors) == 0
+
+
+def iter_summarization_claims(pg_conn_cfg):
+    """Claim batches of news to summarization until there are no candidates"""
+    while True:
+        claimed = claim_news(
+            pg_conn_cfg,
+            summ.CLAIM_STAGE,
+            summ.QUERY_NEWS_TO_SUMMARY_CANDIDATES,
+            {"id_news": None},
+            PIPE_BATCH_SIZE,
+            summ.CLAIM_LEASE,
+        )
+        if len(claimed) == 0:
+            return
+        yield claimed
+
+
+def claim_ner(pg_conn_cfg, id_news):
+    """Claim news for the ner-pipeline and select them.
+
+    Returns:
+        tuple(claimed, news_to_ner) or None if no news are claimed
+    """
+    claimed = claim_news(
+        pg_conn_cfg,
+        ner.CLAIM_STAGE,
+        ner.QUERY_NEWS_TO_NER_CANDIDATES,
+        {"id_news": list(id_news)},
+        len(id_news),
+        ner.CLAIM_LEASE,
+    )
+    if len(claimed) == 0:
+        return None
+    return claimed, ner.select_news_to_ner_pip(pg_conn_cfg, claimed)
+
+
+def build_stages(pg_conn_cfg, ner_backlog, summarized, linked):
+    """Stages of summarization and ner pipelines.
+
+    Args:
+        pg_conn_cfg: dict with cfg connect to database
+        ner_backlog: ids of news with summaries, not processed by ner-pipeline
+        summarized: list to add ids of summarized news
+        linked: list to add ids of news processed by ner-pipeline
+
+    Returns:
+        StageWorkers
+    """
+
+    # stages (functions of batch, return result and amount of items)
+    def select_summarization(claimed):
+        return summ.select_news_to_summary(pg_conn_cfg, claimed), len(claimed)
+
+    def inference(news_to_summary):
+        lsh = get_minhash_index(pg_conn_cfg, summ.QUERY_MINHASH_INDEX)
+        result = summ.summarize_news(news_to_summary, lsh)
+        return (result, lsh.take_unsaved()), len(news_to_summary)
+
+    def write_summaries(batch):
+        result, minhash_rows = batch
+        id_news = summ.write_summaries(pg_conn_cfg, result, minhash_rows)
+        summarized.extend(id_news)
+        # summarized news go to the ner-pipeline
+        return (claim_ner(pg_conn_cfg, id_news) if id_news else None), len(result)
+
+    def select_ner(id_news):
+        return claim_ner(pg_conn_cfg, id_news), len(id_news)
+
+    def ner_extraction(batch):
+        claimed, news_to_ner = batch
+        similar = ner.select_similar_news_ents(pg_conn_cfg, claimed)
+        synonyms = ner.get_norm_ners_from_news(news_to_ner, similar)
+        return (claimed, synonyms), len(news_to_ner)
+
+    def entity_linking(batch):
+        claimed, synonyms = batch
+        return (claimed, ner.entity_linking(pg_conn_cfg, synonyms)), len(claimed)
+
+    def write_ners(batch):
+        claimed, synonyms = batch
+        linked.extend(ner.write_db_results_ner_pipeline(pg_conn_cfg, synonyms, claimed))
+        return None, len(claimed)
+
+    ner_backlog_batches = (
+        ner_backlog[i : i + PIPE_BATCH_SIZE]  # noqa E203
+        for i in range(0, len(ner_backlog), PIPE_BATCH_SIZE)
+    )
+
+    workers = StageWorkers()
+    # fmt: off
+    workers.add_stage(summ.CLAIM_STAGE, "select", select_summarization,
+                      iter_summarization_claims(pg_conn_cfg), "to_summarize")
+    workers.add_stage(summ.CLAIM_STAGE, "inference", inference,
+                      "to_summarize", "summaries")
+    workers.add_stage(summ.CLAIM_STAGE, "db_write", write_summaries,
+                      "summaries", "to_ner")
+    workers.add_stage(ner.CLAIM_STAGE, "select", select_ner,
+                      ner_backlog_batches, "to_ner")
+    workers.add_stage(ner.CLAIM_STAGE, "ner_extraction", ner_extraction,
+                      "to_ner", "to_link")
+    workers.add_stage(ner.CLAIM_STAGE, "entity_linking", entity_linking,
+                      "to_link", "to_write")
+    workers.add_stage(ner.CLAIM_STAGE, "db_write", write_ners, "to_write")
+    # fmt: on
+    return workers
+
+
+def overlapped_pipeline(pg_conn_cfg):
+    """Run summarization and ner pipelines for all unprocessed news with
+    overlapped stages.
+
+    Returns:
+        list: ids of news processed by the ner-pipeline
+    """
+    start = time.perf_counter()
+    # backlog of the ner-pipeline at start (news with summaries)
+    ner_backlog = [
+        row[0]
+        for row in safe_pg_read_query(
+            pg_conn_cfg, ner.QUERY_NEWS_TO_NER_CANDIDATES, {"id_news": None}
+        )
+    ]
+    set_gauge("ml_backlog_news", len(ner_backlog), pipeline=ner.CLAIM_STAGE)
+
+    # load models before start of workers (once per process)
+    summ.get_model(summ.MODEL_CFG["name"])
+    ner.get_nlp_models()
+
+    summarized, linked = [], []
+    workers = build_stages(pg_conn_cfg, ner_backlog, summarized, linked)
+    completed = workers.run()
+
+    if len(linked) > 0:
+        with stage_timer(ner.CLAIM_STAGE, "update_names"):
+            ner.update_main_ner_names_and_types(pg_conn_cfg)
+        bump_data_version(pg_conn_cfg)
+
+    duration = time.perf_counter() - start
+    busy = ", ".join(f"{stage} {sec:.1f} s" for stage, sec in workers.busy.items())
+    print(
+        f"Info: Overlapped pipeline: {len(summarized)} news summarized, "
+        f"{len(linked)} news linked in {duration:.1f} s (busy time of stages: "
+        f"{busy})."
+    )
+    if not completed:
+        export_metrics()
+        sys.exit(f"Overlapped pipeline is stopped: {workers.errors}")
+
+    for pipeline in (summ.CLAIM_STAGE, ner.CLAIM_STAGE):
+        set_gauge("ml_last_success_timestamp_seconds", time.time(), pipeline=pipeline)
+    export_metrics()
+    return linked
+
+
+if __name__ == "__main__":
+    overlapped_pipeline(PG_CONN_CFG)
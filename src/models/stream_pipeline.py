@@ -0,0 +1,156 @@
+"""Stream ml-pipeline script (run from cli), alternative to hourly batch run
+of summarization_pipeline.py and ner_pipeline.py.
+
+Description of the algorithm:
+1. We listen NEWS_INSERTED_CHANNEL (the parser sends NOTIFY with ids of new
+   news in transaction of their insert)
+2. We collect ids to micro-batch (until STREAM_BATCH_SIZE ids or
+   STREAM_BATCH_WAIT seconds after the first id)
+3. We run summarization and ner pipelines for the micro-batch (models are
+   loaded once per process), the ner-pipeline notifies the app (graph store
+   and cache) about new links
+4. We report latency from ingest (news.date_collected) and from publication
+   (news.news_date) to graph visibility (commit of the ner-pipeline)
+5. At start and every STREAM_SWEEP_INTERVAL seconds we run pipelines for all
+   unprocessed news (news inserted while the stream pipeline was down,
+   missed notifications)
+"""
+import os
+import time
+import select
+import numpy as np
+import psycopg2
+from psycopg2 import Error
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from src.common_funcs import NEWS_INSERTED_CHANNEL, safe_pg_read_query
+from src.common_metrics import set_gauge, export_metrics
+from src.models.summarization_pipeline import summarization_pipeline
+from src.models.ner_pipeline import ner_pipeline
+
+# Hyperparameters
+PG_CONN_CFG = {
+    "dbname": os.environ.get("POSTGRES_DB"),
+    "user": os.environ.get("POSTGRES_USER"),
+    "host": os.environ.get("POSTGRES_HOST"),
+    "port": os.environ.get("POSTGRES_PORT"),
+}
+with open(os.environ.get("POSTGRES_PASSWORD_FILE"), "r") as f:
+    PG_CONN_CFG["password"] = f.readlines()[0].rstrip("\n")
+
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 64))
+STREAM_BATCH_WAIT = float(os.environ.get("STREAM_BATCH_WAIT", 5))
+STREAM_SWEEP_INTERVAL = float(os.environ.get("STREAM_SWEEP_INTERVAL", 900))
+
+
+def report_latency(pg_conn_cfg, id_news):
+    """Print latency (in seconds) from ingest and from publication of news
+    to now (i.e. to graph visibility)"""
+    if len(id_news) == 0:
+        return
+    query = """
+    SELECT EXTRACT(EPOCH FROM now() - date_collected),
+           EXTRACT(EPOCH FROM now() - news_date)
+    FROM news
+    WHERE id_news = ANY(%s);
+    """
+    latency = np.array(
+        safe_pg_read_query(pg_conn_cfg, query, (list(id_news),)), dtype=float
+    )
+    ingest_p50, ingest_max = np.percentile(latency[:, 0], [50, 100])
+    publish_p50, publish_max = np.percentile(latency[:, 1], [50, 100])
+    for since, quantile, value in (
+        ("ingest", "0.5", ingest_p50),
+        ("ingest", "1", ingest_max),
+        ("publication", "0.5", publish_p50),
+        ("publication", "1", publish_max),
+    ):
+        set_gauge("ml_stream_latency_seconds", value, since=since, quantile=quantile)
+    print(
+        f"Info: Stream latency of {len(id_news)} news: from ingest p50 "
+        f"{ingest_p50:.1f} s, max {ingest_max:.1f} s; from publication p50 "
+        f"{publish_p50:.1f} s, max {publish_max:.1f} s."
+    )
+
+
+def process_news(pg_conn_cfg, id_news=None):
+    """Run summarization and ner pipelines for news (None - all unprocessed
+    news)"""
+    summarization_pipeline(pg_conn_cfg, id_news)
+    linked_id_news = ner_pipeline(pg_conn_cfg, id_news)
+    report_latency(pg_conn_cfg, linked_id_news)
+    export_metrics()
+
+
+def wait_news_ids(pg_con, timeout):
+    """Wait notifications with ids of new news (not longer than timeout)
+
+    Returns:
+        set: ids of new news
+    """
+    id_news = set()
+    if select.select([pg_con], [], [], max(timeout, 0))[0]:
+        pg_con.poll()
+        while pg_con.notifies:
+            notify = pg_con.notifies.pop(0)
+            id_news.update(map(int, notify.payload.split(",")))
+    return id_news
+
+
+def stream_pipeline(pg_conn_cfg):
+    """Listen new news and process them by micro-batches (reconnect on
+    errors)."""
+    while True:
+        try:
+            pg_con = psycopg2.connect(
+                dbname=pg_conn_cfg["dbname"],
+                user=pg_conn_cfg["user"],
+                password=pg_conn_cfg["password"],
+                host=pg_conn_cfg["host"],
+                port=pg_conn_cfg["port"],
+            )
+            pg_con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            pg_cur = pg_con.cursor()
+            pg_cur.execute(f"LISTEN {NEWS_INSERTED_CHANNEL};")
+
+            # news inserted before LISTEN
+            process_news(pg_conn_cfg)
+            last_sweep = time.monotonic()
+
+            pending, batch_start = set(), None
+            while True:
+                now = time.monotonic()
+                if len(pending) > 0:
+                    timeout = batch_start + STREAM_BATCH_WAIT - now
+                else:
+                    timeout = last_sweep + STREAM_SWEEP_INTERVAL - now
+                id_news = wait_news_ids(pg_con, timeout)
+                if len(id_news) > 0 and len(pending) == 0:
+                    batch_start = time.monotonic()
+                pending.update(id_news)
+
+                now = time.monotonic()
+                if len(pending) >= STREAM_BATCH_SIZE or (
+                    len(pending) > 0 and now - batch_start >= STREAM_BATCH_WAIT
+                ):
+                    pending = sorted(pending)
+                    for i in range(0, len(pending), STREAM_BATCH_SIZE):
+                        process_news(
+                            pg_conn_cfg, pending[i : i + STREAM_BATCH_SIZE]  # noqa E203
+                        )
+                    pending, batch_start = set(), None
+
+                if now - last_sweep >= STREAM_SWEEP_INTERVAL:
+                    process_news(pg_conn_cfg)
+                    last_sweep = time.monotonic()
+
+        except (Exception, Error) as error:
+            print("Error connection to PostgreSQL:\n", error)
+            time.sleep(STREAM_BATCH_WAIT)
+
+        finally:
+            if "pg_con" in locals() and pg_con:
+                pg_con.close()
+
+
+if __name__ == "__main__":
+    stream_pipeline(PG_CONN_CFG)
@@ -2,9 +2,30 @@
 
 import os
 import re
+import sys
+import time
+import argparse
 import datetime
 import warnings
-from src.common_funcs import safe_pg_read_query, safe_pg_execute_values
+from functools import lru_cache
+import psycopg2
+from psycopg2 import Error
+from psycopg2.extras import execute_values
+from src.common_funcs import safe_pg_read_query, claim_news, release_claims
+from src.common_metrics import (
+    MetricsCursor,
+    stage_timer,
+    inc,
+    set_gauge,
+    export_metrics,
+)
+from src.common_profiling import enable_profiling
+from src.common_minhash import (
+    minhash_signature,
+    get_minhash_index,
+    write_minhash,
+    report_near_duplicates,
+)
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 
 warnings.filterwarnings("ignore")
@@ -32,6 +53,33 @@ PG_CONN_CFG = {
 with open(os.environ.get("POSTGRES_PASSWORD_FILE"), "r") as f:
     PG_CONN_CFG["password"] = f.readlines()[0].rstrip("\n")
 
+# work claiming (for several replicas of the pipeline): news are claimed by
+# batches, claim of crashed worker is expired after lease (in seconds)
+CLAIM_STAGE = "summarization"
+CLAIM_BATCH_SIZE = int(os.environ.get("SUMMARIZATION_CLAIM_BATCH", 100))
+CLAIM_LEASE = int(os.environ.get("CLAIM_LEASE", 3600))
+
+# ids of news to summarization (news without summary, only from id_news if it
+# is set), candidates to claim (anti-join by id_news and news_date, so only
+# the partition of the news is checked, see partition_news.py)
+QUERY_NEWS_TO_SUMMARY_CANDIDATES = """
+SELECT id_news
+FROM news
+WHERE NOT EXISTS (SELECT 1 FROM news_summary
+                  WHERE news_summary.id_news = news.id_news AND
+                        news_summary.news_date = news.news_date) AND
+      (%(id_news)s::integer[] IS Null OR id_news = ANY(%(id_news)s))
+"""
+
+# signatures of news with summaries in window of near-duplicates index
+# (payload - summary, it is reused for near-duplicates)
+QUERY_MINHASH_INDEX = """
+SELECT news_minhash.id_news, signature, summary_text
+FROM news_minhash
+    INNER JOIN news_summary ON news_summary.id_news = news_minhash.id_news
+WHERE news_summary.news_date >= now() - %(window_days)s * interval '1 day'
+"""
+
 
 def inference(
     texts, model, tokenizer, tokenizer_kwargs={}, generate_kwargs={}, num_beams=5
@@ -48,40 +96,67 @@ def inference(
     return summary
 
 
-def summarization_pipeline():
+@lru_cache(maxsize=1)
+def get_model(name):
+    """Load summarization model (once per process, e.g. for stream pipeline)
+
+    Returns:
+        tuple(tokenizer, model)
+    """
+    with stage_timer(CLAIM_STAGE, "model_load"):
+        tokenizer = AutoTokenizer.from_pretrained(name)
+        model = AutoModelForSeq2SeqLM.from_pretrained(name)
+    return tokenizer, model
 
-    # select news to summarisation (news without summary)
+
+def select_news_to_summary(pg_conn_cfg, id_news):
+    """
+    Returns:
+        list of tuples(id_news, news_text, news_source)
+    """
     query = """
     SELECT id_news, news_text, news_source
     FROM news
-    WHERE id_news NOT IN (SELECT id_news FROM news_summary);
+    WHERE id_news = ANY(%s);
     """
-    # list of tuples(id_news, news_text, summary_text)
-    news_to_summary = safe_pg_read_query(PG_CONN_CFG, query)
+    return safe_pg_read_query(pg_conn_cfg, query, (list(id_news),))
+
 
-    # # Unit-test
-    # news_to_summary = news_to_summary[:10]
+def summarize_news(news_to_summary, lsh=None):
+    """
+    Args:
+        news_to_summary: list of tuples(id_news, news_text, news_source)
+        lsh (MinHashLSH): index of near-duplicates (summary of similar news is
+                          reused, signatures of news are added to the index),
+                          None - summarize all news
 
+    Returns:
+        list of tuples(id_news, date_generated, summary_text, id_model)
+    """
     current_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     result = []
+    n_inference, inference_seconds = 0, 0.0
 
-    # if news to processing exist
-    if len(news_to_summary) > 0:
-
-        # get summarization model
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_CFG["name"])
-        model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_CFG["name"])
+    # get summarization model
+    tokenizer, model = get_model(MODEL_CFG["name"])
 
-        # processing one news at a time (do not use batch > 1 to save memory)
-        for news_id, text, source in news_to_summary:
+    # processing one news at a time (do not use batch > 1 to save memory)
+    for news_id, text, source in news_to_summary:
 
-            # clean text before input to model (custom by source or for all)
-            # if source = "src1":
-            #    text = re.sub(r"[^\x20-\xFFа-яА-ЯёЁ№\n]+|__|\*\*", '', text)
-            text = re.sub(r"[^\x20-\xFFа-яА-ЯёЁ№\n]+|__|\*\*", "", text)
+        # clean text before input to model (custom by source or for all)
+        # if source = "src1":
+        #    text = re.sub(r"[^\x20-\xFFа-яА-ЯёЁ№\n]+|__|\*\*", '', text)
+        text = re.sub(r"[^\x20-\xFFа-яА-ЯёЁ№\n]+|__|\*\*", "", text)
 
-            # task: add if news is one simple sentence, then summary = clean text
+        # task: add if news is one simple sentence, then summary = clean text
 
+        # near-duplicate of processed news, its summary is reused
+        signature = minhash_signature(text) if lsh is not None else None
+        similar = lsh.query(signature) if signature is not None else None
+        if similar is not None:
+            summary = lsh.payloads[similar[0]]
+        else:
+            start = time.perf_counter()
             summary = inference(
                 [text],
                 model,
@@ -89,37 +164,163 @@ def summarization_pipeline():
                 MODEL_CFG["tokenizer_kwargs"],
                 MODEL_CFG["generate_kwargs"],
             )[0]
+            inference_seconds += time.perf_counter() - start
+            n_inference += 1
 
-            # summary by model is incorrect if summary length > input text length
-            # in this case, use the original text
+            # summary by model is incorrect if summary length > input text
+            # length in this case, use the original text
             if len(summary) >= len(text):
                 summary = text
+        if signature is not None:
+            lsh.add(news_id, signature, summary, similar)
+
+        result.append(
+            (
+                news_id,
+                current_date,
+                summary,
+                MODEL_CFG["id_model"],
+            )
+        )
+
+    if lsh is not None:
+        report_near_duplicates(
+            CLAIM_STAGE,
+            len(news_to_summary),
+            len(news_to_summary) - n_inference,
+            inference_seconds / max(n_inference, 1),
+        )
+    return result
+
 
-            result.append(
-                (
-                    news_id,
-                    current_date,
-                    summary,
-                    MODEL_CFG["id_model"],
-                )
+def write_summaries(pg_conn_cfg, result, minhash_rows=()):
+    """Write summaries and their MinHash signatures (only of news still
+    claimed by the worker) and release claims in single transaction.
+
+    Args:
+        pg_conn_cfg: dict with cfg connect to database
+        result: list of tuples(id_news, date_generated, summary_text, id_model)
+        minhash_rows: signatures of news (see MinHashLSH.take_unsaved)
+
+    Returns:
+        list: ids of news with written summaries
+    """
+    try:
+        pg_con = psycopg2.connect(
+            dbname=pg_conn_cfg["dbname"],
+            user=pg_conn_cfg["user"],
+            password=pg_conn_cfg["password"],
+            host=pg_conn_cfg["host"],
+            port=pg_conn_cfg["port"],
+        )
+        pg_cur = pg_con.cursor(cursor_factory=MetricsCursor)
+
+        claimed = release_claims(pg_cur, CLAIM_STAGE, [row[0] for row in result])
+        result = [row for row in result if row[0] in claimed]
+
+        if len(result) > 0:
+            # news_date of the news (partition key) is taken from news
+            query = """
+                INSERT INTO news_summary(id_news, news_date, date_generated,
+                                         summary_text, id_model)
+                SELECT data.id_news, news.news_date, data.date_generated::timestamp,
+                       data.summary_text, data.id_model
+                FROM (VALUES %s) AS data(id_news, date_generated, summary_text,
+                                         id_model)
+                     INNER JOIN news USING(id_news)
+            """
+            execute_values(pg_cur, query, result)
+            write_minhash(pg_cur, [row for row in minhash_rows if row[0] in claimed])
+
+        pg_con.commit()
+        pg_cur.close()
+        inc("ml_rows_written_total", len(result), table="news_summary")
+
+    except (Exception, Error) as error:
+        print("Error connection to PostgreSQL:\n", error)
+        sys.exit(str(error))
+    finally:
+        if "pg_con" in locals() and pg_con:
+            pg_cur.close()
+            pg_con.close()
+
+    return [row[0] for row in result]
+
+
+def summarization_pipeline(pg_conn_cfg, id_news=None):
+    """News are processed by batches claimed by the worker (several replicas
+    of the pipeline process different news). Metrics of stages are exported
+    by export_metrics.
+
+    Args:
+        pg_conn_cfg: dict with cfg connect to database
+        id_news: list of ids of news to process (None - all news without summary)
+
+    Returns:
+        list: ids of processed news
+    """
+
+    placeholder = {"id_news": None if id_news is None else list(id_news)}
+    backlog = safe_pg_read_query(
+        pg_conn_cfg,
+        f"SELECT COUNT(*) FROM ({QUERY_NEWS_TO_SUMMARY_CANDIDATES}) candidates;",
+        placeholder,
+    )[0][0]
+    set_gauge("ml_backlog_news", backlog, pipeline=CLAIM_STAGE)
+
+    processed = []
+    while True:
+        with stage_timer(CLAIM_STAGE, "select") as stage:
+            claimed = claim_news(
+                pg_conn_cfg,
+                CLAIM_STAGE,
+                QUERY_NEWS_TO_SUMMARY_CANDIDATES,
+                placeholder,
+                CLAIM_BATCH_SIZE,
+                CLAIM_LEASE,
             )
+            news_to_summary = []
+            if len(claimed) > 0:
+                news_to_summary = select_news_to_summary(pg_conn_cfg, claimed)
+            stage["items"] = len(news_to_summary)
+        if len(claimed) == 0:
+            break
 
-        del model, tokenizer
+        # # Unit-test
+        # news_to_summary = news_to_summary[:10]
+
+        # load model and index of near-duplicates before timer of inference
+        # (once per process)
+        get_model(MODEL_CFG["name"])
+        lsh = get_minhash_index(pg_conn_cfg, QUERY_MINHASH_INDEX)
+        with stage_timer(CLAIM_STAGE, "inference", len(news_to_summary)):
+            result = summarize_news(news_to_summary, lsh)
 
         # save summarization results in database
-        query = """
-            INSERT INTO news_summary(id_news, date_generated,
-                                    summary_text, id_model)
-            VALUES %s
-        """
-        safe_pg_execute_values(PG_CONN_CFG, query, result)
+        with stage_timer(CLAIM_STAGE, "db_write", len(result)):
+            processed.extend(write_summaries(pg_conn_cfg, result, lsh.take_unsaved()))
 
     print(
         "Summarization pipeline completed: {} - processed {} news".format(
-            current_date, len(result)
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), len(processed)
         )
     )
+    set_gauge("ml_last_success_timestamp_seconds", time.time(), pipeline=CLAIM_STAGE)
+    export_metrics()
+    return processed
 
 
 if __name__ == "__main__":
-    summarization_pipeline()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="DIR",
+        help="profile stages (cpu and memory), artifacts to DIR or PROFILE_DIR env",
+    )
+    args = parser.parse_args()
+    if args.profile is not None:
+        enable_profiling(args.profile or None)
+    summarization_pipeline(PG_CONN_CFG)